@@ -1,5 +1,5 @@
 import os
-from ssm.trainers.n2_trainer import train_all_n2
+from ssm.trainers.sweep import run_sweep
 
 def main():
     
@@ -13,8 +13,11 @@ def main():
         }
     
     N2_PATH = os.environ.get("N2_CONFIG_PATH")
-    train_all_n2(config_path=N2_PATH, ssm=False, override_config=override_dict)
-    train_all_n2(config_path=N2_PATH, ssm=True, override_config=override_dict)
+    grid = {
+        "schema": ["n2n", "n2v", "n2s"],
+        "ssm": [False, True]
+        }
+    run_sweep(config_path=N2_PATH, grid=grid, base_override=override_dict)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import torch
+from ssm.utils.export import is_exported_model, load_exported_model
 
 def apply_model_to_dataset(model_path, dataset, 
                           batch_size=8, 
@@ -17,11 +18,14 @@ def apply_model_to_dataset(model_path, dataset,
     """
     print(f"Using device: {device}")
     
-    # Load the model
-    model = SpeckleSeparationModule(input_channels=1, feature_dim=32)
-    #model = SpeckleSeparationUNet(input_channels=1, feature_dim=32)
-    model.load_state_dict(torch.load(model_path, map_location=device))
-    model.to(device)
+    # Load the model: an exported inference artifact, or the model class and its weights
+    if is_exported_model(model_path):
+        model, _ = load_exported_model(model_path, device)
+    else:
+        model = SpeckleSeparationModule(input_channels=1, feature_dim=32)
+        #model = SpeckleSeparationUNet(input_channels=1, feature_dim=32)
+        model.load_state_dict(torch.load(model_path, map_location=device))
+        model.to(device)
     model.eval()
     
     # Prepare input tensors
@@ -10,7 +10,7 @@ from ssm.data import get_paired_loaders
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-def normalise_sample(raw_image, reference):
+def normalise_sample(raw_image, reference, size=(256, 256)):
         '''
         sample = random.choice(list(dataset.keys()))
         raw_image = dataset[sample]["raw"][0][0]
@@ -27,9 +27,9 @@ def normalise_sample(raw_image, reference):
         import cv2
         from ssm.utils import normalize_image_np
         
-        # Normalise the raw image
+        # Normalise the raw image, resizing unless size is None (tiled evaluation)
         raw_image = raw_image.cpu().numpy()
-        resized = cv2.resize(raw_image, (256, 256), interpolation=cv2.INTER_LINEAR)
+        resized = cv2.resize(raw_image, size, interpolation=cv2.INTER_LINEAR) if size is not None else raw_image
         resized = normalize_image_np(resized)
         raw_image = torch.from_numpy(resized).float()
         raw_image = raw_image.unsqueeze(0).unsqueeze(0)
@@ -37,7 +37,7 @@ def normalise_sample(raw_image, reference):
 
         # Normalise the reference image
         reference = reference.cpu().numpy()
-        resized_ref = cv2.resize(reference, (256, 256), interpolation=cv2.INTER_LINEAR)
+        resized_ref = cv2.resize(reference, size, interpolation=cv2.INTER_LINEAR) if size is not None else reference
         resized_ref = normalize_image_np(resized_ref)
         reference = torch.from_numpy(resized_ref).float()
         reference = reference.unsqueeze(0).unsqueeze(0)
@@ -67,14 +67,16 @@ def main(method=None, soct=True):
     if soct:
 
         sdoct_path = r"C:\Datasets\OCTData\boe-13-12-6357-d001\Sparsity_SDOCT_DATASET_2012"
-        dataset = load_sdoct_dataset(sdoct_path)
+        # With 'tile_size' set the models are evaluated on native-resolution B-scans
+        size = None if config['training'].get('tile_size', None) else (256, 256)
+        dataset = load_sdoct_dataset(sdoct_path, target_size=size)
 
         # random sample
         #sample = random.choice(list(dataset.keys()))
         sample = '1'
         raw_image = dataset[sample]["raw"][0][0]
         reference = dataset[sample]["avg"][0][0]
-        raw_image, reference = normalise_sample(raw_image, reference)
+        raw_image, reference = normalise_sample(raw_image, reference, size)
     
     else:
         n_images_per_patient = config['training']['n_images_per_patient']
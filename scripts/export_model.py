@@ -0,0 +1,62 @@
+import os
+import argparse
+import torch
+
+from ssm.utils.config import get_config
+from ssm.utils.export import export_model, export_path, checkpoint_metadata
+from ssm.models.ssm.frozen_ssm import load_speckle_module
+from ssm.schemas.components.evaluate_baselines import load_model, baseline_checkpoint_path
+
+def export_baseline(config_path, method, ssm=False, last=False, best=False, fmt='torchscript'):
+    config = get_config(config_path)
+    config['training']['method'] = method
+    config['training']['compile'] = False
+    config['training']['artifact'] = None
+    if ssm:
+        config['speckle_module']['use'] = True
+
+    model, checkpoint = load_model(config, last=last, best=best)
+    path = export_path(baseline_checkpoint_path(config, last, best), fmt)
+    return export_model(model, path, method=fmt, metadata=checkpoint_metadata(checkpoint))
+
+def export_speckle_module(checkpoint_path, fmt='torchscript', device='cpu'):
+    # Rebuilds distilled students too, from the architecture recorded in the checkpoint
+    model = load_speckle_module(checkpoint_path, device)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    return export_model(model, export_path(checkpoint_path, fmt), method=fmt, metadata=checkpoint_metadata(checkpoint))
+
+def main():
+    """
+    Export trained models as inference artifacts for evaluation and apply_ssm.
+
+        python scripts/export_model.py n2 --method n2n --ssm
+        python scripts/export_model.py ssm --checkpoint path/to/ssm_checkpoint.pth
+
+    Evaluation then loads the artifact with the 'artifact' training option
+    (True for the artifact next to the evaluated checkpoint, or a path).
+    """
+    parser = argparse.ArgumentParser(description="Export inference artifacts")
+    parser.add_argument("--format", choices=["torchscript", "export"], default="torchscript")
+    subparsers = parser.add_subparsers(dest="model", required=True)
+
+    n2_parser = subparsers.add_parser("n2", help="An n2 baseline checkpoint")
+    n2_parser.add_argument("--method", required=True, choices=["n2n", "n2v", "n2s"])
+    n2_parser.add_argument("--ssm", action="store_true")
+    n2_parser.add_argument("--last", action="store_true")
+    n2_parser.add_argument("--best", action="store_true", help="Best-metrics checkpoint")
+
+    ssm_parser = subparsers.add_parser("ssm", help="A speckle separation module checkpoint")
+    ssm_parser.add_argument("--checkpoint", default=None)
+
+    args = parser.parse_args()
+
+    if args.model == "n2":
+        export_baseline(os.environ.get("N2_CONFIG_PATH"), args.method, args.ssm, args.last, args.best, args.format)
+    else:
+        checkpoint_path = args.checkpoint
+        if checkpoint_path is None:
+            checkpoint_path = get_config(os.environ.get("N2_CONFIG_PATH"))['training']['ssm_checkpoint_path']
+        export_speckle_module(checkpoint_path, args.format)
+
+if __name__ == "__main__":
+    main()
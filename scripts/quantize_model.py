@@ -0,0 +1,78 @@
+import os
+import argparse
+from ssm.utils.config import get_config
+from ssm.utils.quantization import calibration_samples, quantize_and_report, save_quantized
+from ssm.utils.export import export_path
+from ssm.models.ssm.frozen_ssm import load_speckle_module
+from ssm.schemas.components.evaluate_baselines import load_model, baseline_checkpoint_path
+
+def report_path(checkpoint_path):
+    root = checkpoint_path[:-4] if checkpoint_path.endswith('.pth') else checkpoint_path
+    return root + '_quantization.json'
+
+def load_baseline(config_path, method, ssm=False, last=False, best=False):
+    config = get_config(config_path)
+    config['training']['method'] = method
+    config['training']['device'] = 'cpu'
+    config['training']['compile'] = False
+    config['training']['artifact'] = None
+    if ssm:
+        config['speckle_module']['use'] = True
+    model, _ = load_model(config, last=last, best=best)
+    return model, baseline_checkpoint_path(config, last, best)
+
+def main():
+    """
+    Quantise a trained model to int8 and compare it with fp32 on CPU.
+
+        python scripts/quantize_model.py n2 --method n2n --ssm
+        python scripts/quantize_model.py ssm --checkpoint path/to/ssm_checkpoint.pth
+
+    Calibration and evaluation images come from different patients. The
+    report (PSNR, SSIM, CNR, fidelity to fp32, latency, size) is printed and
+    written next to the checkpoint.
+    """
+    parser = argparse.ArgumentParser(description="Int8 quantisation for CPU inference")
+    parser.add_argument("--modes", nargs="+", choices=["static", "dynamic", "auto"], default=["static", "dynamic"])
+    parser.add_argument("--backend", default="x86", help="Quantised engine: x86, fbgemm or qnnpack")
+    parser.add_argument("--calibration-start", type=int, default=1)
+    parser.add_argument("--eval-start", type=int, default=40)
+    parser.add_argument("--n-images", type=int, default=20, help="Images per patient for calibration and evaluation")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--save", action="store_true",
+                        help="Also save the quantised models as TorchScript inference artifacts")
+    subparsers = parser.add_subparsers(dest="model", required=True)
+
+    n2_parser = subparsers.add_parser("n2", help="An n2 baseline checkpoint")
+    n2_parser.add_argument("--method", required=True, choices=["n2n", "n2v", "n2s"])
+    n2_parser.add_argument("--ssm", action="store_true")
+    n2_parser.add_argument("--last", action="store_true")
+    n2_parser.add_argument("--best", action="store_true", help="Best-metrics checkpoint")
+
+    ssm_parser = subparsers.add_parser("ssm", help="A speckle separation module checkpoint")
+    ssm_parser.add_argument("--checkpoint", default=None)
+
+    args = parser.parse_args()
+
+    config_path = os.environ.get("N2_CONFIG_PATH")
+    if args.model == "n2":
+        model, checkpoint_path = load_baseline(config_path, args.method, args.ssm, args.last, args.best)
+    else:
+        checkpoint_path = args.checkpoint or get_config(config_path)['training']['ssm_checkpoint_path']
+        model = load_speckle_module(checkpoint_path)
+
+    calibration_inputs, _ = calibration_samples(args.calibration_start, 1, args.n_images)
+    inputs, targets = calibration_samples(args.eval_start, 1, args.n_images)
+
+    models, _ = quantize_and_report(model, calibration_inputs, inputs, targets, modes=args.modes,
+                                    backend=args.backend, num_threads=args.threads,
+                                    output_path=report_path(checkpoint_path))
+    if args.save:
+        root = checkpoint_path[:-4] if checkpoint_path.endswith('.pth') else checkpoint_path
+        for name, quantized in models.items():
+            if name != 'fp32':
+                save_quantized(quantized, export_path(f"{root}_{name}"), (1,) + tuple(inputs.shape[1:]),
+                               metadata={'quantization': name})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import os
+from ssm.trainers.distil_trainer import train_distillation
+
+def main():
+    """
+    Distil the attention speckle module into a small student.
+
+    Afterwards set 'student_checkpoint_path' in the 'speckle_module' section
+    of the n2 config to the printed path to train baselines with the student
+    as the constraint.
+    """
+    override_dict = {
+        "training" : {
+            "distil_student": "SSMSimple",
+            "distil_epochs": 50,
+            }
+        }
+
+    N2_PATH = os.environ.get("N2_CONFIG_PATH")
+
+    checkpoint_path, report = train_distillation(config_path=N2_PATH, override_config=override_dict)
+    print(f"Student saved to {checkpoint_path}")
+
+if __name__ == "__main__":
+    main()
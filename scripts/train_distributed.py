@@ -0,0 +1,54 @@
+import os
+import argparse
+
+from ssm.utils.distributed import launch
+
+def train_n2_worker(schema, ssm, backend):
+    from ssm.trainers.n2_trainer import train_n2
+
+    override_dict = {"training": {"distributed_backend": backend}} if backend else None
+    train_n2(config_path=os.environ.get("N2_CONFIG_PATH"), schema=schema, ssm=ssm, override_config=override_dict)
+
+def train_ssm_worker(backend):
+    from ssm.trainers import train_speckle_separation_module
+    from ssm.losses.ssm_loss import custom_loss
+    from ssm.utils.config import get_config
+    import torch
+
+    def mse_loss(y_true, y_pred):
+        return torch.mean((y_true - y_pred) ** 2)
+
+    config = get_config(os.environ.get("SSM_CONFIG_PATH"))
+    if backend:
+        config['training']['distributed_backend'] = backend
+    loss_name = config['training']['criterion']
+    loss_fn = mse_loss if loss_name == 'mse' else custom_loss
+    train_speckle_separation_module(config['training'], loss_fn, loss_name)
+
+def main():
+    """
+    Distributed training of the n2 baselines or the speckle separation module.
+
+    On one machine:
+        python scripts/train_distributed.py --nproc 4 --backend gloo n2 --schema n2n
+    Across nodes, start it with torchrun on every node instead:
+        torchrun --nnodes 2 --nproc-per-node 4 --rdzv-endpoint host:29500 scripts/train_distributed.py ssm
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nproc', type=int, default=1, help='Local processes to spawn (ignored under torchrun)')
+    parser.add_argument('--backend', default=None, help="'nccl' or 'gloo', defaults by device")
+    parser.add_argument('--master-port', type=int, default=29500)
+    subparsers = parser.add_subparsers(dest='trainer', required=True)
+    n2_parser = subparsers.add_parser('n2')
+    n2_parser.add_argument('--schema', required=True, help='n2n, n2v or n2s')
+    n2_parser.add_argument('--ssm', action='store_true')
+    subparsers.add_parser('ssm')
+    args = parser.parse_args()
+
+    if args.trainer == 'n2':
+        launch(train_n2_worker, args.nproc, args.schema, args.ssm, args.backend, master_port=args.master_port)
+    else:
+        launch(train_ssm_worker, args.nproc, args.backend, master_port=args.master_port)
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,4 @@
-from .paired_dataset import get_paired_loaders
\ No newline at end of file
+from .paired_dataset import get_paired_loaders, split_batch, cache_paired_dataset, CachedPairedDataset
+from .patch_dataset import get_patch_loaders, RandomPatchDataset
+from .flow_store import get_flow_loaders, precompute_flow_maps, FlowMapDataset
+from .tensor_loader import get_tensor_loaders, TensorBatchLoader
\ No newline at end of file
@@ -0,0 +1,144 @@
+import os
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Subset
+
+from ssm.data.paired_dataset import load_paired_dataset
+from ssm.models.ssm.frozen_ssm import FrozenSpeckleModule, load_speckle_module
+
+def file_hash(path, chunk_size=1 << 20):
+    """Short SHA-256 digest of a file, used to key stored flow maps by checkpoint."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+def dataset_fingerprint(dataset):
+    """Short digest of the input images of a ``PairedOCTDataset``, in order."""
+    digest = hashlib.sha256()
+    for image in dataset.input_images:
+        image = np.ascontiguousarray(image, dtype=np.float32)
+        digest.update(str(image.shape).encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()[:16]
+
+def normalize_flow_maps(flows):
+    """Min-max normalise each flow map of a (N, C, H, W) tensor to [0, 1] independently."""
+    flat = flows.flatten(1)
+    min_val = flat.min(dim=1, keepdim=True)[0]
+    max_val = flat.max(dim=1, keepdim=True)[0]
+    scale = torch.where(max_val > min_val, max_val - min_val, torch.ones_like(max_val))
+    flat = torch.where(max_val > min_val, (flat - min_val) / scale, torch.zeros_like(flat))
+    return flat.view_as(flows)
+
+def flow_store_path(ssm_checkpoint_path, dataset, store_dir=None):
+    """Location of the stored flow maps for this checkpoint and dataset."""
+    if store_dir is None:
+        store_dir = os.path.join(os.environ["DATASET_DIR_PATH"], "flow_maps")
+    # Stores hold raw flow maps; the '_raw' name keeps older per-image normalised stores from being reused
+    return os.path.join(store_dir, file_hash(ssm_checkpoint_path), f"{dataset_fingerprint(dataset)}_raw.npy")
+
+def precompute_flow_maps(dataset, ssm_checkpoint_path, device='cuda', batch_size=16, store_dir=None, overwrite=False):
+    """
+    Run the frozen speckle separation module once over a dataset and store the flow maps.
+
+    Raw flow maps of the input images are saved as a single (N, 1, H, W)
+    float32 ``.npy`` file under
+    ``<store_dir>/<checkpoint hash>/<dataset fingerprint>_raw.npy`` (``store_dir``
+    defaults to ``$DATASET_DIR_PATH/flow_maps``). Existing stores are reused.
+    They are not normalised: the trainers normalise stored input flows and
+    fresh output flows together, exactly as without the store.
+
+    Args:
+        dataset: ``PairedOCTDataset`` to process
+        ssm_checkpoint_path: Speckle module checkpoint, see ``load_speckle_module``
+        device: Device to run the module on
+        batch_size: Images per forward pass
+        store_dir: Root directory of the store
+        overwrite: Recompute even if a store exists
+
+    Returns:
+        np.ndarray: Memory-mapped (N, 1, H, W) flow maps
+    """
+    path = flow_store_path(ssm_checkpoint_path, dataset, store_dir)
+    if os.path.exists(path) and not overwrite:
+        print(f"Loading precomputed flow maps from {path}")
+        return np.load(path, mmap_mode='r')
+
+    print(f"Precomputing flow maps for {len(dataset)} images into {path}")
+    speckle_module = FrozenSpeckleModule(load_speckle_module(ssm_checkpoint_path)).to(device)
+
+    inputs_only = [dataset[i][0] for i in range(len(dataset))]
+    flows = []
+    for start in range(0, len(inputs_only), batch_size):
+        batch = torch.stack(inputs_only[start:start + batch_size]).to(device)
+        flow, = speckle_module.flows(batch)
+        flows.append(flow.float().cpu())
+    flows = torch.cat(flows, dim=0).numpy().astype(np.float32)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, flows)
+    os.replace(tmp_path, path)
+
+    return np.load(path, mmap_mode='r')
+
+class FlowMapDataset(Dataset):
+    """
+    Paired dataset that also yields the precomputed flow map of each input.
+
+    Items are ``(input, target, flow_input)`` tensors.
+    """
+    def __init__(self, dataset, flow_maps):
+        if len(dataset) != len(flow_maps):
+            raise ValueError(f"Dataset has {len(dataset)} images but {len(flow_maps)} flow maps")
+        self.dataset = dataset
+        self.flow_maps = flow_maps
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        input_tensor, target_tensor = self.dataset[idx][:2]
+        flow_tensor = torch.from_numpy(np.array(self.flow_maps[idx], dtype=np.float32))
+        return input_tensor, target_tensor, flow_tensor
+
+def get_flow_loaders(start, ssm_checkpoint_path, n_patients=2, n_images_per_patient=50, batch_size=8,
+                val_split=0.2, shuffle=True, device='cuda', store_dir=None, cache_dir=None):
+    """
+    Paired loaders yielding ``(input, target, flow_input)`` from the flow-map store.
+
+    The split matches ``get_paired_loaders``; flow maps are computed on first use.
+    """
+    full_dataset = load_paired_dataset(start, n_patients, n_images_per_patient, cache_dir=cache_dir)
+
+    dataset_size = len(full_dataset)
+    print(f"Dataset size: {dataset_size}")
+    val_size = int(val_split * dataset_size)
+    train_size = dataset_size - val_size
+
+    flow_maps = precompute_flow_maps(full_dataset, ssm_checkpoint_path, device=device, store_dir=store_dir)
+    flow_dataset = FlowMapDataset(full_dataset, flow_maps)
+
+    train_dataset = Subset(flow_dataset, np.arange(train_size))
+    val_dataset = Subset(flow_dataset, np.arange(train_size, dataset_size))
+
+    train_loader = DataLoader(
+        train_dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=0,
+        drop_last=True
+    )
+
+    val_loader = DataLoader(
+        val_dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=0,
+        drop_last=True
+    )
+
+    return train_loader, val_loader
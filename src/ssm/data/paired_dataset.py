@@ -1,3 +1,6 @@
+import os
+import json
+import shutil
 import numpy as np
 import torch
 from skimage import io
@@ -6,8 +9,9 @@ from torch.utils.data import Dataset, DataLoader
 from ssm.utils import paired_preprocessing
 
 class PairedOCTDataset(Dataset):
-    def __init__(self, start, n_patients=2, n_images_per_patient=50, transform=None, diabetes_list=[0,1,2]):
+    def __init__(self, start, n_patients=2, n_images_per_patient=50, transform=None, diabetes_list=[0,1,2], return_index=False):
         self.transform = transform
+        self.return_index = return_index
         dataset_dict = paired_preprocessing(start, n_patients, n_images_per_patient, diabetes_list=diabetes_list)
         
         self.input_images = []
@@ -45,13 +49,103 @@ class PairedOCTDataset(Dataset):
         if self.transform:
             input_tensor = self.transform(input_tensor)
             target_tensor = self.transform(target_tensor)
-            
+        
+        if self.return_index:
+            return input_tensor, target_tensor, idx
         return input_tensor, target_tensor
 
+class CachedPairedDataset(PairedOCTDataset):
+    """
+    ``PairedOCTDataset`` read from a cache written by ``cache_paired_dataset``.
+
+    Images are memory-mapped copy-on-write, so concurrent trials reading the
+    same cache share its pages instead of each holding a preprocessed copy.
+    """
+    def __init__(self, cache_path, transform=None, return_index=False):
+        self.transform = transform
+        self.return_index = return_index
+        self.input_images = np.load(os.path.join(cache_path, 'inputs.npy'), mmap_mode='c')
+        self.target_images = np.load(os.path.join(cache_path, 'targets.npy'), mmap_mode='c')
+
+def paired_cache_path(start, n_patients, n_images_per_patient, diabetes_list=(0, 1, 2), cache_dir=None):
+    """Cache directory of one paired dataset, under ``$DATASET_DIR_PATH/paired_cache`` by default."""
+    if cache_dir is None:
+        cache_dir = os.path.join(os.environ["DATASET_DIR_PATH"], "paired_cache")
+    diabetes = '-'.join(str(d) for d in diabetes_list)
+    return os.path.join(cache_dir, f"start{start}_patients{n_patients}_images{n_images_per_patient}_diabetes{diabetes}")
+
+def cache_paired_dataset(start, n_patients=2, n_images_per_patient=50, diabetes_list=(0, 1, 2), cache_dir=None,
+                         overwrite=False):
+    """
+    Preprocess a paired dataset once and store it as ``.npy`` arrays.
+
+    Inputs and targets are stacked into ``inputs.npy`` and ``targets.npy``
+    (float32) with a ``meta.json`` describing the dataset. The directory is
+    written under a temporary name and renamed into place, so readers never
+    see a partial cache. Existing caches are reused.
+
+    Returns:
+        str: Cache directory for ``CachedPairedDataset``
+    """
+    path = paired_cache_path(start, n_patients, n_images_per_patient, diabetes_list, cache_dir)
+    if os.path.exists(os.path.join(path, 'meta.json')) and not overwrite:
+        print(f"Using cached dataset {path}")
+        return path
+
+    dataset = PairedOCTDataset(start, n_patients=n_patients, n_images_per_patient=n_images_per_patient,
+                               diabetes_list=list(diabetes_list))
+    print(f"Caching {len(dataset)} image pairs to {path}")
+    tmp_path = path + f'.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'inputs.npy'), np.stack(dataset.input_images).astype(np.float32))
+    np.save(os.path.join(tmp_path, 'targets.npy'), np.stack(dataset.target_images).astype(np.float32))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({
+            'start': start,
+            'n_patients': n_patients,
+            'n_images_per_patient': n_images_per_patient,
+            'diabetes_list': list(diabetes_list),
+            'size': len(dataset),
+        }, f, indent=2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return path
+
+def load_paired_dataset(start, n_patients=2, n_images_per_patient=50, return_index=False, cache_dir=None):
+    """
+    ``PairedOCTDataset``, or its cached memory-mapped copy when ``cache_dir`` is given.
+
+    The cache is built on first use.
+    """
+    if cache_dir is None:
+        return PairedOCTDataset(start, n_patients=n_patients, n_images_per_patient=n_images_per_patient,
+                                return_index=return_index)
+    path = cache_paired_dataset(start, n_patients, n_images_per_patient, cache_dir=cache_dir)
+    return CachedPairedDataset(path, return_index=return_index)
+
+def split_batch(batch):
+    """
+    Unpack a loader batch into (inputs, targets, indices, flow_maps).
+
+    ``indices`` holds the dataset index of each sample when the dataset was
+    built with ``return_index=True`` and ``flow_maps`` the precomputed input
+    flow maps of a ``FlowMapDataset``; either is None otherwise.
+    """
+    if len(batch) == 3:
+        extra = batch[2]
+        if isinstance(extra, torch.Tensor) and extra.dim() > 1:
+            return batch[0], batch[1], None, extra
+        return batch[0], batch[1], extra, None
+    inputs, targets = batch
+    return inputs, targets, None, None
+
 def get_paired_loaders(start, n_patients=2, n_images_per_patient=50, batch_size=8, 
-                val_split=0.2, shuffle=True, random_seed=42):
+                val_split=0.2, shuffle=True, random_seed=42, return_index=False, cache_dir=None):
 
-    full_dataset = PairedOCTDataset(start, n_patients=n_patients, n_images_per_patient=n_images_per_patient)
+    full_dataset = load_paired_dataset(start, n_patients, n_images_per_patient, return_index=return_index,
+                                       cache_dir=cache_dir)
     
     dataset_size = len(full_dataset)
     print(f"Dataset size: {dataset_size}")
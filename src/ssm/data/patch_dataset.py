@@ -0,0 +1,132 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Subset
+
+from ssm.data.paired_dataset import PairedOCTDataset, load_paired_dataset
+
+class RandomPatchDataset(Dataset):
+    """
+    Random crops drawn directly from the stored image pairs of a paired dataset.
+
+    Each index maps to one (input, target) patch pair. Crop positions come from
+    a generator seeded with (seed, epoch, index), so an epoch is reproducible
+    regardless of worker count, and ``set_epoch`` draws fresh crops.
+    """
+    def __init__(self, dataset, patch_size=64, patches_per_image=8, patches_per_epoch=None, seed=42):
+        self.dataset = dataset
+        self.patch_size = patch_size
+        self.patches_per_image = patches_per_image
+        self.patches_per_epoch = patches_per_epoch
+        self.seed = seed
+        self.epoch = 0
+
+        # Crop straight from the stored numpy arrays instead of converting full images
+        if isinstance(dataset, Subset) and isinstance(dataset.dataset, PairedOCTDataset):
+            self.source = dataset.dataset
+            self.indices = list(dataset.indices)
+        elif isinstance(dataset, PairedOCTDataset):
+            self.source = dataset
+            self.indices = list(range(len(dataset)))
+        else:
+            self.source = None
+            self.indices = list(range(len(dataset)))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.patches_per_epoch is not None:
+            return self.patches_per_epoch
+        return len(self.indices) * self.patches_per_image
+
+    def _load_pair(self, image_idx):
+        if self.source is not None:
+            idx = self.indices[image_idx]
+            input_img = self.source.input_images[idx]
+            target_img = self.source.target_images[idx]
+            if len(input_img.shape) == 2:
+                input_img = input_img[:, :, np.newaxis]
+                target_img = target_img[:, :, np.newaxis]
+            # (H, W, C) -> (C, H, W) views, no copy yet
+            return input_img.transpose(2, 0, 1), target_img.transpose(2, 0, 1)
+        input_tensor, target_tensor = self.dataset[image_idx][:2]
+        return input_tensor, target_tensor
+
+    def __getitem__(self, idx):
+        rng = np.random.default_rng((self.seed, self.epoch, idx))
+        if self.patches_per_epoch is not None:
+            image_idx = int(rng.integers(len(self.indices)))
+        else:
+            image_idx = idx // self.patches_per_image
+
+        input_img, target_img = self._load_pair(image_idx)
+        h, w = input_img.shape[-2:]
+        p = self.patch_size
+        if h < p or w < p:
+            raise ValueError(f"Patch size {p} is larger than image size {(h, w)}")
+        y = int(rng.integers(h - p + 1))
+        x = int(rng.integers(w - p + 1))
+
+        input_patch = input_img[:, y:y + p, x:x + p]
+        target_patch = target_img[:, y:y + p, x:x + p]
+
+        if isinstance(input_patch, np.ndarray):
+            input_patch = torch.from_numpy(np.ascontiguousarray(input_patch)).float()
+            target_patch = torch.from_numpy(np.ascontiguousarray(target_patch)).float()
+            if self.source is not None and self.source.transform:
+                input_patch = self.source.transform(input_patch)
+                target_patch = self.source.transform(target_patch)
+        else:
+            input_patch = input_patch.contiguous()
+            target_patch = target_patch.contiguous()
+
+        return input_patch, target_patch
+
+def get_patch_loaders(start, n_patients=2, n_images_per_patient=50, batch_size=8, patch_batch_size=32,
+                patch_size=64, patches_per_image=8, patches_per_epoch=None, val_split=0.2, num_workers=0,
+                random_seed=42, cache_dir=None):
+    """
+    Training loader of random patch pairs and validation loader of full images.
+
+    The split matches ``get_paired_loaders``. Every training batch holds exactly
+    ``patch_batch_size`` patches and an epoch has ``len(train_loader)`` steps, fixed
+    by ``patches_per_epoch`` (or ``patches_per_image`` per training image).
+    Validation batches hold ``batch_size`` full images.
+    """
+    full_dataset = load_paired_dataset(start, n_patients, n_images_per_patient, cache_dir=cache_dir)
+
+    dataset_size = len(full_dataset)
+    print(f"Dataset size: {dataset_size}")
+    val_size = int(val_split * dataset_size)
+    train_size = dataset_size - val_size
+
+    train_images = Subset(full_dataset, np.arange(train_size))
+    val_dataset = Subset(full_dataset, np.arange(train_size, dataset_size))
+
+    train_dataset = RandomPatchDataset(
+        train_images,
+        patch_size=patch_size,
+        patches_per_image=patches_per_image,
+        patches_per_epoch=patches_per_epoch,
+        seed=random_seed
+    )
+    print(f"Patches per epoch: {len(train_dataset)}")
+
+    train_loader = DataLoader(
+        train_dataset,
+        batch_size=patch_batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        generator=torch.Generator().manual_seed(random_seed),
+        drop_last=True
+    )
+
+    val_loader = DataLoader(
+        val_dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=0,
+        drop_last=True
+    )
+
+    return train_loader, val_loader
@@ -0,0 +1,183 @@
+import itertools
+import torch
+
+from ssm.utils.batch_size_finder import default_memory_budget_mb
+
+def tensors_size_mb(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+def default_device_budget_mb(device='cuda', fraction=0.25):
+    """
+    Memory a dataset may occupy on ``device``: a fraction of free CUDA memory,
+    so the model and activations still fit, or of available system memory on CPU.
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free / 2**20 * fraction
+    return default_memory_budget_mb('cpu')
+
+class TensorBatchLoader:
+    """
+    Batches of a set of equally long tensors, without ``Dataset``/``DataLoader`` overhead.
+
+    Each epoch draws one permutation of the sample indices (when ``shuffle``)
+    and gathers every batch with a single ``index_select`` per tensor; without
+    shuffling batches are plain slices. Iterating yields tuples like a
+    ``DataLoader`` over a ``TensorDataset``.
+
+    When the tensors live on ``device`` they are used as is. Otherwise they are
+    kept in pinned host memory and streamed: each batch is gathered into a
+    pinned staging buffer and copied asynchronously, with the copy of the next
+    batch issued before the current one is handed out.
+
+    Args:
+        tensors: Tensors sharing their first dimension
+        batch_size: Samples per batch
+        shuffle: Reshuffle on every pass
+        drop_last: Drop the last incomplete batch
+        device: Device the batches are returned on
+        seed: Seed of the shuffling generator
+    """
+    def __init__(self, tensors, batch_size, shuffle=False, drop_last=False, device=None, seed=42):
+        self.tensors = tuple(tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = torch.device(device) if device is not None else self.tensors[0].device
+        self.seed = seed
+        self.generator = torch.Generator().manual_seed(seed)
+        self.indices = None
+        self.streaming = self.tensors[0].device != self.device
+        if self.streaming and self.device.type == 'cuda':
+            self.tensors = tuple(t if t.is_pinned() else t.pin_memory() for t in self.tensors)
+        self._buffers = None
+
+    def __len__(self):
+        n = self.num_samples
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+    @property
+    def num_samples(self):
+        return len(self.indices) if self.indices is not None else self.tensors[0].size(0)
+
+    def shard(self, rank, world_size):
+        """
+        Loader over the samples of one rank, for distributed training.
+
+        Shards are strided and cut to equal length so every rank runs the
+        same number of batches; each rank shuffles within its own shard.
+        """
+        n = self.tensors[0].size(0) // world_size * world_size
+        loader = TensorBatchLoader(self.tensors, self.batch_size, self.shuffle, self.drop_last, self.device,
+                                   self.seed + rank)
+        loader.indices = torch.arange(rank, n, world_size)
+        return loader
+
+    def _batch_indices(self):
+        n = self.num_samples
+        if self.shuffle:
+            order = torch.randperm(n, generator=self.generator)
+            if self.indices is not None:
+                order = self.indices[order]
+        elif self.indices is not None:
+            order = self.indices
+        else:
+            order = None
+
+        stop = n // self.batch_size * self.batch_size if self.drop_last else n
+        for start in range(0, stop, self.batch_size):
+            end = min(start + self.batch_size, n)
+            yield (start, end) if order is None else order[start:end]
+
+    def _gather(self, index, out=None):
+        if isinstance(index, tuple):
+            start, end = index
+            return tuple(t[start:end] for t in self.tensors)
+        if not self.streaming:
+            index = index.to(self.device)
+        if out is None:
+            return tuple(t.index_select(0, index) for t in self.tensors)
+        return tuple(torch.index_select(t, 0, index, out=o[:len(index)]) for t, o in zip(self.tensors, out))
+
+    def _staging_buffers(self):
+        # Two pinned buffers so one can be refilled while the other is being copied
+        if self._buffers is None:
+            self._buffers = [
+                tuple(torch.empty((self.batch_size,) + t.shape[1:], dtype=t.dtype).pin_memory() for t in self.tensors)
+                for _ in range(2)
+            ]
+        return self._buffers
+
+    def _stream(self, indices):
+        cuda = self.device.type == 'cuda'
+        buffers = self._staging_buffers() if cuda else None
+        events = [None, None]
+        pending = None
+        for i, index in enumerate(indices):
+            slot = i % 2
+            if events[slot] is not None:
+                events[slot].synchronize()
+            host = self._gather(index, buffers[slot] if cuda else None)
+            batch = tuple(t.to(self.device, non_blocking=cuda) for t in host)
+            if cuda:
+                events[slot] = torch.cuda.Event()
+                events[slot].record()
+            if pending is not None:
+                yield pending
+            pending = batch
+        if pending is not None:
+            yield pending
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def iter_from(self, start_batch):
+        """Iterate over this pass from batch ``start_batch`` on, without gathering the skipped batches."""
+        indices = itertools.islice(self._batch_indices(), start_batch, None)
+        if self.streaming:
+            return self._stream(indices)
+        return (self._gather(index) for index in indices)
+
+def get_tensor_loaders(tensors, batch_size, val_split=0.2, device='cuda', seed=42, memory_budget_mb=None):
+    """
+    Shuffled train and ordered validation ``TensorBatchLoader``s over in-memory tensors.
+
+    The samples are split as ``random_split`` would with the same seed and
+    reordered once so that each split is a contiguous view. If the tensors fit
+    in ``memory_budget_mb`` they are moved to ``device`` and batches never
+    leave it; otherwise they stay in pinned host memory and are streamed.
+
+    Args:
+        tensors: CPU tensors sharing their first dimension
+        batch_size: Samples per batch
+        val_split: Fraction of samples for validation
+        device: Training device
+        seed: Seed for the split and shuffling
+        memory_budget_mb: Device memory the data may use, defaults to ``default_device_budget_mb``
+
+    Returns:
+        tuple: (train_loader, val_loader)
+    """
+    n = tensors[0].size(0)
+    val_size = int(val_split * n)
+    train_size = n - val_size
+
+    # A local generator, like random_split(generator=...), leaves the global RNG untouched
+    order = torch.randperm(n, generator=torch.Generator().manual_seed(seed))
+    tensors = [t[order] for t in tensors]
+
+    size_mb = tensors_size_mb(tensors)
+    if memory_budget_mb is None:
+        memory_budget_mb = default_device_budget_mb(device)
+    if size_mb <= memory_budget_mb:
+        tensors = [t.to(device) for t in tensors]
+        print(f"Dataset ({size_mb:.0f} MB) kept on {device}")
+    else:
+        print(f"Dataset ({size_mb:.0f} MB) exceeds the {memory_budget_mb:.0f} MB budget, streaming from host memory")
+
+    train_loader = TensorBatchLoader([t[:train_size] for t in tensors], batch_size, shuffle=True,
+                                     device=device, seed=seed)
+    val_loader = TensorBatchLoader([t[train_size:] for t in tensors], batch_size, shuffle=False,
+                                   device=device, seed=seed)
+    return train_loader, val_loader
@@ -1,6 +1,19 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+
+def match_spatial_size(x, reference, align_corners=True):
+    """
+    Bilinearly resize ``x`` to the spatial size of ``reference`` when they differ.
+
+    The size check is data dependent, so modules that call this register it
+    with ``torch.fx.wrap('match_spatial_size')``; it is then recorded as a
+    single leaf call and the model stays symbolically traceable (FX graph-mode
+    quantisation, see ``ssm.utils.quantization``).
+    """
+    if x.shape[2:] != reference.shape[2:]:
+        x = F.interpolate(x, size=reference.shape[2:], mode='bilinear', align_corners=align_corners)
+    return x
     
 class ChannelAttention(nn.Module):
     def __init__(self, channels, reduction_ratio=16, scale_factor=1.0):
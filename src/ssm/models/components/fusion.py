@@ -0,0 +1,46 @@
+import copy
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+def fuse_conv_bn(model, inplace=False):
+    """
+    Fold every BatchNorm2d that directly follows a Conv2d into the convolution.
+
+    Only pairs that are consecutive children of the same ``nn.Sequential`` are
+    fused; the BatchNorm is replaced by ``nn.Identity`` so module indices and
+    the forward pass are unchanged. The model must be used in eval mode
+    afterwards, since the running statistics are baked into the weights.
+
+    Args:
+        model: Model to fuse
+        inplace: Modify ``model`` instead of a deep copy
+
+    Returns:
+        nn.Module: The fused model in eval mode
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules.keys())
+        for conv_name, bn_name in zip(names[:-1], names[1:]):
+            conv = module._modules[conv_name]
+            bn = module._modules[bn_name]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+                module._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+                module._modules[bn_name] = nn.Identity()
+
+    return model
+
+def strip_dropout(model, inplace=False):
+    """Replace every dropout layer with ``nn.Identity`` (no-ops in eval mode, but still dispatched)."""
+    if not inplace:
+        model = copy.deepcopy(model)
+    for module in model.modules():
+        for name, child in module._modules.items():
+            if isinstance(child, nn.modules.dropout._DropoutNd):
+                module._modules[name] = nn.Identity()
+    return model
@@ -1,14 +1,35 @@
+import math
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
 
 class NonLocalBlock(nn.Module):
-    def __init__(self, in_channels, inter_channels=None):
+    """
+    Embedded-Gaussian non-local block (Wang et al., 2018) with a residual connection.
+
+    Attention over all H*W positions runs through ``scaled_dot_product_attention``
+    (unscaled logits, as in the original block) in blocks of ``query_chunk_size``
+    queries, so at most a (chunk x H*W) slice of the attention matrix exists at
+    a time, and none at all with the fused CUDA kernels. ``exact=True`` keeps the
+    reference implementation that materialises the full (H*W x H*W) matrix.
+
+    Args:
+        in_channels: Channels of the input
+        inter_channels: Channels of the embeddings, default ``in_channels // 2``
+        sub_sample: Max-pool keys and values (phi and g) by 2 in each direction,
+            which cuts attention cost by 4; changes the output, unlike chunking
+        query_chunk_size: Queries per attention call, None for all at once
+        exact: Use the reference matmul/softmax implementation
+    """
+    def __init__(self, in_channels, inter_channels=None, sub_sample=False, query_chunk_size=4096, exact=False):
         super(NonLocalBlock, self).__init__()
         
         self.in_channels = in_channels
         self.inter_channels = inter_channels
+        self.sub_sample = sub_sample
+        self.query_chunk_size = query_chunk_size
+        self.exact = exact
         
         if self.inter_channels is None:
             self.inter_channels = in_channels // 2
@@ -23,29 +44,44 @@ class NonLocalBlock(nn.Module):
         # Output transformation
         self.W = nn.Conv2d(self.inter_channels, in_channels, kernel_size=1, stride=1, padding=0)
         self.bn = nn.BatchNorm2d(in_channels)
+
+    def _key_value(self, x):
+        g_x = self.g(x)
+        phi_x = self.phi(x)
+        if self.sub_sample:
+            # Parameter-free, so checkpoints load with or without sub-sampling
+            g_x = F.max_pool2d(g_x, kernel_size=2)
+            phi_x = F.max_pool2d(phi_x, kernel_size=2)
+        return phi_x.flatten(2).transpose(1, 2), g_x.flatten(2).transpose(1, 2)  # [B, N, C//2] each
+
+    def _attention_exact(self, theta_x, phi_x, g_x):
+        f = torch.matmul(theta_x, phi_x.transpose(1, 2))  # [B, H*W, N]
+        f_div_C = F.softmax(f, dim=-1)
+        return torch.matmul(f_div_C, g_x)  # [B, H*W, C//2]
+
+    def _attention(self, theta_x, phi_x, g_x):
+        chunk = self.query_chunk_size or theta_x.size(1)
+        # The non-local block uses plain dot products; undo the default 1/sqrt(d)
+        # scaling on the queries, since the 'scale' argument needs torch >= 2.1
+        theta_x = theta_x * math.sqrt(theta_x.size(-1))
+        return torch.cat([
+            F.scaled_dot_product_attention(theta_x[:, i:i + chunk], phi_x, g_x)
+            for i in range(0, theta_x.size(1), chunk)
+        ], dim=1)
         
     def forward(self, x):
         batch_size = x.size(0)
         
-        # g(x): [B, C, H, W] -> [B, C//2, H, W]
-        g_x = self.g(x).view(batch_size, self.inter_channels, -1)  # [B, C//2, H*W]
-        g_x = g_x.permute(0, 2, 1)  # [B, H*W, C//2]
-        
-        # theta(x): [B, C, H, W] -> [B, C//2, H, W]
-        theta_x = self.theta(x).view(batch_size, self.inter_channels, -1)  # [B, C//2, H*W]
-        theta_x = theta_x.permute(0, 2, 1)  # [B, H*W, C//2]
-        
-        # phi(x): [B, C, H, W] -> [B, C//2, H, W]
-        phi_x = self.phi(x).view(batch_size, self.inter_channels, -1)  # [B, C//2, H*W]
-        
-        # Calculate attention map
-        f = torch.matmul(theta_x, phi_x)  # [B, H*W, H*W]
-        f_div_C = F.softmax(f, dim=-1)
+        # theta(x): [B, C, H, W] -> [B, H*W, C//2]
+        theta_x = self.theta(x).flatten(2).transpose(1, 2)
+        # phi(x), g(x): [B, C, H, W] -> [B, N, C//2], N = H*W (H*W/4 when sub-sampled)
+        phi_x, g_x = self._key_value(x)
         
-        # Weighted sum using the attention map
-        y = torch.matmul(f_div_C, g_x)  # [B, H*W, C//2]
-        y = y.permute(0, 2, 1).contiguous()  # [B, C//2, H*W]
-        y = y.view(batch_size, self.inter_channels, *x.size()[2:])  # [B, C//2, H, W]
+        if self.exact or not hasattr(F, 'scaled_dot_product_attention'):
+            y = self._attention_exact(theta_x, phi_x, g_x)
+        else:
+            y = self._attention(theta_x, phi_x, g_x)
+        y = y.transpose(1, 2).reshape(batch_size, self.inter_channels, *x.size()[2:])  # [B, C//2, H, W]
         
         # Final transformation and residual connection
         W_y = self.W(y)  # [B, C, H, W]
@@ -56,7 +92,8 @@ class NonLocalBlock(nn.Module):
 
 # Generator Network (with Nonlocal blocks)
 class Generator(nn.Module):
-    def __init__(self, in_channels=1, out_channels=1, features=64):
+    def __init__(self, in_channels=1, out_channels=1, features=64, nonlocal_sub_sample=False,
+                 nonlocal_chunk_size=4096):
         super(Generator, self).__init__()
         
         # Encoder
@@ -84,8 +121,8 @@ class Generator(nn.Module):
         )  # [B, 512, H/16, W/16]
         
         # NonLocal blocks
-        self.nonlocal1 = NonLocalBlock(features * 8)
-        self.nonlocal2 = NonLocalBlock(features * 4)
+        self.nonlocal1 = NonLocalBlock(features * 8, sub_sample=nonlocal_sub_sample, query_chunk_size=nonlocal_chunk_size)
+        self.nonlocal2 = NonLocalBlock(features * 4, sub_sample=nonlocal_sub_sample, query_chunk_size=nonlocal_chunk_size)
         
         # Decoder
         self.dec1 = nn.Sequential(
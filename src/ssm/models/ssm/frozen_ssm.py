@@ -0,0 +1,136 @@
+import torch
+import torch.nn as nn
+
+from ssm.models.components.fusion import fuse_conv_bn, strip_dropout
+from ssm.models.ssm.ssm_attention import SpeckleSeparationUNetAttention
+from ssm.models.ssm.ssm_attention_simple import SimplifiedSpeckleSeparationModel
+
+# Speckle separation modules by the 'model_name' stored in their checkpoints
+SPECKLE_MODELS = {
+    'SSMAttention': SpeckleSeparationUNetAttention,
+    'SSMSimple': SimplifiedSpeckleSeparationModel,
+}
+
+class FrozenSpeckleModule(nn.Module):
+    """
+    Inference-only wrapper around a trained speckle separation module.
+
+    The wrapped model is switched to eval mode (BatchNorm running statistics,
+    no dropout), its BatchNorm layers are folded into the preceding convolutions
+    and its parameters are frozen. ``flows`` runs all given tensors through a
+    single batched forward without autograd and returns only the flow
+    components; ``cached_flows`` additionally keeps the flow maps of inputs
+    that do not change between epochs, keyed by dataset index.
+
+    Modules with a flow-only mode (``SpeckleSeparationUNetAttention``) are
+    switched to it, so the unused noise branch is never computed; when fusing,
+    dropout layers are removed from the copy as well.
+
+    Calling the wrapper directly returns ``{'flow_component': ...}`` so it can
+    stand in for the original module in visualisation code.
+    """
+    def __init__(self, module, fuse_bn=True, cache_device='cpu'):
+        super(FrozenSpeckleModule, self).__init__()
+        module = strip_dropout(fuse_conv_bn(module), inplace=True) if fuse_bn else module.eval()
+        if hasattr(module, 'flow_only'):
+            module.flow_only = True
+        for param in module.parameters():
+            param.requires_grad_(False)
+        self.module = module
+        self.cache_device = cache_device
+        self.cache = {}
+
+    def train(self, mode=True):
+        # Always stays in eval mode
+        return super(FrozenSpeckleModule, self).train(False)
+
+    def _flow(self, x):
+        outputs = self.module(x)
+        return outputs['flow_component'] if isinstance(outputs, dict) else outputs
+
+    def forward(self, x):
+        with torch.no_grad():
+            return {'flow_component': self._flow(x.detach())}
+
+    def flows(self, *tensors):
+        """
+        Flow components of all tensors from one batched forward pass.
+
+        Returns:
+            tuple: One flow tensor per input tensor, in order
+        """
+        sizes = [t.shape[0] for t in tensors]
+        with torch.no_grad():
+            batch = torch.cat([t.detach() for t in tensors], dim=0)
+            return torch.split(self._flow(batch), sizes, dim=0)
+
+    def cached_flows(self, inputs, keys, *others, input_flows=None):
+        """
+        Like ``flows(inputs, *others)``, reusing cached flow maps of ``inputs``.
+
+        Args:
+            inputs: Tensor whose flow maps are cached, one entry per sample
+            keys: Hashable key per sample of ``inputs`` (e.g. dataset index), or
+                None to disable caching
+            *others: Tensors computed fresh in the same forward pass (e.g. model outputs)
+            input_flows: Precomputed flow maps of ``inputs`` (e.g. from the flow-map
+                store); when given, ``inputs`` is not run through the module
+
+        Returns:
+            tuple: Flow of ``inputs`` followed by one flow tensor per ``others``
+        """
+        if input_flows is not None:
+            other_flows = self.flows(*others) if others else ()
+            return (input_flows.to(inputs.device),) + tuple(other_flows)
+
+        if keys is None:
+            return self.flows(inputs, *others)
+
+        keys = [k.item() if isinstance(k, torch.Tensor) else k for k in keys]
+        missing = [i for i, k in enumerate(keys) if k not in self.cache]
+
+        if missing:
+            index = torch.tensor(missing, device=inputs.device)
+            computed = self.flows(inputs.index_select(0, index), *others)
+            for i, flow in zip(missing, computed[0]):
+                self.cache[keys[i]] = flow.to(self.cache_device)
+            other_flows = computed[1:]
+        else:
+            other_flows = self.flows(*others) if others else ()
+
+        input_flows = torch.stack([self.cache[k] for k in keys]).to(inputs.device)
+        return (input_flows,) + tuple(other_flows)
+
+    def clear_cache(self):
+        self.cache = {}
+
+def freeze_speckle_module(speckle_module, fuse_bn=True):
+    """Wrap ``speckle_module`` in a ``FrozenSpeckleModule`` unless it already is one (or None)."""
+    if speckle_module is None or isinstance(speckle_module, FrozenSpeckleModule):
+        return speckle_module
+    return FrozenSpeckleModule(speckle_module, fuse_bn=fuse_bn)
+
+def load_speckle_module(checkpoint_path, device='cpu'):
+    """
+    Speckle separation module of a checkpoint, with its trained weights.
+
+    Checkpoints written by the distillation trainer record the architecture
+    as 'model_name' and 'model_kwargs'; older checkpoints without them are
+    ``SpeckleSeparationUNetAttention(input_channels=1, feature_dim=32)``.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model_name = checkpoint.get('model_name', 'SSMAttention')
+    model_kwargs = checkpoint.get('model_kwargs', {'input_channels': 1, 'feature_dim': 32})
+    speckle_module = SPECKLE_MODELS[model_name](**model_kwargs)
+    speckle_module.load_state_dict(checkpoint['model_state_dict'])
+    return speckle_module.to(device)
+
+def speckle_checkpoint_path(config):
+    """
+    Checkpoint of the speckle module used as the training constraint.
+
+    A distilled student ('student_checkpoint_path' in the 'speckle_module'
+    section) replaces the attention module of 'ssm_checkpoint_path'.
+    """
+    student = config.get('speckle_module', {}).get('student_checkpoint_path', None)
+    return student or config['training']['ssm_checkpoint_path']
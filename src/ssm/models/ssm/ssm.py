@@ -2,6 +2,10 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
+from ssm.models.components.components import match_spatial_size
+
+# Keeps forward symbolically traceable, see match_spatial_size
+torch.fx.wrap('match_spatial_size')
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
@@ -220,8 +224,7 @@ class SpeckleSeparationUNet(nn.Module):
             x = self.up(x)
             # Ensure matching sizes for concatenation
             encoder_feature = encoder_features[self.depth - i - 1]
-            if x.size() != encoder_feature.size():
-                x = nn.functional.interpolate(x, size=encoder_feature.size()[2:], mode='bilinear', align_corners=True)
+            x = match_spatial_size(x, encoder_feature)
             x = torch.cat([x, encoder_feature], dim=1)
             x = self.decoder_blocks[i](x)
         
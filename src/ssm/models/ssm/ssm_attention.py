@@ -1,6 +1,10 @@
 import torch
 import torch.nn as nn
 import sys
+from ssm.models.components.components import match_spatial_size
+
+# Keeps forward symbolically traceable, see match_spatial_size
+torch.fx.wrap('match_spatial_size')
 sys.path.append(r"C:\Users\CL-11\OneDrive\Repos\OCTDenoisingFinal\src")
 class ChannelAttention(nn.Module):
     """
@@ -197,11 +201,13 @@ class SpeckleSeparationUNetAttention(nn.Module):
         # Upsampling layer
         self.up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
 
+        # When set, forward returns only the flow tensor (see forward_flow)
+        self.flow_only = False
+
     def __repr__(self):
         return f"SpeckleSeparationUNetAttention(input_channels={self.input_channels}, feature_dim={self.feature_dim}, depth={self.depth}, block_depth={self.block_depth})"
 
-    def forward(self, x):
-
+    def _features(self, x):
         encoder_features = []
         
         # Encoder path with attention
@@ -219,14 +225,28 @@ class SpeckleSeparationUNetAttention(nn.Module):
         for i in range(self.depth):
             x = self.up(x)
             encoder_feature = encoder_features[self.depth - i - 1]
-            if x.size() != encoder_feature.size():
-                x = nn.functional.interpolate(x, size=encoder_feature.size()[2:], mode='bilinear', align_corners=True)
+            x = match_spatial_size(x, encoder_feature)
             x = torch.cat([x, encoder_feature], dim=1)
             x = self.decoder_blocks[i](x)
             x = self.decoder_attentions[i](x)  # Apply attention
         
         x = self.dilation_block(x)
-        x = self.final_attention(x) 
+        return self.final_attention(x)
+
+    def forward_flow(self, x):
+        """
+        Flow component only, as a tensor.
+
+        Skips the full-resolution noise branch, for callers that only use
+        ``outputs['flow_component']`` (flow losses, ROI selection).
+        """
+        return self.flow_branch(self._features(x))
+
+    def forward(self, x):
+        if self.flow_only:
+            return self.forward_flow(x)
+
+        x = self._features(x)
         
         flow_component = self.flow_branch(x)
         #flow_component = torch.where(flow_component > 0.01, flow_component, torch.zeros_like(flow_component)) # binary
@@ -1,6 +1,10 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from ssm.models.components.components import match_spatial_size
+
+# Keeps forward symbolically traceable, see match_spatial_size
+torch.fx.wrap('match_spatial_size')
 
 class SimplifiedSpeckleSeparationModel(nn.Module):
     def __init__(self, input_channels=1, feature_dim=32, depth=4):
@@ -49,6 +53,9 @@ class SimplifiedSpeckleSeparationModel(nn.Module):
         self.output_noise = nn.Sequential(
             nn.Conv2d(in_channels, input_channels, kernel_size=1)
         )
+
+        # When set, forward returns only the flow tensor (see forward_flow)
+        self.flow_only = False
     
     def _create_conv_block(self, in_channels, out_channels):
         return nn.Sequential(
@@ -60,7 +67,7 @@ class SimplifiedSpeckleSeparationModel(nn.Module):
             nn.ReLU(inplace=True)
         )
         
-    def forward(self, x):
+    def _features(self, x):
         # Store encoder outputs for skip connections
         encoder_outputs = []
         
@@ -83,13 +90,23 @@ class SimplifiedSpeckleSeparationModel(nn.Module):
             encoder_feature = encoder_outputs[-(i+1)]
             
             # Ensure sizes match for concatenation
-            if x.shape[2:] != encoder_feature.shape[2:]:
-                x = F.interpolate(x, size=encoder_feature.shape[2:], 
-                                 mode='bilinear', align_corners=True)
+            x = match_spatial_size(x, encoder_feature)
             
             x = torch.cat([x, encoder_feature], dim=1)
             
             x = self.decoder_blocks[i](x)
+
+        return x
+
+    def forward_flow(self, x):
+        """Flow component only, as a tensor, without the noise head."""
+        return self.output_flow(self._features(x))
+
+    def forward(self, x):
+        if self.flow_only:
+            return self.forward_flow(x)
+
+        x = self._features(x)
         
         # Generate output components
         flow_component = self.output_flow(x)
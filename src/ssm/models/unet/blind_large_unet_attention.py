@@ -3,6 +3,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ssm.models.components.components import DoubleConv, Down, Up, OutConv, ChannelAttention
+from ssm.models.components.components import match_spatial_size
+
+# Keeps forward symbolically traceable, see match_spatial_size
+torch.fx.wrap('match_spatial_size')
 
 import torch
 import torch.nn as nn
@@ -192,30 +196,26 @@ class BlindLargeUNetAtt(nn.Module):
         # Upsample and concatenate with corresponding encoder features
         d4 = self.up4(b)
         # Check if dimensions match and handle spatial discrepancies
-        if d4.shape[2] != e4.shape[2] or d4.shape[3] != e4.shape[3]:
-            d4 = F.interpolate(d4, size=(e4.shape[2], e4.shape[3]), mode='bilinear', align_corners=False)
+        d4 = match_spatial_size(d4, e4, align_corners=False)
         # Concatenate along channel dimension
         d4 = torch.cat([d4, e4], dim=1)
         d4 = self.dec4(d4)
         d4 = self.dropout(d4)
         
         d3 = self.up3(d4)
-        if d3.shape[2] != e3.shape[2] or d3.shape[3] != e3.shape[3]:
-            d3 = F.interpolate(d3, size=(e3.shape[2], e3.shape[3]), mode='bilinear', align_corners=False)
+        d3 = match_spatial_size(d3, e3, align_corners=False)
         d3 = torch.cat([d3, e3], dim=1)
         d3 = self.dec3(d3)
         d3 = self.dropout(d3)
         
         d2 = self.up2(d3)
-        if d2.shape[2] != e2.shape[2] or d2.shape[3] != e2.shape[3]:
-            d2 = F.interpolate(d2, size=(e2.shape[2], e2.shape[3]), mode='bilinear', align_corners=False)
+        d2 = match_spatial_size(d2, e2, align_corners=False)
         d2 = torch.cat([d2, e2], dim=1)
         d2 = self.dec2(d2)
         d2 = self.dropout(d2)
         
         d1 = self.up1(d2)
-        if d1.shape[2] != e1.shape[2] or d1.shape[3] != e1.shape[3]:
-            d1 = F.interpolate(d1, size=(e1.shape[2], e1.shape[3]), mode='bilinear', align_corners=False)
+        d1 = match_spatial_size(d1, e1, align_corners=False)
         d1 = torch.cat([d1, e1], dim=1)
         d1 = self.dec1(d1)
         
@@ -12,6 +12,7 @@ from tqdm import tqdm
 
 from losses.content_loss import ContentLoss
 from models.gan.gan import Generator, Discriminator
+from ssm.utils.precision import get_precision
 
 from IPython.display import clear_output
 
@@ -142,7 +143,8 @@ def train_nonlocal_gan(generator, discriminator, train_loader, num_epochs=100,
 
 
 def train_nonlocal_gan(generator, discriminator, train_loader, num_epochs=100, 
-                      lr_g=0.0002, lr_d=0.0002, save_path=r'C:\Users\CL-11\OneDrive\Repos\OCTDenoisingFinal\checkpoints'):
+                      lr_g=0.0002, lr_d=0.0002, save_path=r'C:\Users\CL-11\OneDrive\Repos\OCTDenoisingFinal\checkpoints',
+                      precision=None, metrics_worker=None, sample_every=100):
     os.makedirs(save_path, exist_ok=True)
     #samples_dir = os.path.join(save_path, 'samples')
     #os.makedirs(samples_dir, exist_ok=True)
@@ -155,6 +157,12 @@ def train_nonlocal_gan(generator, discriminator, train_loader, num_epochs=100,
 
     adversarial_loss = nn.BCEWithLogitsLoss()
     content_loss = ContentLoss()
+
+    # Separate gradient scalers for the two optimizers
+    precision_g = get_precision(precision, device)
+    precision_d = get_precision(precision_g.precision, device, precision_g.channels_last)
+    generator = precision_g.prepare_model(generator)
+    discriminator = precision_d.prepare_model(discriminator)
     
     for epoch in range(num_epochs):
         generator.train()
@@ -165,7 +173,7 @@ def train_nonlocal_gan(generator, discriminator, train_loader, num_epochs=100,
         
         for i, noisy_images in enumerate(tqdm(train_loader, desc=f'Epoch {epoch+1}/{num_epochs}')):
             noisy_images = noisy_images[0]
-            noisy_images = noisy_images.to(device)
+            noisy_images = precision_g.prepare_input(noisy_images.to(device))
             batch_size = noisy_images.size(0)
             
             real_labels = torch.ones(batch_size, 1, 30, 30).to(device)  # Size depends on your discriminator's output
@@ -173,46 +181,61 @@ def train_nonlocal_gan(generator, discriminator, train_loader, num_epochs=100,
             
             optimizer_d.zero_grad()
             
-            # Pass real images through discriminator
-            real_outputs = discriminator(noisy_images)
-            d_loss_real = adversarial_loss(real_outputs, real_labels)
-            
-            # Generate denoised images
-            denoised_images = generator(noisy_images)
+            with precision_d.autocast():
+                # Pass real images through discriminator
+                real_outputs = discriminator(noisy_images)
+                
+                # Generate denoised images
+                denoised_images = generator(noisy_images)
+                
+                # Pass fake (denoised) images through discriminator
+                fake_outputs = discriminator(denoised_images.detach())
             
-            # Pass fake (denoised) images through discriminator
-            fake_outputs = discriminator(denoised_images.detach())
-            d_loss_fake = adversarial_loss(fake_outputs, fake_labels)
+            # Losses in fp32
+            d_loss_real = adversarial_loss(real_outputs.float(), real_labels)
+            d_loss_fake = adversarial_loss(fake_outputs.float(), fake_labels)
             
             # Total discriminator loss
             d_loss = (d_loss_real + d_loss_fake) * 0.5
-            d_loss.backward()
-            optimizer_d.step()
+            precision_d.backward(d_loss)
+            precision_d.step(optimizer_d)
 
             optimizer_g.zero_grad()
             
             # Pass fake (denoised) images through discriminator for generator training
-            fake_outputs = discriminator(denoised_images)
-            g_loss_adv = adversarial_loss(fake_outputs, real_labels)
+            with precision_g.autocast():
+                fake_outputs = discriminator(denoised_images)
+            g_loss_adv = adversarial_loss(fake_outputs.float(), real_labels)
             
             # Content loss
-            g_loss_content = content_loss(denoised_images, noisy_images) * 10.0  # Weight higher for content preservation
+            g_loss_content = content_loss(denoised_images.float(), noisy_images.float()) * 10.0  # Weight higher for content preservation
             
             # Total generator loss
             g_loss = g_loss_adv + g_loss_content
-            g_loss.backward()
-            optimizer_g.step()
+            precision_g.backward(g_loss)
+            precision_g.step(optimizer_g)
             
             # Track losses
             running_loss_g += g_loss.item()
             running_loss_d += d_loss.item()
             
-            if i % 100 == 0:
+            if i % sample_every == 0:
                 with torch.no_grad():
                     generator.eval()
-                    sample_noisy = noisy_images[0:4].cpu()
-                    sample_denoised = generator(sample_noisy.to(device)).cpu()
-                    
+                    sample_noisy = noisy_images[0:4].float().cpu()
+                    with precision_g.autocast():
+                        sample_denoised = generator(sample_noisy.to(device)).float().cpu()
+                    generator.train()
+
+                if metrics_worker is not None:
+                    # Grid rendered and saved by the metrics worker process
+                    n = sample_noisy.size(0)
+                    metrics_worker.submit_figure(
+                        [img.squeeze().numpy() for img in sample_noisy] + [img.squeeze().numpy() for img in sample_denoised],
+                        ['Noisy'] * n + ['Denoised'] * n,
+                        {'D Loss': d_loss.item(), 'G Loss': g_loss.item()},
+                        name=f"gan_epoch_{epoch+1}_iter_{i}", cols=n)
+                else:
                     # Create grid of images
                     fig, axes = plt.subplots(2, 4, figsize=(12, 6))
                     for j in range(4):
@@ -229,7 +252,6 @@ def train_nonlocal_gan(generator, discriminator, train_loader, num_epochs=100,
                     plt.tight_layout()
                     #plt.savefig(os.path.join(samples_dir, f'epoch_{epoch+1}_iter_{i}.png'))
                     plt.close()
-                    generator.train()
         
         # Print epoch summary
         avg_loss_g = running_loss_g / len(train_loader)
@@ -2,6 +2,13 @@
 import time
 import torch
 from ssm.utils.eval_utils.visualise import plot_images
+from ssm.utils.precision import get_precision
+from ssm.utils.checkpoint import CheckpointWriter
+from ssm.utils.distributed import all_reduce_mean, unwrap_model
+from ssm.utils.profiler import NullProfiler, get_profiler
+from ssm.utils.resume import NullTrainingState
+from ssm.models.ssm.frozen_ssm import freeze_speckle_module
+from ssm.data.paired_dataset import split_batch
     
 def normalize_image_torch(t_img: torch.Tensor) -> torch.Tensor:
     """
@@ -76,32 +83,43 @@ def threshold_flow_component(t_img: torch.Tensor, threshold: float = 0.01, botto
     # Apply both masks
     return binary_mask * bottom_mask
 
-def process_batch(data_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha, scheduler):
+def process_batch(data_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha, scheduler,
+                  precision=None, profiler=None):
     mode = 'train' if model.training else 'val'
+    precision = get_precision(precision, device)
+    profiler = profiler or NullProfiler()
+    speckle_module = freeze_speckle_module(speckle_module)
     
     epoch_loss = 0
     
-    for batch_idx, (input_imgs, target_imgs) in enumerate(data_loader):
-        input_imgs = input_imgs.to(device)
-        target_imgs = target_imgs.to(device)
+    for batch_idx, batch in enumerate(profiler.batches(data_loader, epoch, mode)):
+        with profiler.phase('h2d'):
+            input_imgs, target_imgs, indices, flow_maps = split_batch(batch)
+            input_imgs = precision.prepare_input(input_imgs.to(device))
+            target_imgs = target_imgs.to(device)
         
         if speckle_module is not None:
-            flow_inputs = speckle_module(input_imgs)
-            flow_inputs = flow_inputs['flow_component'].detach()
-            flow_inputs = normalize_image_torch(flow_inputs)
-            #flow_inputs = threshold_flow_component(flow_inputs, threshold=0.05)
-            outputs = model(input_imgs)
-            flow_outputs = speckle_module(outputs)
-            flow_outputs = flow_outputs['flow_component'].detach()
-            flow_outputs = normalize_image_torch(flow_outputs)
-            #flow_outputs = threshold_flow_component(flow_outputs, threshold=0.05)
-            flow_loss = torch.mean(torch.abs(flow_outputs - flow_inputs))
-            
-            loss = criterion(outputs, target_imgs) + flow_loss * alpha
+            with precision.autocast(), profiler.phase('forward'):
+                outputs = model(input_imgs)
+                # One frozen forward for inputs and outputs, input flows cached per dataset index
+                flow_inputs, flow_outputs = speckle_module.cached_flows(input_imgs, indices, outputs, input_flows=flow_maps)
+            # Losses in fp32
+            with profiler.phase('loss'):
+                outputs = outputs.float()
+                flow_inputs = normalize_image_torch(flow_inputs.float())
+                #flow_inputs = threshold_flow_component(flow_inputs, threshold=0.05)
+                flow_outputs = normalize_image_torch(flow_outputs.float())
+                #flow_outputs = threshold_flow_component(flow_outputs, threshold=0.05)
+                flow_loss = torch.mean(torch.abs(flow_outputs - flow_inputs))
+                
+                loss = criterion(outputs, target_imgs) + flow_loss * alpha
         else:
             try:
-                outputs = model(input_imgs)
-                loss = criterion(outputs, target_imgs)
+                with precision.autocast(), profiler.phase('forward'):
+                    outputs = model(input_imgs)
+                with profiler.phase('loss'):
+                    outputs = outputs.float()
+                    loss = criterion(outputs, target_imgs)
             except Exception as e:
                 print(f"Error in model output: {e}")
 
@@ -110,11 +128,12 @@ def process_batch(data_loader, model, criterion, optimizer, epoch, epochs, devic
         
         if mode == 'train':
             optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            optimizer.step()
+            with profiler.phase('backward'):
+                precision.backward(loss)
+            with profiler.phase('step'):
+                precision.step(optimizer, model, max_norm=1.0)
         else:
-            scheduler.step(loss)
+            scheduler.step(all_reduce_mean(loss.item()))
         
         epoch_loss += loss.item()
 
@@ -147,57 +166,72 @@ def process_batch(data_loader, model, criterion, optimizer, epoch, epochs, devic
                     'Total Loss': loss.item()
                 }
                 
-            plot_images(images, titles, losses)
+            with profiler.phase('metrics'):
+                plot_images(images, titles, losses)
 
     return epoch_loss / len(data_loader)
 
 def train_n2n(model, train_loader, val_loader, optimizer, criterion, starting_epoch, epochs, 
               batch_size, lr, best_val_loss, checkpoint_path = None,device='cuda', visualise=False, 
-              speckle_module=None, alpha=1, save=False, scheduler=None):
+              speckle_module=None, alpha=1, save=False, scheduler=None, best_metrics_score=None, train_config=None,
+              precision=None, training_state=None):
 
     last_checkpoint_path = checkpoint_path + f'_last_checkpoint.pth'
     best_checkpoint_path = checkpoint_path + f'_best_checkpoint.pth'
 
     print(f"Saving checkpoints to {best_checkpoint_path}")
 
+    precision = get_precision(precision, device)
+    model = precision.prepare_model(model)
+    speckle_module = precision.prepare_model(freeze_speckle_module(speckle_module))
+
+    checkpoint_writer = CheckpointWriter()
+    profiler = get_profiler(train_config, checkpoint_path + '_profile.jsonl', device)
+    training_state = training_state or NullTrainingState()
     start_time = time.time()
     for epoch in range(starting_epoch, starting_epoch+epochs):
         model.train()
         visualise = False
-        train_loss = process_batch(train_loader, model, criterion, optimizer, epoch, starting_epoch+epochs, device, visualise, speckle_module, alpha, scheduler)
+        train_loss = process_batch(training_state.batches(train_loader, epoch), model, criterion, optimizer, epoch, starting_epoch+epochs, device, visualise, speckle_module, alpha, scheduler, precision, profiler)
 
         model.eval()
         visualise = True
         with torch.no_grad():
-            val_loss = process_batch(val_loader, model, criterion, optimizer, epoch, starting_epoch+epochs, device, visualise, speckle_module, alpha, scheduler)
+            val_loss = process_batch(val_loader, model, criterion, optimizer, epoch, starting_epoch+epochs, device, visualise, speckle_module, alpha, scheduler, precision, profiler)
+
+        # Losses averaged over ranks so best-model and scheduler decisions agree
+        train_loss = all_reduce_mean(train_loss)
+        val_loss = all_reduce_mean(val_loss)
 
         print(f"Epoch [{epoch+1}/{starting_epoch+epochs}], Average Loss: {train_loss:.6f}")
         
+        # Checkpoints of one epoch are written once from a shared snapshot
+        checkpoint_paths = []
         if val_loss < best_val_loss and save:
             best_val_loss = val_loss
             print(f"Saving best model with val loss: {val_loss:.6f}")
             print(f"Best checkpoint path: {best_checkpoint_path}")
             print(f"Epoch: {epoch}, Best val loss: {best_val_loss:.6f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss
-            }, best_checkpoint_path)
+            checkpoint_paths.append(best_checkpoint_path)
     
         if save:
             print(f"Saving last model with val loss: {val_loss:.6f}")
-            torch.save({
-                        'epoch': epoch,
-                        'model_state_dict': model.state_dict(),
-                        'optimizer_state_dict': optimizer.state_dict(),
-                        'train_loss': train_loss,
-                        'val_loss': val_loss,
-                        'best_val_loss': best_val_loss
-                }, last_checkpoint_path)
+            checkpoint_paths.append(last_checkpoint_path)
+            with profiler.phase('checkpoint'):
+                checkpoint_writer.save({
+                            'epoch': epoch,
+                            'target_epoch': starting_epoch + epochs,
+                            'model_state_dict': unwrap_model(model).state_dict(),
+                            'optimizer_state_dict': optimizer.state_dict(),
+                            'train_loss': train_loss,
+                            'val_loss': val_loss,
+                            'best_val_loss': best_val_loss
+                    }, *checkpoint_paths)
+        training_state.end_epoch(epoch, best_val_loss=best_val_loss, best_metrics_score=best_metrics_score)
+        profiler.end_epoch(epoch, train_loss=train_loss, val_loss=val_loss)
     
+    checkpoint_writer.close()
+    profiler.close()
     elapsed_time = time.time() - start_time
     print(f"Training completed in {elapsed_time / 60:.2f} minutes")
     
@@ -2,10 +2,24 @@
 import time
 import torch
 from ssm.utils.eval_utils.visualise import plot_images
-from ssm.utils.data_utils.patch_processing import extract_patches, reconstruct_from_patches
+from ssm.utils.data_utils.patch_processing import (
+    extract_patches, gather_patches, reconstruct_from_patches, filter_tissue_patches, print_skip_stats,
+    patch_cache_keys
+)
 import torch.nn.functional as F
 
 from ssm.utils import evaluate_oct_denoising
+from ssm.utils.precision import get_precision
+from ssm.utils.checkpoint import CheckpointWriter
+from ssm.utils.distributed import all_reduce_mean, unwrap_model
+from ssm.utils.profiler import NullProfiler, get_profiler
+from ssm.utils.resume import NullTrainingState
+from ssm.utils.eval_utils.async_metrics import (
+    get_metrics_worker, report_validation, metrics_score, BestMetricsCheckpointer
+)
+from ssm.models.ssm.frozen_ssm import freeze_speckle_module
+from ssm.data.paired_dataset import split_batch
+from ssm.schemas.components.micro_batch import get_micro_batch_runner
     
 def normalize_image_torch(t_img: torch.Tensor) -> torch.Tensor:
     """
@@ -84,66 +98,87 @@ def threshold_flow_component(t_img: torch.Tensor, threshold: float = 0.01, botto
 
 def process_batch(
         data_loader, model, criterion, optimizer, epoch, 
-        epochs, device, visualise, speckle_module, alpha, scheduler, sample, patch_size, stride):
+        epochs, device, visualise, speckle_module, alpha, scheduler, sample, patch_size, stride,
+        tissue_threshold=None, background_keep=0.0, precision=None, train_config=None,
+        metrics_worker=None, metrics_key=None, profiler=None):
     mode = 'train' if model.training else 'val'
+    precision = get_precision(precision, device)
+    profiler = profiler or NullProfiler()
+    speckle_module = freeze_speckle_module(speckle_module)
+    # One optimizer step per loader batch, patch micro-batches sized by memory budget
+    runner = get_micro_batch_runner(
+        model, optimizer if mode == 'train' else None, precision, train_config, device, profiler=profiler)
     
     epoch_loss = 0 
+    skip_stats = {}
 
     metrics = None
     
-    for batch_idx, (input_imgs, target_imgs) in enumerate(data_loader):
-        input_imgs = input_imgs.to(device)
-        target_imgs = target_imgs.to(device)
+    for batch_idx, batch in enumerate(profiler.batches(data_loader, epoch, mode)):
+        with profiler.phase('h2d'):
+            input_imgs, target_imgs, indices, flow_maps = split_batch(batch)
+            input_imgs = input_imgs.to(device)
+            target_imgs = target_imgs.to(device)
         
-        # Extract patches
-        input_patches, patch_locations = extract_patches(input_imgs, patch_size, stride)
-        target_patches, _ = extract_patches(target_imgs, patch_size, stride)
+        with profiler.phase('prep'):
+            # Sliding-window views; patches are only copied one sub-batch at a time
+            input_windows, patch_locations = extract_patches(input_imgs, patch_size, stride, contiguous=False)
+            target_windows, _ = extract_patches(target_imgs, patch_size, stride, contiguous=False)
+            # Precomputed input flows are cropped at the same patch locations
+            flow_windows = None
+            if flow_maps is not None:
+                flow_windows, _ = extract_patches(flow_maps.to(device), patch_size, stride, contiguous=False)
+        
+            # Background-only patches are skipped during training
+            if tissue_threshold is not None and mode == 'train':
+                patch_locations, _ = filter_tissue_patches(
+                    input_imgs, patch_locations, patch_size, tissue_threshold, background_keep, stats=skip_stats)
+            n_patches = len(patch_locations)
         
-        sub_batch_size = 16 
-        total_loss = 0
         all_output_patches = []
         
-        for i in range(0, len(input_patches), sub_batch_size):
-            input_sub_batch = input_patches[i:i+sub_batch_size]
-            target_sub_batch = target_patches[i:i+sub_batch_size]
+        for i, end in runner.micro_batches(n_patches, (input_imgs.shape[1], patch_size, patch_size)):
+            with runner.accumulate():
+                sub_locations = patch_locations[i:end]
+                input_sub_batch = precision.prepare_input(gather_patches(input_windows, sub_locations))
+                target_sub_batch = gather_patches(target_windows, sub_locations)
 
                 
-            if speckle_module is not None:
-                flow_inputs = speckle_module(input_sub_batch)
-                flow_inputs = flow_inputs['flow_component'].detach()
-                flow_inputs = normalize_image_torch(flow_inputs)
-                
-                outputs = model(input_sub_batch)
-                for j in range(outputs.size(0)):
-                    all_output_patches.append(outputs[j].detach().clone())
+                if speckle_module is not None:
+                    patch_keys = patch_cache_keys(indices, sub_locations)
+                    flow_sub_batch = gather_patches(flow_windows, sub_locations) if flow_windows is not None else None
+                    with precision.autocast(), profiler.phase('forward'):
+                        outputs = model(input_sub_batch)
+                        # One frozen forward for input and output patches, input flows cached per patch
+                        flow_inputs, flow_outputs = speckle_module.cached_flows(
+                            input_sub_batch, patch_keys, outputs, input_flows=flow_sub_batch)
+                    # Losses in fp32
+                    with profiler.phase('loss'):
+                        outputs = outputs.float()
+                        all_output_patches.append(outputs.detach())
                 
-                flow_outputs = speckle_module(outputs)
-                flow_outputs = flow_outputs['flow_component'].detach()
-                flow_outputs = normalize_image_torch(flow_outputs)
+                        flow_inputs = normalize_image_torch(flow_inputs.float())
+                        flow_outputs = normalize_image_torch(flow_outputs.float())
                 
-                flow_loss_abs = torch.mean(torch.abs(flow_outputs - flow_inputs))
-                flow_loss_mse = F.mse_loss(flow_outputs, flow_inputs) 
-                patch_loss = criterion(outputs, target_sub_batch) + flow_loss_abs * alpha + flow_loss_mse * alpha
-            else:
-                outputs = model(input_sub_batch)
-                for j in range(outputs.size(0)):
-                    all_output_patches.append(outputs[j].detach().clone())
-                patch_loss = criterion(outputs, target_sub_batch)
+                        flow_loss_abs = torch.mean(torch.abs(flow_outputs - flow_inputs))
+                        flow_loss_mse = F.mse_loss(flow_outputs, flow_inputs) 
+                        patch_loss = criterion(outputs, target_sub_batch) + flow_loss_abs * alpha + flow_loss_mse * alpha
+                else:
+                    with precision.autocast(), profiler.phase('forward'):
+                        outputs = model(input_sub_batch)
+                    with profiler.phase('loss'):
+                        outputs = outputs.float()
+                        all_output_patches.append(outputs.detach())
+                        patch_loss = criterion(outputs, target_sub_batch)
             
-            total_loss += patch_loss.item() * len(input_sub_batch)
-            
-            if mode == 'train':
-                optimizer.zero_grad()
-                patch_loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-                optimizer.step()
+                runner.backward(patch_loss, len(input_sub_batch))
         
         # Reconstruct full images from patches for visualization
         if visualise and batch_idx % 10 == 0:
             sample_input = sample
             print(f"Sample input shape: {sample_input.shape}")
             sample_output = model(sample_input).cpu().numpy()
-            output_patches = torch.stack(all_output_patches)
+            output_patches = torch.cat(all_output_patches, dim=0)[:n_patches]
             reconstructed_outputs = reconstruct_from_patches(
                 output_patches, patch_locations, input_imgs.shape, patch_size
             )
@@ -164,7 +199,7 @@ def process_batch(
                 ]
                 losses = {
                     'Flow Loss': flow_loss_abs.item(),
-                    'Total Loss': total_loss / len(input_patches)
+                    'Total Loss': runner.batch_loss
                 }
             else:
                 titles = ['Input Image', 'Target Image', 'Output Image', 'Sample Input', 'Sample Output']
@@ -176,20 +211,25 @@ def process_batch(
                     sample_output[0][0]
                 ]
                 losses = {
-                    'Total Loss': total_loss / len(input_patches)
+                    'Total Loss': runner.batch_loss
                 }
                 
-            plot_images(images, titles, losses)
-
-            metrics = evaluate_oct_denoising(
-                input_imgs[0][0].cpu().numpy(), 
-                reconstructed_outputs[0][0].cpu().numpy())
+            # Queued metrics are only computed for the first visualised batch
+            with profiler.phase('metrics'):
+                metrics = report_validation(
+                    images, titles, losses,
+                    input_imgs[0][0].cpu().numpy(), 
+                    reconstructed_outputs[0][0].cpu().numpy(),
+                    metrics_worker, metrics_key, name=f"n2n_patch_{metrics_key}_batch{batch_idx}",
+                    submit_metrics=metrics is None)
             
-        loss_value = total_loss / len(input_patches)
+        loss_value = runner.batch_loss
         epoch_loss += loss_value
         
     if mode != 'train':
-        scheduler.step(loss_value)
+        scheduler.step(all_reduce_mean(loss_value))
+    else:
+        print_skip_stats(skip_stats)
 
     #return epoch_loss / len(data_loader)
     if metrics is not None:
@@ -200,7 +240,8 @@ def process_batch(
 def train_n2n_patch(model, train_loader, val_loader, optimizer, criterion, starting_epoch, epochs, 
               batch_size, lr, best_val_loss, checkpoint_path = None,device='cuda', visualise=False, 
               speckle_module=None, alpha=1, save=False, scheduler=None, best_metrics_score=None, train_config=None,
-              sample=None, patch_size=128, stride=48):
+              sample=None, patch_size=128, stride=48, tissue_threshold=None, background_keep=0.0,
+              precision=None, training_state=None):
 
     last_checkpoint_path = checkpoint_path + f'_patched_last_checkpoint.pth'
     best_checkpoint_path = checkpoint_path + f'_patched_best_checkpoint.pth'
@@ -208,70 +249,71 @@ def train_n2n_patch(model, train_loader, val_loader, optimizer, criterion, start
 
     print(f"Saving checkpoints to {best_checkpoint_path}")
 
+    precision = get_precision(precision, device)
+    model = precision.prepare_model(model)
+    speckle_module = precision.prepare_model(freeze_speckle_module(speckle_module))
+
+    checkpoint_writer = CheckpointWriter()
+    # Validation figures and metrics off the training thread, every metrics_every epochs
+    metrics_worker = get_metrics_worker(train_config, checkpoint_path + '_patched_validation')
+    metrics_every = train_config.get('metrics_every', 1) if train_config else 1
+    best_metrics = None
+    if metrics_worker is not None:
+        best_metrics = BestMetricsCheckpointer(
+            metrics_worker, checkpoint_writer, best_metrics_checkpoint_path, best_metrics_score, save)
+    profiler = get_profiler(train_config, checkpoint_path + '_patched_profile.jsonl', device)
+    training_state = training_state or NullTrainingState()
     start_time = time.time()
     for epoch in range(starting_epoch, starting_epoch+epochs):
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)
         model.train()
         visualise = False
         train_loss = process_batch(
-            train_loader, model, criterion, optimizer, epoch, 
+            training_state.batches(train_loader, epoch), model, criterion, optimizer, epoch, 
             starting_epoch+epochs, device, visualise, speckle_module, alpha, 
-            scheduler, sample, patch_size, stride)
+            scheduler, sample, patch_size, stride, tissue_threshold, background_keep, precision, train_config,
+            profiler=profiler)
 
         model.eval()
-        visualise = True
+        visualise = (epoch - starting_epoch) % metrics_every == 0
         with torch.no_grad():
-            val_loss, val_metrics = process_batch(
+            val_result = process_batch(
                 val_loader, model, criterion, optimizer, epoch, starting_epoch+epochs, 
                 device, visualise, speckle_module, alpha, scheduler, sample,
-                patch_size, stride)
+                patch_size, stride, precision=precision, train_config=train_config,
+                metrics_worker=metrics_worker, metrics_key=epoch, profiler=profiler)
+            val_loss, val_metrics = val_result if isinstance(val_result, tuple) else (val_result, {})
             
-            val_metrics_score = (
-                val_metrics.get('snr', 0) * 0.3 + 
-                val_metrics.get('cnr', 0) * 0.3 + 
-                val_metrics.get('enl', 0) * 0.2 + 
-                val_metrics.get('epi', 0) * 0.2
-            )
+            val_metrics_score = metrics_score(val_metrics)
+
+        # Losses averaged over ranks so best-model and scheduler decisions agree
+        train_loss = all_reduce_mean(train_loss)
+        val_loss = all_reduce_mean(val_loss)
 
         print(f"Epoch [{epoch+1}/{starting_epoch+epochs}], Average Loss: {train_loss:.6f}")
         
+        # Checkpoints of one epoch are written once from a shared snapshot
+        checkpoint_paths = []
         if val_loss < best_val_loss and save:
             best_val_loss = val_loss
             print(f"Saving best model with val loss: {val_loss:.6f}")
             print(f"Best checkpoint path: {best_checkpoint_path}")
             print(f"Epoch: {epoch}, Best val loss: {best_val_loss:.6f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss,
-                'train_config': train_config,
-                'metrics': val_metrics,
-                'metrics_score': val_metrics_score,
-                'train_config': train_config
-            }, best_checkpoint_path)
+            checkpoint_paths.append(best_checkpoint_path)
 
-        if val_metrics_score > best_metrics_score  and save:
+        if metrics_worker is None and val_metrics and val_metrics_score > best_metrics_score  and save:
             best_metrics_score = val_metrics_score
             print(f"Saving best metrics model with score: {val_metrics_score:.4f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss,
-                'metrics': val_metrics,
-                'metrics_score': val_metrics_score,
-                'train_config': train_config
-            }, best_metrics_checkpoint_path)
+            checkpoint_paths.append(best_metrics_checkpoint_path)
     
         if save:
             print(f"Saving last model with val loss: {val_loss:.6f}")
-            torch.save({
+            checkpoint_paths.append(last_checkpoint_path)
+            checkpoint = {
                         'epoch': epoch,
-                        'model_state_dict': model.state_dict(),
+                        'target_epoch': starting_epoch + epochs,
+                        'model_state_dict': unwrap_model(model).state_dict(),
                         'optimizer_state_dict': optimizer.state_dict(),
                         'train_loss': train_loss,
                         'val_loss': val_loss,
@@ -280,8 +322,24 @@ def train_n2n_patch(model, train_loader, val_loader, optimizer, criterion, start
                         'metrics': val_metrics,
                         'metrics_score': val_metrics_score,
                         'train_config': train_config
-                }, last_checkpoint_path)
+                }
+            with profiler.phase('checkpoint'):
+                checkpoint_writer.save(checkpoint, *checkpoint_paths)
+                if best_metrics is not None and visualise:
+                    best_metrics.add(epoch, checkpoint)
+
+        if best_metrics is not None:
+            with profiler.phase('metrics'):
+                best_metrics.update()
+        training_state.end_epoch(
+            epoch, best_val_loss=best_val_loss,
+            best_metrics_score=best_metrics.best_score if best_metrics is not None else best_metrics_score)
+        profiler.end_epoch(epoch, train_loss=train_loss, val_loss=val_loss)
     
+    if best_metrics is not None:
+        best_metrics.close()
+    checkpoint_writer.close()
+    profiler.close()
     elapsed_time = time.time() - start_time
     print(f"Training completed in {elapsed_time / 60:.2f} minutes")
     
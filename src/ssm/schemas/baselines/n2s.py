@@ -2,6 +2,17 @@ import torch.optim as optim
 import time
 import torch
 from ssm.utils.eval_utils.visualise import plot_images
+from ssm.utils.precision import get_precision
+from ssm.utils.checkpoint import CheckpointWriter
+from ssm.utils.distributed import all_reduce_mean, unwrap_model
+from ssm.utils.profiler import NullProfiler, get_profiler
+from ssm.utils.resume import NullTrainingState
+from ssm.utils.eval_utils.async_metrics import (
+    get_metrics_worker, report_validation, metrics_score, BestMetricsCheckpointer
+)
+from ssm.models.ssm.frozen_ssm import freeze_speckle_module
+from ssm.data.paired_dataset import split_batch
+from ssm.schemas.components.micro_batch import get_micro_batch_runner
 from tqdm import tqdm
 from tqdm.notebook import tqdm as tqdm_notebook
 
@@ -390,13 +401,19 @@ def process_batch_n2s_with_clean_inference(data_loader, model, criterion, optimi
 
 def train_n2s(model, train_loader, val_loader, optimizer, criterion, starting_epoch, epochs, batch_size, lr, 
           best_val_loss, checkpoint_path=None, device='cuda', visualise=False, 
-          speckle_module=None, alpha=1, save=False):
+          speckle_module=None, alpha=1, save=False, precision=None, training_state=None):
 
     last_checkpoint_path = checkpoint_path + f'_last_checkpoint.pth'
     best_checkpoint_path = checkpoint_path + f'_best_checkpoint.pth'
 
     print(f"Saving checkpoints to {best_checkpoint_path}")
 
+    precision = get_precision(precision, device)
+    model = precision.prepare_model(model)
+    speckle_module = precision.prepare_model(freeze_speckle_module(speckle_module))
+
+    checkpoint_writer = CheckpointWriter()
+    training_state = training_state or NullTrainingState()
     start_time = time.time()
 
     for epoch in tqdm_notebook(range(starting_epoch, starting_epoch+epochs)):
@@ -404,8 +421,8 @@ def train_n2s(model, train_loader, val_loader, optimizer, criterion, starting_ep
         #train_loss = process_batch_n2s(train_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha)
         #train_loss = process_batch_n2s_with_clean_inference(train_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha)
         train_loss, _ = process_batch_n2s_patch(
-            model, train_loader, criterion, optimizer, device=device,
-            speckle_module=speckle_module, visualize=visualise, alpha=alpha
+            model, training_state.batches(train_loader, epoch), criterion, optimizer, device=device,
+            speckle_module=speckle_module, visualize=visualise, alpha=alpha, precision=precision
         )
         
         model.eval()
@@ -414,34 +431,37 @@ def train_n2s(model, train_loader, val_loader, optimizer, criterion, starting_ep
             #val_loss = process_batch_n2s_with_clean_inference(train_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha)
             val_loss, _ = process_batch_n2s_patch(
                 model, val_loader, criterion, optimizer, device=device,
-                speckle_module=speckle_module, visualize=visualise, alpha=alpha
+                speckle_module=speckle_module, visualize=visualise, alpha=alpha, precision=precision
             )
 
+        # Losses averaged over ranks so best-model and scheduler decisions agree
+        train_loss = all_reduce_mean(train_loss)
+        val_loss = all_reduce_mean(val_loss)
+
         print(f"Epoch [{starting_epoch+epoch+1}/{epochs}], Average Loss: {train_loss:.6f}")
         
+        # Checkpoints of one epoch are written once from a shared snapshot
+        checkpoint_paths = []
         if val_loss < best_val_loss and save:
             best_val_loss = val_loss
             print(f"Saving best model with val loss: {val_loss:.6f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss
-            }, best_checkpoint_path)
+            checkpoint_paths.append(best_checkpoint_path)
         
         if save:
             print(f"Saving last model with val loss: {val_loss:.6f}")
-            torch.save({
+            checkpoint_paths.append(last_checkpoint_path)
+            checkpoint_writer.save({
                         'epoch': epoch,
-                        'model_state_dict': model.state_dict(),
+                        'target_epoch': starting_epoch + epochs,
+                        'model_state_dict': unwrap_model(model).state_dict(),
                         'optimizer_state_dict': optimizer.state_dict(),
                         'train_loss': train_loss,
                         'val_loss': val_loss,
                         'best_val_loss': best_val_loss
-                }, last_checkpoint_path)
+                }, *checkpoint_paths)
+        training_state.end_epoch(epoch, best_val_loss=best_val_loss)
     
+    checkpoint_writer.close()
     elapsed_time = time.time() - start_time
     print(f"Training completed in {elapsed_time / 60:.2f} minutes")
     
@@ -450,7 +470,8 @@ def train_n2s(model, train_loader, val_loader, optimizer, criterion, starting_ep
 def train_n2s_patch(model, train_loader, val_loader, optimizer, criterion, starting_epoch, epochs, batch_size, lr, 
           best_val_loss, checkpoint_path=None, device='cuda', visualise=False, 
           speckle_module=None, alpha=1, save=False, scheduler=None, sample=None, train_config=None, best_metrics_score=float('-inf'),
-          patch_size=64, stride=32, n_partitions=2):
+          patch_size=64, stride=32, n_partitions=2, tissue_threshold=None, background_keep=0.0, precision=None,
+          training_state=None):
 
     last_checkpoint_path = checkpoint_path + f'_patched_last_checkpoint.pth'
     best_checkpoint_path = checkpoint_path + f'_patched_best_checkpoint.pth'
@@ -458,73 +479,78 @@ def train_n2s_patch(model, train_loader, val_loader, optimizer, criterion, start
 
     print(f"Saving checkpoints to {best_checkpoint_path}")
 
+    precision = get_precision(precision, device)
+    model = precision.prepare_model(model)
+    speckle_module = precision.prepare_model(freeze_speckle_module(speckle_module))
+
+    checkpoint_writer = CheckpointWriter()
+    # Validation figures and metrics off the training thread, every metrics_every epochs
+    metrics_worker = get_metrics_worker(train_config, checkpoint_path + '_patched_validation')
+    metrics_every = train_config.get('metrics_every', 1) if train_config else 1
+    best_metrics = None
+    if metrics_worker is not None:
+        best_metrics = BestMetricsCheckpointer(
+            metrics_worker, checkpoint_writer, best_metrics_checkpoint_path, best_metrics_score, save)
+    profiler = get_profiler(train_config, checkpoint_path + '_patched_profile.jsonl', device)
+    training_state = training_state or NullTrainingState()
     start_time = time.time()
 
     for epoch in tqdm_notebook(range(starting_epoch, starting_epoch+epochs)):
         print(f"Epoch {epoch+1}/{epochs}")
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)
         model.train()
         #train_loss = process_batch_n2s(train_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha)
         #train_loss = process_batch_n2s_with_clean_inference(train_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha)
         train_loss, _ = process_batch_n2s_patch(
-            model, train_loader, criterion, optimizer, device=device,
+            model, training_state.batches(train_loader, epoch), criterion, optimizer, device=device,
             speckle_module=speckle_module, visualize=False, alpha=alpha, scheduler=None, sample=sample,
-            patch_size=patch_size, stride=stride, n_partitions=n_partitions
+            patch_size=patch_size, stride=stride, n_partitions=n_partitions,
+            tissue_threshold=tissue_threshold, background_keep=background_keep, precision=precision,
+            train_config=train_config, profiler=profiler, epoch=epoch
         )
         
         model.eval()
+        visualise_epoch = visualise and (epoch - starting_epoch) % metrics_every == 0
         with torch.no_grad():
             #val_loss = process_batch_n2s(val_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha)
             #val_loss = process_batch_n2s_with_clean_inference(train_loader, model, criterion, optimizer, epoch, epochs, device, visualise, speckle_module, alpha)
             val_loss, val_metrics = process_batch_n2s_patch(
                 model, val_loader, criterion, optimizer=None, device=device,
-                speckle_module=speckle_module, visualize=visualise, alpha=alpha, scheduler=scheduler, sample=sample,
-                patch_size=patch_size, stride=stride, n_partitions=n_partitions
+                speckle_module=speckle_module, visualize=visualise_epoch, alpha=alpha, scheduler=scheduler, sample=sample,
+                patch_size=patch_size, stride=stride, n_partitions=n_partitions, precision=precision,
+                train_config=train_config, metrics_worker=metrics_worker, metrics_key=epoch,
+                profiler=profiler, epoch=epoch
             )
+            val_metrics = val_metrics or {}
 
-            val_metrics_score = (
-                val_metrics.get('snr', 0) * 0.3 + 
-                val_metrics.get('cnr', 0) * 0.3 + 
-                val_metrics.get('enl', 0) * 0.2 + 
-                val_metrics.get('epi', 0) * 0.2
-            )
+            val_metrics_score = metrics_score(val_metrics)
+
+        # Losses averaged over ranks so best-model and scheduler decisions agree
+        train_loss = all_reduce_mean(train_loss)
+        val_loss = all_reduce_mean(val_loss)
 
         print(f"Epoch [{starting_epoch+epoch+1}/{epochs}], Average Loss: {train_loss:.6f}")
         
+        # Checkpoints of one epoch are written once from a shared snapshot
+        checkpoint_paths = []
         if val_loss < best_val_loss and save:
             best_val_loss = val_loss
             print(f"Saving best model with val loss: {val_loss:.6f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss,
-                'metrics': val_metrics,
-                'metrics_score': val_metrics_score,
-                'train_config': train_config
-            }, best_checkpoint_path)
-
-        if val_metrics_score > best_metrics_score  and save:
+            checkpoint_paths.append(best_checkpoint_path)
+
+        if metrics_worker is None and val_metrics and val_metrics_score > best_metrics_score  and save:
             best_metrics_score = val_metrics_score
             print(f"Saving best metrics model with score: {val_metrics_score:.4f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss,
-                'metrics': val_metrics,
-                'metrics_score': val_metrics_score,
-                'train_config': train_config
-            }, best_metrics_checkpoint_path)
+            checkpoint_paths.append(best_metrics_checkpoint_path)
         
         if save:
             print(f"Saving last model with val loss: {val_loss:.6f}")
-            torch.save({
+            checkpoint_paths.append(last_checkpoint_path)
+            checkpoint = {
                         'epoch': epoch,
-                        'model_state_dict': model.state_dict(),
+                        'target_epoch': starting_epoch + epochs,
+                        'model_state_dict': unwrap_model(model).state_dict(),
                         'optimizer_state_dict': optimizer.state_dict(),
                         'train_loss': train_loss,
                         'val_loss': val_loss,
@@ -532,8 +558,24 @@ def train_n2s_patch(model, train_loader, val_loader, optimizer, criterion, start
                         'metrics': val_metrics,
                         'metrics_score': val_metrics_score,
                         'train_config': train_config
-                }, last_checkpoint_path)
+                }
+            with profiler.phase('checkpoint'):
+                checkpoint_writer.save(checkpoint, *checkpoint_paths)
+                if best_metrics is not None and visualise_epoch:
+                    best_metrics.add(epoch, checkpoint)
+
+        if best_metrics is not None:
+            with profiler.phase('metrics'):
+                best_metrics.update()
+        training_state.end_epoch(
+            epoch, best_val_loss=best_val_loss,
+            best_metrics_score=best_metrics.best_score if best_metrics is not None else best_metrics_score)
+        profiler.end_epoch(epoch, train_loss=train_loss, val_loss=val_loss)
     
+    if best_metrics is not None:
+        best_metrics.close()
+    checkpoint_writer.close()
+    profiler.close()
     elapsed_time = time.time() - start_time
     print(f"Training completed in {elapsed_time / 60:.2f} minutes")
     
@@ -543,7 +585,7 @@ def train_n2s_patch(model, train_loader, val_loader, optimizer, criterion, start
 from contextlib import nullcontext
 from ssm.utils import evaluate_oct_denoising
 import torch.nn.functional as F
-from ssm.utils.data_utils.patch_processing import extract_patches, reconstruct_from_patches
+from ssm.utils.data_utils.patch_processing import extract_patches, reconstruct_from_patches, filter_tissue_patches, print_skip_stats, patch_cache_keys
 
 def _process_batch_n2s_patch(
         model, loader, criterion, optimizer=None,
@@ -1337,7 +1379,9 @@ def process_batch_n2s_patch(
       model, loader, criterion, optimizer=None,
       device='cuda', speckle_module=None, visualize=False,
       alpha=1.0, scheduler=None, sample=None,
-      patch_size=64, stride=32, n_partitions=2
+      patch_size=64, stride=32, n_partitions=2,
+      tissue_threshold=None, background_keep=0.0, precision=None, train_config=None,
+      metrics_worker=None, metrics_key=None, profiler=None, epoch=None
       ):
     
     if optimizer: 
@@ -1345,8 +1389,15 @@ def process_batch_n2s_patch(
     else:
         model.eval()
     
+    precision = get_precision(precision, device)
+    profiler = profiler or NullProfiler()
+    speckle_module = freeze_speckle_module(speckle_module)
+    # Loss-weighted accumulation with one optimizer step per loader batch
+    runner = get_micro_batch_runner(model, optimizer, precision, train_config, device, profiler=profiler)
+    
     total_loss = 0.0
     metrics = None
+    skip_stats = {}
     
     # Pre-compute checkerboard masks once
     y_coords, x_coords = torch.meshgrid(
@@ -1360,86 +1411,92 @@ def process_batch_n2s_patch(
     context_manager = torch.no_grad() if not optimizer else nullcontext()
     
     with context_manager:
-        for batch_idx, batch in enumerate(tqdm(loader)):
+        mode = 'train' if optimizer else 'val'
+        for batch_idx, batch in enumerate(tqdm(profiler.batches(loader, epoch, mode))):
             print(f"Processing batch {batch_idx + 1}/{len(loader)}")
-            raw1, _ = batch
-            raw1 = raw1.to(device)
-
-            # Extract patches
-            raw1_patches, patch_locations = extract_patches(raw1, patch_size, stride)
-            n_patches = raw1_patches.shape[0]
-            
-            # Process patches in sub-batches
-            sub_batch_size = 32
-            batch_loss = 0.0
+            with profiler.phase('h2d'):
+                raw1, _, indices, flow_maps = split_batch(batch)
+                raw1 = raw1.to(device)
+
+            with profiler.phase('prep'):
+                # Extract patches
+                raw1_patches, patch_locations = extract_patches(raw1, patch_size, stride)
+                # Precomputed input flows are cropped at the same patch locations
+                flow_patches = None
+                if flow_maps is not None:
+                    flow_patches, _ = extract_patches(flow_maps.to(device), patch_size, stride)
+            
+                # Background-only patches are skipped during training
+                if tissue_threshold is not None and optimizer is not None:
+                    patch_locations, keep = filter_tissue_patches(
+                        raw1, patch_locations, patch_size, tissue_threshold, background_keep, stats=skip_stats)
+                    raw1_patches = raw1_patches[keep]
+                    if flow_patches is not None:
+                        flow_patches = flow_patches[keep]
+                n_patches = raw1_patches.shape[0]
+            
+            # Process patches in micro-batches sized by memory budget
             all_output_patches = [] if visualize else None
             
-            # Clear gradients once per batch
-            if optimizer is not None:
-                optimizer.zero_grad()
-            
-            for i in range(0, n_patches, sub_batch_size):
-                current_batch_size = min(sub_batch_size, n_patches - i)
-                patch_sub_batch = raw1_patches[i:i+current_batch_size]
+            for i, end in runner.micro_batches(n_patches, raw1_patches.shape[1:]):
+                with runner.accumulate():
+                    current_batch_size = end - i
+                    patch_sub_batch = precision.prepare_input(raw1_patches[i:i+current_batch_size])
                 
-                # Get masks for current sub-batch
-                mask1_batch = mask1.expand(current_batch_size, -1, -1, -1)
-                mask2_batch = mask2.expand(current_batch_size, -1, -1, -1)
+                    # Get masks for current sub-batch
+                    mask1_batch = mask1.expand(current_batch_size, -1, -1, -1)
+                    mask2_batch = mask2.expand(current_batch_size, -1, -1, -1)
                 
-                # Process partition 1
-                masked_input1 = patch_sub_batch * (1 - mask1_batch)
-                output1 = model(masked_input1)
-                pred1 = output1 * mask1_batch
+                    with precision.autocast(), profiler.phase('forward'):
+                        # Process partition 1
+                        masked_input1 = patch_sub_batch * (1 - mask1_batch)
+                        output1 = model(masked_input1)
+                    
+                        # Process partition 2
+                        masked_input2 = patch_sub_batch * (1 - mask2_batch)
+                        output2 = model(masked_input2)
                 
-                # Process partition 2
-                masked_input2 = patch_sub_batch * (1 - mask2_batch)
-                output2 = model(masked_input2)
-                pred2 = output2 * mask2_batch
+                    with profiler.phase('loss'):
+                        # Losses in fp32
+                        pred1 = output1.float() * mask1_batch
+                        pred2 = output2.float() * mask2_batch
                 
-                # Combine predictions
-                final_output = pred1 + pred2
-                if visualize:
-                    all_output_patches.append(final_output.detach())
+                        # Combine predictions
+                        final_output = pred1 + pred2
+                        if visualize:
+                            all_output_patches.append(final_output.detach())
                 
-                # Compute N2S loss
-                target1 = patch_sub_batch * mask1_batch
-                target2 = patch_sub_batch * mask2_batch
-                n2s_loss = criterion(pred1, target1) + criterion(pred2, target2)
+                        # Compute N2S loss
+                        target1 = patch_sub_batch * mask1_batch
+                        target2 = patch_sub_batch * mask2_batch
+                        n2s_loss = criterion(pred1, target1) + criterion(pred2, target2)
                 
-                sub_loss = n2s_loss
+                        sub_loss = n2s_loss
                 
-                # Speckle module loss (if enabled)
-                if speckle_module is not None:
-                    with torch.no_grad():
-                        flow_inputs = speckle_module(patch_sub_batch)['flow_component']
-                        flow_inputs = normalize_image_torch(flow_inputs)
-                        
-                        flow_outputs = speckle_module(final_output)['flow_component']
-                        flow_outputs = normalize_image_torch(flow_outputs)
+                    # Speckle module loss (if enabled)
+                    if speckle_module is not None:
+                        patch_keys = patch_cache_keys(indices, patch_locations[i:i+current_batch_size])
+                        flow_sub_batch = flow_patches[i:i+current_batch_size] if flow_patches is not None else None
+                        with precision.autocast(), profiler.phase('forward'):
+                            # One frozen forward for input and output patches, input flows cached per patch
+                            flow_inputs, flow_outputs = speckle_module.cached_flows(
+                                patch_sub_batch, patch_keys, final_output, input_flows=flow_sub_batch)
+                        with profiler.phase('loss'):
+                            flow_inputs = normalize_image_torch(flow_inputs.float())
+                            flow_outputs = normalize_image_torch(flow_outputs.float())
                     
-                    flow_loss = torch.mean(torch.abs(flow_outputs - flow_inputs))
-                    sub_loss = n2s_loss + flow_loss * alpha
-                
-                # Weight by sub-batch proportion
-                #weighted_loss = sub_loss * (current_batch_size / n_patches)
-                #batch_loss += weighted_loss.item()
-                batch_loss += sub_loss.item()
+                            flow_loss = torch.mean(torch.abs(flow_outputs - flow_inputs))
+                            sub_loss = n2s_loss + flow_loss * alpha
                 
-                # Backpropagation (accumulate gradients)
-                if optimizer is not None:
-                    sub_loss.backward()
+                    # Backpropagation, weighted by sub-batch proportion
+                    runner.backward(sub_loss, current_batch_size)
             
-            # Single optimizer step per batch
-            if optimizer is not None:
-                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-                optimizer.step()
-            
-            total_loss += batch_loss
+            total_loss += runner.batch_loss
             
             # Visualization (first batch only)
             if visualize and batch_idx == 0:
                 # Reconstructed outputs only computed when needed
-                output_patches = torch.cat(all_output_patches, dim=0)
+                output_patches = torch.cat(all_output_patches, dim=0)[:n_patches]
                 reconstructed_outputs1 = reconstruct_from_patches(
                     output_patches, patch_locations, raw1.shape, patch_size
                 )
@@ -1476,7 +1533,7 @@ def process_batch_n2s_patch(
                     
                     losses = {
                         'Flow Loss': flow_loss.item() if speckle_module else 0,
-                        'Total Loss': batch_loss / n_patches
+                        'Total Loss': runner.batch_loss
                     }
                 else:
                     titles = ['Input Image', 'N2S Output']
@@ -1492,14 +1549,16 @@ def process_batch_n2s_patch(
                             sample_output[0][0].cpu().numpy()
                         ])
                     
-                    losses = {'Total Loss': batch_loss / n_patches}
+                    losses = {'Total Loss': runner.batch_loss}
                     
-                plot_images(images, titles, losses)
+                with profiler.phase('metrics'):
+                    metrics = report_validation(
+                        images, titles, losses,
+                        raw1[0][0].cpu().numpy(), 
+                        reconstructed_outputs1[0][0].cpu().numpy(),
+                        metrics_worker, metrics_key, name=f"n2s_patch_{metrics_key}"
+                    )
 
-                from ssm.utils import evaluate_oct_denoising
-                metrics = evaluate_oct_denoising(
-                    raw1[0][0].cpu().numpy(), 
-                    reconstructed_outputs1[0][0].cpu().numpy()
-                )
+    print_skip_stats(skip_stats)
 
     return total_loss / len(loader), metrics
\ No newline at end of file
@@ -19,6 +19,13 @@ from contextlib import nullcontext
 import torch
 from tqdm import tqdm
 from ssm.utils.eval_utils.visualise import plot_images
+from ssm.utils.precision import get_precision
+from ssm.utils.checkpoint import CheckpointWriter
+from ssm.utils.distributed import all_reduce_mean, unwrap_model
+from ssm.utils.profiler import NullProfiler, get_profiler
+from ssm.utils.resume import NullTrainingState
+from ssm.models.ssm.frozen_ssm import freeze_speckle_module
+from ssm.data.paired_dataset import split_batch
 
 def create_blind_spot_input_fast(image, mask): # This creates an artificial situation: your network learns to reconstruct pixels from surrounding context, but the masking pattern (black dots) doesn't match the actual noise distribution in OCT images.
     blind_input = image.clone()
@@ -974,7 +981,10 @@ def process_batch_n2v(
         device='cuda',
         speckle_module=None,
         visualize=False,
-        alpha = 1.0
+        alpha = 1.0,
+        precision=None,
+        profiler=None,
+        epoch=None
         ):
     
     if optimizer: 
@@ -982,68 +992,84 @@ def process_batch_n2v(
     else:
         model.eval()
     
+    precision = get_precision(precision, device)
+    profiler = profiler or NullProfiler()
+    speckle_module = freeze_speckle_module(speckle_module)
     total_loss = 0.0
     
     context_manager = torch.no_grad() if not optimizer else nullcontext()
     
     with context_manager:
-        for batch_idx, batch in enumerate(tqdm(loader)):
-            raw1, raw2 = batch
-
-            raw1 = raw1.to(device)
-            raw2 = raw2.to(device)
-
-            mask = torch.bernoulli(torch.full((raw1.size(0), 1, raw1.size(2), raw1.size(3)), 
-                                            mask_ratio, device=device))
-
-            blind1 = create_blind_spot_input_with_realistic_noise(raw1, mask).requires_grad_(True)
-            blind2 = create_blind_spot_input_with_realistic_noise(raw2, mask).requires_grad_(True)
+        mode = 'train' if optimizer else 'val'
+        for batch_idx, batch in enumerate(tqdm(profiler.batches(loader, epoch, mode))):
+            with profiler.phase('h2d'):
+                raw1, raw2, indices, flow_maps = split_batch(batch)
+
+                raw1 = precision.prepare_input(raw1.to(device))
+                raw2 = precision.prepare_input(raw2.to(device))
+
+            with profiler.phase('prep'):
+                mask = torch.bernoulli(torch.full((raw1.size(0), 1, raw1.size(2), raw1.size(3)), 
+                                                mask_ratio, device=device))
+
+                # Noise statistics stay per stream, the model sees both streams in one batch
+                blind1 = create_blind_spot_input_with_realistic_noise(raw1, mask)
+                blind2 = create_blind_spot_input_with_realistic_noise(raw2, mask)
+                raw = torch.cat([raw1, raw2], dim=0)
+                blind = torch.cat([blind1, blind2], dim=0).requires_grad_(True)
+                masked = torch.cat([mask, mask], dim=0).expand_as(raw) > 0
             
             if optimizer:
                 optimizer.zero_grad()
 
-            if speckle_module is not None:
-                flow_inputs = speckle_module(raw1)
-                flow_inputs = flow_inputs['flow_component'].detach()
-                flow_inputs = normalize_image_torch(flow_inputs)
-                outputs1 = model(blind1)
-                
-                #outputs1 = model(blind1)
-                #outputs2 = model(blind2)
-                flow_outputs = speckle_module(outputs1)
-                flow_outputs = flow_outputs['flow_component'].detach()
-                flow_outputs = normalize_image_torch(flow_outputs)
-                flow_loss1 = torch.mean(torch.abs(flow_outputs - flow_inputs))
-
-                flow_inputs = speckle_module(raw2)
-                flow_inputs = flow_inputs['flow_component'].detach()
-                flow_inputs = normalize_image_torch(flow_inputs)
-                outputs2 = model(blind2)
-                flow_outputs = speckle_module(outputs2)
-                flow_outputs = flow_outputs['flow_component'].detach()
-                flow_outputs = normalize_image_torch(flow_outputs)
-                flow_loss2 = torch.mean(torch.abs(flow_outputs - flow_inputs))
-                
-                n2v_loss1 = criterion(outputs1[mask > 0], raw1[mask > 0])
-                n2v_loss2 = criterion(outputs2[mask > 0], raw2[mask > 0])
+            with precision.autocast(), profiler.phase('forward'):
+                outputs = model(blind)
 
-                loss = n2v_loss1 + n2v_loss2 + flow_loss1 * alpha + flow_loss2 * alpha
+                if speckle_module is not None:
+                    # Both raw images share one cache, keyed by (dataset index, image)
+                    raw_keys = None
+                    if indices is not None:
+                        raw_keys = [(i, 0) for i in indices.tolist()] + [(i, 1) for i in indices.tolist()]
+
+                    if flow_maps is not None:
+                        # raw1 flows come from the flow-map store, only raw2 is run through the module
+                        raw2_keys = raw_keys[len(raw_keys) // 2:] if raw_keys is not None else None
+                        flow_inputs2, flow_outputs = speckle_module.cached_flows(raw2, raw2_keys, outputs)
+                        flow_raw = torch.cat([flow_maps.to(device), flow_inputs2.to(flow_maps.dtype)], dim=0)
+                    else:
+                        # Single frozen forward for both raw images and both outputs
+                        flow_raw, flow_outputs = speckle_module.cached_flows(raw, raw_keys, outputs)
+            with profiler.phase('loss'):
+                outputs = outputs.float()
+                outputs1, outputs2 = outputs.chunk(2, dim=0)
+
+                # One boolean gather over both streams; the shared mask splits it evenly
+                masked_outputs1, masked_outputs2 = outputs[masked].chunk(2)
+                masked_raw1, masked_raw2 = raw[masked].chunk(2)
+                n2v_loss1 = criterion(masked_outputs1, masked_raw1)
+                n2v_loss2 = criterion(masked_outputs2, masked_raw2)
 
-            else:
-                #outputs = model(input_imgs)
-                #loss = criterion(outputs, target_imgs)
+                if speckle_module is not None:
+                    flow_inputs1, flow_inputs2 = flow_raw.float().chunk(2, dim=0)
+                    flow_outputs1, flow_outputs2 = flow_outputs.float().chunk(2, dim=0)
 
-                outputs1 = model(blind1)
-                outputs2 = model(blind2)
-            
-                n2v_loss1 = criterion(outputs1[mask > 0], raw1[mask > 0])
-                n2v_loss2 = criterion(outputs2[mask > 0], raw2[mask > 0])
+                    flow_inputs = normalize_image_torch(flow_inputs1)
+                    flow_outputs = normalize_image_torch(flow_outputs1)
+                    flow_loss1 = torch.mean(torch.abs(flow_outputs - flow_inputs))
 
-                loss = n2v_loss1 + n2v_loss2
+                    flow_inputs = normalize_image_torch(flow_inputs2)
+                    flow_outputs = normalize_image_torch(flow_outputs2)
+                    flow_loss2 = torch.mean(torch.abs(flow_outputs - flow_inputs))
+
+                    loss = n2v_loss1 + n2v_loss2 + flow_loss1 * alpha + flow_loss2 * alpha
+                else:
+                    loss = n2v_loss1 + n2v_loss2
             
             if optimizer:
-                loss.backward()
-                optimizer.step()
+                with profiler.phase('backward'):
+                    precision.backward(loss)
+                with profiler.phase('step'):
+                    precision.step(optimizer)
             
             total_loss += loss.item()
 
@@ -1076,7 +1102,8 @@ def process_batch_n2v(
                         'Total Loss': loss.item()
                     }
                     
-                plot_images(images, titles, losses)
+                with profiler.phase('metrics'):
+                    plot_images(images, titles, losses)
     
     return total_loss / len(loader)
 
@@ -1164,7 +1191,8 @@ def visualise_n2v(raw1, blind1, blind2, output1, output2):
 
 def train_n2v(model, train_loader, val_loader, optimizer, criterion, starting_epoch, epochs, batch_size, lr, 
           best_val_loss, checkpoint_path=None, device='cuda', visualise=False, 
-          speckle_module=None, alpha=1, save=False, method='n2v', octa_criterion=None, threshold=0.0, mask_ratio=0.1):
+          speckle_module=None, alpha=1, save=False, method='n2v', octa_criterion=None, threshold=0.0, mask_ratio=0.1,
+          best_metrics_score=None, scheduler=None, train_config=None, precision=None, training_state=None):
     """
     Train function that handles both Noise2Void and Noise2Self approaches.
     
@@ -1177,51 +1205,78 @@ def train_n2v(model, train_loader, val_loader, optimizer, criterion, starting_ep
 
     print(f"Saving checkpoints to {best_checkpoint_path}")
 
+    precision = get_precision(precision, device)
+    model = precision.prepare_model(model)
+    speckle_module = precision.prepare_model(freeze_speckle_module(speckle_module))
+
+    checkpoint_writer = CheckpointWriter()
+    profiler = get_profiler(train_config, checkpoint_path + '_profile.jsonl', device)
+    training_state = training_state or NullTrainingState()
     start_time = time.time()
     for epoch in range(starting_epoch, starting_epoch+epochs):
         model.train()
 
         #print(model)
 
-        train_loss = process_batch_n2v(model, train_loader, criterion, mask_ratio,
+        train_loss = process_batch_n2v(model, training_state.batches(train_loader, epoch), criterion, mask_ratio,
             optimizer=optimizer, 
-            device='cuda',
+            device=device,
             speckle_module=speckle_module,
-            visualize=False)
+            visualize=False,
+            precision=precision,
+            profiler=profiler,
+            epoch=epoch)
         
         model.eval()
         with torch.no_grad():
             val_loss = process_batch_n2v(model, val_loader, criterion, mask_ratio,
                 optimizer=None, 
-                device='cuda',
+                device=device,
                 speckle_module=speckle_module,
-                visualize=True)
+                visualize=True,
+                precision=precision,
+                profiler=profiler,
+                epoch=epoch)
+
+        # Losses averaged over ranks so best-model and scheduler decisions agree
+        train_loss = all_reduce_mean(train_loss)
+        val_loss = all_reduce_mean(val_loss)
+        if scheduler is not None:
+            scheduler.step(val_loss)
 
         print(f"Epoch [{epoch+1}/{starting_epoch+epochs}], Average Loss: {train_loss:.6f}")
         
         if val_loss < best_val_loss and save:
             best_val_loss = val_loss
             print(f"Saving best model with val loss: {val_loss:.6f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss
-            }, best_checkpoint_path)
+            with profiler.phase('checkpoint'):
+                checkpoint_writer.save({
+                    'epoch': epoch,
+                    'target_epoch': starting_epoch + epochs,
+                    'model_state_dict': unwrap_model(model).state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict(),
+                    'train_loss': train_loss,
+                    'val_loss': val_loss,
+                    'best_val_loss': best_val_loss
+                }, best_checkpoint_path)
+        training_state.end_epoch(epoch, best_val_loss=best_val_loss, best_metrics_score=best_metrics_score)
+        profiler.end_epoch(epoch, train_loss=train_loss, val_loss=val_loss)
     
-    if save:
+    # No epochs run (a finished run resumed) leaves nothing new to save
+    if save and epochs > 0:
         print(f"Saving last model with val loss: {val_loss:.6f}")
-        torch.save({
+        checkpoint_writer.save({
                     'epoch': epoch,
-                    'model_state_dict': model.state_dict(),
+                    'target_epoch': starting_epoch + epochs,
+                    'model_state_dict': unwrap_model(model).state_dict(),
                     'optimizer_state_dict': optimizer.state_dict(),
                     'train_loss': train_loss,
                     'val_loss': val_loss,
                     'best_val_loss': best_val_loss
             }, last_checkpoint_path)
     
+    checkpoint_writer.close()
+    profiler.close()
     elapsed_time = time.time() - start_time
     print(f"Training completed in {elapsed_time / 60:.2f} minutes")
     
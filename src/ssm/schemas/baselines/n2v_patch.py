@@ -4,9 +4,20 @@ import torch
 from ssm.utils.eval_utils.visualise import plot_images
 
 from ssm.utils import evaluate_oct_denoising
+from ssm.utils.precision import get_precision
+from ssm.utils.checkpoint import CheckpointWriter
+from ssm.utils.distributed import all_reduce_mean, unwrap_model
+from ssm.utils.profiler import NullProfiler, get_profiler
+from ssm.utils.resume import NullTrainingState
+from ssm.utils.eval_utils.async_metrics import (
+    get_metrics_worker, report_validation, metrics_score, BestMetricsCheckpointer
+)
+from ssm.models.ssm.frozen_ssm import freeze_speckle_module
+from ssm.data.paired_dataset import split_batch
+from ssm.schemas.components.micro_batch import get_micro_batch_runner
 import torch.nn.functional as F
 
-from ssm.utils.data_utils.patch_processing import extract_patches, reconstruct_from_patches
+from ssm.utils.data_utils.patch_processing import extract_patches, reconstruct_from_patches, filter_tissue_patches, print_skip_stats, patch_cache_keys
 
 def train_n2v(model, train_loader, val_loader, optimizer, criterion, starting_epoch, epochs, batch_size, lr, 
           best_val_loss, checkpoint_path=None, device='cuda', visualise=False, 
@@ -31,7 +42,7 @@ def train_n2v(model, train_loader, val_loader, optimizer, criterion, starting_ep
 
         train_loss = process_batch_n2v(model, train_loader, criterion, mask_ratio,
             optimizer=optimizer, 
-            device='cuda',
+            device=device,
             speckle_module=speckle_module,
             visualize=False)
         
@@ -39,7 +50,7 @@ def train_n2v(model, train_loader, val_loader, optimizer, criterion, starting_ep
         with torch.no_grad():
             val_loss = process_batch_n2v(model, val_loader, criterion, mask_ratio,
                 optimizer=None, 
-                device='cuda',
+                device=device,
                 speckle_module=speckle_module,
                 visualize=True)
 
@@ -50,6 +61,7 @@ def train_n2v(model, train_loader, val_loader, optimizer, criterion, starting_ep
             print(f"Saving best model with val loss: {val_loss:.6f}")
             torch.save({
                 'epoch': epoch,
+                'target_epoch': starting_epoch + epochs,
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'train_loss': train_loss,
@@ -61,6 +73,7 @@ def train_n2v(model, train_loader, val_loader, optimizer, criterion, starting_ep
         print(f"Saving last model with val loss: {val_loss:.6f}")
         torch.save({
                     'epoch': epoch,
+                    'target_epoch': starting_epoch + epochs,
                     'model_state_dict': model.state_dict(),
                     'optimizer_state_dict': optimizer.state_dict(),
                     'train_loss': train_loss,
@@ -77,7 +90,8 @@ def train_n2v(model, train_loader, val_loader, optimizer, criterion, starting_ep
 def train_n2v_patch(model, train_loader, val_loader, optimizer, criterion, starting_epoch, epochs, batch_size, lr, 
           best_val_loss, checkpoint_path=None, device='cuda', visualise=False, 
           speckle_module=None, alpha=1, save=False, method='n2v', octa_criterion=None, threshold=0.0, mask_ratio=0.1, best_metrics_score=float('-inf'),
-          scheduler=None, train_config=None, sample=None, patch_size=64, stride=32, patience_count=10):
+          scheduler=None, train_config=None, sample=None, patch_size=64, stride=32, patience_count=10,
+          tissue_threshold=None, background_keep=0.0, precision=None, training_state=None):
     """
     Train function that handles both Noise2Void and Noise2Self approaches.
     
@@ -91,86 +105,99 @@ def train_n2v_patch(model, train_loader, val_loader, optimizer, criterion, start
 
     print(f"Saving checkpoints to {best_checkpoint_path}")
 
+    precision = get_precision(precision, device)
+    model = precision.prepare_model(model)
+    speckle_module = precision.prepare_model(freeze_speckle_module(speckle_module))
+
     patience = 0
 
+    checkpoint_writer = CheckpointWriter()
+    # Validation figures and metrics off the training thread, every metrics_every epochs
+    metrics_worker = get_metrics_worker(train_config, checkpoint_path + '_patched_validation')
+    metrics_every = train_config.get('metrics_every', 1) if train_config else 1
+    best_metrics = None
+    if metrics_worker is not None:
+        best_metrics = BestMetricsCheckpointer(
+            metrics_worker, checkpoint_writer, best_metrics_checkpoint_path, best_metrics_score, save)
+    profiler = get_profiler(train_config, checkpoint_path + '_patched_profile.jsonl', device)
+    training_state = training_state or NullTrainingState()
     start_time = time.time()
     for epoch in range(starting_epoch, starting_epoch+epochs):
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)
         model.train()
 
         #print(model)
         print(f"Epoch [{epoch+1}/{starting_epoch+epochs}]")
 
-        train_loss = process_batch_n2v_patch(model, train_loader, criterion, mask_ratio,
+        train_loss = process_batch_n2v_patch(model, training_state.batches(train_loader, epoch), criterion, mask_ratio,
             optimizer=optimizer, 
-            device='cuda',
+            device=device,
             speckle_module=speckle_module,
             visualize=False,
             alpha=alpha,
             scheduler=scheduler,
             sample=sample,
             patch_size = patch_size,
-            stride = stride)
+            stride = stride,
+            tissue_threshold = tissue_threshold,
+            background_keep = background_keep,
+            precision = precision,
+            train_config = train_config,
+            profiler = profiler,
+            epoch = epoch)
         
         model.eval()
+        visualise = (epoch - starting_epoch) % metrics_every == 0
         with torch.no_grad():
-            val_loss, val_metrics = process_batch_n2v_patch(model, val_loader, criterion, mask_ratio,
+            val_result = process_batch_n2v_patch(model, val_loader, criterion, mask_ratio,
                 optimizer=None, 
-                device='cuda',
+                device=device,
                 speckle_module=speckle_module,
-                visualize=True,
+                visualize=visualise,
                 alpha=alpha,
                 scheduler=scheduler,
                 sample=sample,
                 patch_size = patch_size,
-                stride = stride)
+                stride = stride,
+                precision = precision,
+                train_config = train_config,
+                metrics_worker = metrics_worker,
+                metrics_key = epoch,
+                profiler = profiler,
+                epoch = epoch)
+            val_loss, val_metrics = val_result if isinstance(val_result, tuple) else (val_result, {})
             
-            val_metrics_score = (
-                val_metrics.get('snr', 0) * 0.3 + 
-                val_metrics.get('cnr', 0) * 0.3 + 
-                val_metrics.get('enl', 0) * 0.2 + 
-                val_metrics.get('epi', 0) * 0.2
-            )
+            val_metrics_score = metrics_score(val_metrics)
         
+        # Losses averaged over ranks so best-model and scheduler decisions agree
+        train_loss = all_reduce_mean(train_loss)
+        val_loss = all_reduce_mean(val_loss)
+
         if scheduler is not None:
             scheduler.step(val_loss)
 
         print(f"Epoch [{epoch+1}/{starting_epoch+epochs}], Average Loss: {train_loss:.6f}")
         
+        # Checkpoints of one epoch are written once from a shared snapshot
+        checkpoint_paths = []
         if val_loss < best_val_loss and save:
             best_val_loss = val_loss
             print(f"Saving best model with val loss: {val_loss:.6f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss,
-                'metrics': val_metrics,
-                'metrics_score': val_metrics_score,
-                'train_config': train_config
-            }, best_checkpoint_path)
+            checkpoint_paths.append(best_checkpoint_path)
 
-        if val_metrics_score > best_metrics_score  and save:
+        if metrics_worker is None and val_metrics and val_metrics_score > best_metrics_score  and save:
             best_metrics_score = val_metrics_score
             print(f"Saving best metrics model with score: {val_metrics_score:.4f}")
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'best_val_loss': best_val_loss,
-                'metrics': val_metrics,
-                'metrics_score': val_metrics_score,
-                'train_config': train_config
-            }, best_metrics_checkpoint_path)
+            checkpoint_paths.append(best_metrics_checkpoint_path)
     
         if save:
             print(f"Saving last model with val loss: {val_loss:.6f}")
-            torch.save({
+            checkpoint_paths.append(last_checkpoint_path)
+            checkpoint = {
                         'epoch': epoch,
-                        'model_state_dict': model.state_dict(),
+                        'target_epoch': starting_epoch + epochs,
+                        'model_state_dict': unwrap_model(model).state_dict(),
                         'optimizer_state_dict': optimizer.state_dict(),
                         'train_loss': train_loss,
                         'val_loss': val_loss,
@@ -178,7 +205,19 @@ def train_n2v_patch(model, train_loader, val_loader, optimizer, criterion, start
                         'metrics': val_metrics,
                         'metrics_score': val_metrics_score,
                         'train_config': train_config
-                }, last_checkpoint_path)
+                }
+            with profiler.phase('checkpoint'):
+                checkpoint_writer.save(checkpoint, *checkpoint_paths)
+                if best_metrics is not None and visualise:
+                    best_metrics.add(epoch, checkpoint)
+
+        if best_metrics is not None:
+            with profiler.phase('metrics'):
+                best_metrics.update()
+        training_state.end_epoch(
+            epoch, best_val_loss=best_val_loss,
+            best_metrics_score=best_metrics.best_score if best_metrics is not None else best_metrics_score)
+        profiler.end_epoch(epoch, train_loss=train_loss, val_loss=val_loss)
             
         # Early stopping based on validation loss
         if val_loss < best_val_loss:
@@ -189,6 +228,10 @@ def train_n2v_patch(model, train_loader, val_loader, optimizer, criterion, start
                 print(f"Early stopping at epoch {epoch+1} due to no improvement in validation loss.")
                 break
     
+    if best_metrics is not None:
+        best_metrics.close()
+    checkpoint_writer.close()
+    profiler.close()
     elapsed_time = time.time() - start_time
     print(f"Training completed in {elapsed_time / 60:.2f} minutes")
     
@@ -547,7 +590,7 @@ def _old_process_batch_n2v_patch(
     
 from contextlib import nullcontext
 from tqdm import tqdm
-from ssm.utils.data_utils.patch_processing import extract_patches, reconstruct_from_patches
+from ssm.utils.data_utils.patch_processing import extract_patches, reconstruct_from_patches, filter_tissue_patches, print_skip_stats, patch_cache_keys
 from ssm.utils.data_utils.standard_preprocessing import normalize_image_torch
 from ssm.utils.noise import create_blind_spot_input_with_realistic_noise
 
@@ -561,7 +604,15 @@ def process_batch_n2v_patch(
         scheduler=None,
         sample=None,
         patch_size = 64,  # Choose appropriate patch size
-        stride = 32 
+        stride = 32,
+        tissue_threshold = None,
+        background_keep = 0.0,
+        precision = None,
+        train_config = None,
+        metrics_worker = None,
+        metrics_key = None,
+        profiler = None,
+        epoch = None
         ):
     
     if optimizer: 
@@ -569,95 +620,119 @@ def process_batch_n2v_patch(
     else:
         model.eval()
     
+    precision = get_precision(precision, device)
+    profiler = profiler or NullProfiler()
+    speckle_module = freeze_speckle_module(speckle_module)
+    # Every sub-batch contributes to one optimizer step per loader batch
+    runner = get_micro_batch_runner(model, optimizer, precision, train_config, device, profiler=profiler)
+    
     total_loss = 0.0
          # Choose appropriate stride
 
     metrics = None
+    skip_stats = {}
     
     context_manager = torch.no_grad() if not optimizer else nullcontext()
     
     with context_manager:
-        for batch_idx, batch in enumerate(tqdm(loader)):
-            raw1, _ = batch
-
-            raw1 = raw1.to(device)
-            #raw2 = raw2.to(device)
-
-            # Extract patches
-            raw1_patches, patch_locations1 = extract_patches(raw1, patch_size, stride)
-            #raw2_patches, patch_locations2 = extract_patches(raw2, patch_size, stride)
+        mode = 'train' if optimizer else 'val'
+        for batch_idx, batch in enumerate(tqdm(profiler.batches(loader, epoch, mode))):
+            with profiler.phase('h2d'):
+                raw1, _, indices, flow_maps = split_batch(batch)
+
+                raw1 = raw1.to(device)
+                #raw2 = raw2.to(device)
+
+            with profiler.phase('prep'):
+                # Extract patches
+                raw1_patches, patch_locations1 = extract_patches(raw1, patch_size, stride)
+                # Precomputed input flows are cropped at the same patch locations
+                flow_patches = None
+                if flow_maps is not None:
+                    flow_patches, _ = extract_patches(flow_maps.to(device), patch_size, stride)
+                #raw2_patches, patch_locations2 = extract_patches(raw2, patch_size, stride)
+
+                # Background-only patches are skipped during training
+                if tissue_threshold is not None and optimizer:
+                    patch_locations1, keep = filter_tissue_patches(
+                        raw1, patch_locations1, patch_size, tissue_threshold, background_keep, stats=skip_stats)
+                    raw1_patches = raw1_patches[keep]
+                    if flow_patches is not None:
+                        flow_patches = flow_patches[keep]
 
             print(f"Raw1 patches shape: {raw1_patches.shape}")
             #print(f"Raw2 patches shape: {raw2_patches.shape}")
             
-            # Process patches in sub-batches to avoid memory issues
-            sub_batch_size = 32  # Adjust based on your GPU memory
-            batch_loss = 0.0
+            # Process patches in micro-batches sized by memory budget
             all_output1_patches = []
             
-            for i in range(0, len(raw1_patches), sub_batch_size):
-                raw1_sub_batch = raw1_patches[i:i+sub_batch_size]
-                #raw2_sub_batch = raw2_patches[i:i+sub_batch_size]
-
-                mask = torch.bernoulli(torch.full((raw1_sub_batch.size(0), 1, raw1_sub_batch.size(2), raw1_sub_batch.size(3)), 
-                                            mask_ratio, device=device))
+            for i, end in runner.micro_batches(len(raw1_patches), raw1_patches.shape[1:]):
+                with runner.accumulate():
+                    raw1_sub_batch = precision.prepare_input(raw1_patches[i:end])
+                    #raw2_sub_batch = raw2_patches[i:i+sub_batch_size]
+
+                    with profiler.phase('prep'):
+                        mask = torch.bernoulli(torch.full((raw1_sub_batch.size(0), 1, raw1_sub_batch.size(2), raw1_sub_batch.size(3)), 
+                                                    mask_ratio, device=device))
                 
-                blind1 = create_blind_spot_input_with_realistic_noise(raw1_sub_batch, mask).requires_grad_(True)
-                #blind2 = create_blind_spot_input_with_realistic_noise(raw2_sub_batch, mask).requires_grad_(True)
+                        blind1 = create_blind_spot_input_with_realistic_noise(raw1_sub_batch, mask).requires_grad_(True)
+                        #blind2 = create_blind_spot_input_with_realistic_noise(raw2_sub_batch, mask).requires_grad_(True)
                 
-                if speckle_module is not None:
-                    flow_inputs = speckle_module(raw1_sub_batch)
-                    flow_inputs = flow_inputs['flow_component'].detach()
-                    flow_inputs = normalize_image_torch(flow_inputs)
-                    outputs1 = model(blind1)
-                    all_output1_patches.append(outputs1.detach())
+                    if speckle_module is not None:
+                        patch_keys = patch_cache_keys(indices, patch_locations1[i:end])
+                        flow_sub_batch = flow_patches[i:end] if flow_patches is not None else None
+                        with precision.autocast(), profiler.phase('forward'):
+                            outputs1 = model(blind1)
+                            # One frozen forward for input and output patches, input flows cached per patch
+                            flow_inputs, flow_outputs = speckle_module.cached_flows(
+                                raw1_sub_batch, patch_keys, outputs1, input_flows=flow_sub_batch)
+                        # Losses in fp32
+                        with profiler.phase('loss'):
+                            outputs1 = outputs1.float()
+                            all_output1_patches.append(outputs1.detach())
                     
-                    flow_outputs = speckle_module(outputs1)
-                    flow_outputs = flow_outputs['flow_component'].detach()
-                    flow_outputs = normalize_image_torch(flow_outputs)
-                    flow_loss1 = torch.mean(torch.abs(flow_outputs - flow_inputs))
-
-                    #flow_inputs = speckle_module(raw2_sub_batch)
-                    #flow_inputs = flow_inputs['flow_component'].detach()
-                    #flow_inputs = normalize_image_torch(flow_inputs)
-
-                    #outputs2 = model(blind2)
-                    #all_output2_patches.append(outputs2.detach())
-                    #flow_outputs = speckle_module(outputs2)
-                    #flow_outputs = flow_outputs['flow_component'].detach()
-                    #flow_outputs = normalize_image_torch(flow_outputs)
-                    #flow_loss2 = torch.mean(torch.abs(flow_outputs - flow_inputs))
+                            flow_inputs = normalize_image_torch(flow_inputs.float())
+                            flow_outputs = normalize_image_torch(flow_outputs.float())
+                            flow_loss1 = torch.mean(torch.abs(flow_outputs - flow_inputs))
+
+                            #flow_inputs = speckle_module(raw2_sub_batch)
+                            #flow_inputs = flow_inputs['flow_component'].detach()
+                            #flow_inputs = normalize_image_torch(flow_inputs)
+
+                            #outputs2 = model(blind2)
+                            #all_output2_patches.append(outputs2.detach())
+                            #flow_outputs = speckle_module(outputs2)
+                            #flow_outputs = flow_outputs['flow_component'].detach()
+                            #flow_outputs = normalize_image_torch(flow_outputs)
+                            #flow_loss2 = torch.mean(torch.abs(flow_outputs - flow_inputs))
                     
-                    n2v_loss1 = criterion(outputs1[mask > 0], raw1_sub_batch[mask > 0])
-                    #n2v_loss2 = criterion(outputs2[mask > 0], raw2_sub_batch[mask > 0])
-
-                    sub_loss = n2v_loss1 + flow_loss1 * alpha
-                    #sub_loss = (n2v_loss1 + n2v_loss2 + flow_loss1 * alpha + flow_loss2 * alpha) / ((len(raw1_patches) + sub_batch_size - 1) // sub_batch_size)
-
-                else:
-                    outputs1 = model(blind1)
-                    #outputs2 = model(blind2)
-                    all_output1_patches.append(outputs1.detach())
-                    #all_output2_patches.append(outputs2.detach())
+                            n2v_loss1 = criterion(outputs1[mask > 0], raw1_sub_batch[mask > 0])
+                            #n2v_loss2 = criterion(outputs2[mask > 0], raw2_sub_batch[mask > 0])
+
+                            sub_loss = n2v_loss1 + flow_loss1 * alpha
+                            #sub_loss = (n2v_loss1 + n2v_loss2 + flow_loss1 * alpha + flow_loss2 * alpha) / ((len(raw1_patches) + sub_batch_size - 1) // sub_batch_size)
+
+                    else:
+                        with precision.autocast(), profiler.phase('forward'):
+                            outputs1 = model(blind1)
+                        with profiler.phase('loss'):
+                            outputs1 = outputs1.float()
+                            #outputs2 = model(blind2)
+                            all_output1_patches.append(outputs1.detach())
+                            #all_output2_patches.append(outputs2.detach())
                 
-                    n2v_loss1 = criterion(outputs1[mask > 0], raw1_sub_batch[mask > 0])
-                    #n2v_loss2 = criterion(outputs2[mask > 0], raw2_sub_batch[mask > 0])
+                            n2v_loss1 = criterion(outputs1[mask > 0], raw1_sub_batch[mask > 0])
+                            #n2v_loss2 = criterion(outputs2[mask > 0], raw2_sub_batch[mask > 0])
 
-                    sub_loss = n2v_loss1
+                            sub_loss = n2v_loss1
                 
-                batch_loss += sub_loss.item() * len(raw1_sub_batch)
+                    runner.backward(sub_loss, len(raw1_sub_batch))
             
-            if optimizer:
-                optimizer.zero_grad()
-                sub_loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-                optimizer.step()
-            
-            total_loss += batch_loss / len(raw1_patches)
+            total_loss += runner.batch_loss
             
             if visualize and batch_idx == 0:
                 # Flatten all output patches
-                output1_patches = torch.cat(all_output1_patches, dim=0)
+                output1_patches = torch.cat(all_output1_patches, dim=0)[:len(patch_locations1)]
                 #output2_patches = torch.cat(all_output2_patches, dim=0)
                 
                 reconstructed_outputs1 = reconstruct_from_patches(
@@ -684,7 +759,7 @@ def process_batch_n2v_patch(
                     ]
                     losses = {
                         'Flow Loss': (flow_loss1.item()),
-                        'Total Loss': batch_loss / len(raw1_patches)
+                        'Total Loss': runner.batch_loss
                     }
                 else:
                     titles = ['Input Image', 'Blind Spot Input', 'Output Image', "Sample Input", "Sample Output"]
@@ -696,14 +771,16 @@ def process_batch_n2v_patch(
                         sample_output[0][0] if sample is not None else None
                     ]
                     losses = {
-                        'Total Loss': batch_loss / len(raw1_patches)
+                        'Total Loss': runner.batch_loss
                     }
                     
-                plot_images(images, titles, losses)
-
-                from ssm.utils import evaluate_oct_denoising
+                with profiler.phase('metrics'):
+                    metrics = report_validation(
+                        images, titles, losses,
+                        raw1[0][0].cpu().numpy(), reconstructed_outputs1[0][0].cpu().numpy(),
+                        metrics_worker, metrics_key, name=f"n2v_patch_{metrics_key}")
 
-                metrics = evaluate_oct_denoising(raw1[0][0].cpu().numpy(), reconstructed_outputs1[0][0].cpu().numpy())
+    print_skip_stats(skip_stats)
 
     if metrics is not None:
         return total_loss / len(loader), metrics
@@ -1,5 +1,7 @@
 from ssm.utils.config import get_config
 from ssm.utils.eval_utils.evaluate import evaluate
+from ssm.utils.compile import get_compiled_model
+from ssm.utils.export import export_path, load_exported_model
 import torch
 from ssm.models import UNet, UNet2, LargeUNetAttention, LargeUNet2, LargeUNet3
 from ssm.models.unet.large_unet_attention import LargeUNetAtt
@@ -27,6 +29,16 @@ def load_model(config, verbose=False, last=False, best=False):
         checkpoint_path = base_checkpoint_path + rf"{method}_{model}_patched_best_metrics_checkpoint.pth"
     
     device = eval_config['device']
+
+    # Inference artifact written by export_model: no model class or training checkpoint needed
+    artifact = eval_config.get('artifact', None)
+    if artifact:
+        if artifact is True:
+            artifact = export_path(baseline_checkpoint_path(config, last, best), eval_config.get('artifact_method', 'torchscript'))
+        model, checkpoint = load_exported_model(artifact, device)
+        if verbose:
+            print(f"Inference artifact loaded from {artifact}")
+        return model, checkpoint
     
     if model == "UNet":
         model = UNet(in_channels=1, out_channels=1).to(device)
@@ -53,6 +65,8 @@ def load_model(config, verbose=False, last=False, best=False):
 
     checkpoint = load_checkpoint(config, last)
     model.load_state_dict(checkpoint['model_state_dict'])
+    # Opt-in torch.compile (TorchScript fallback) for full 256x256 images
+    model = get_compiled_model(model.eval(), eval_config)
 
     if verbose:
         print(f"Loading {model} model...")
@@ -96,7 +110,7 @@ def load_checkpoint(config, last=False):
     
     return checkpoint
 
-def load_checkpoint(config, last=False, best=False):
+def baseline_checkpoint_path(config, last=False, best=False):
     eval_config = config['training']
     base_checkpoint_path = eval_config['baselines_checkpoint_path']
     ablation = eval_config['ablation'].format(n=config['training']['n_patients'], n_images=config['training']['n_images_per_patient'])
@@ -119,10 +133,26 @@ def load_checkpoint(config, last=False, best=False):
             checkpoint_path = base_checkpoint_path + ablation + rf"/{method}_{model}_patched_last_checkpoint.pth"
         else:
             checkpoint_path = base_checkpoint_path + ablation + rf"/{method}_{model}_patched_best_checkpoint.pth"
+    return checkpoint_path
+
+def tiling_options(config):
+    """
+    Tiled evaluation options passed to ``evaluate``.
+
+    Options:
+        tile_size: Denoise native-resolution images with tiles of this size
+            (``tiled_denoise``); None (default) runs the whole image at once
+        tile_overlap: Overlap between neighbouring tiles in pixels (default 64)
+    """
+    eval_config = config['training']
+    return {'tile_size': eval_config.get('tile_size', None), 'overlap': eval_config.get('tile_overlap', 64)}
+
+def load_checkpoint(config, last=False, best=False):
+    checkpoint_path = baseline_checkpoint_path(config, last, best)
     
     print(f"Checkpoint path: {checkpoint_path}")
     
-    device = eval_config['device']
+    device = config['training']['device']
     
     checkpoint = torch.load(checkpoint_path, map_location=device)
     
@@ -139,7 +169,8 @@ def evaluate_baseline(image, reference, method, config_path = None, override_con
     model, checkpoint = load_model(config, verbose, last=last, best=best)
     #checkpoint = load_checkpoint(config, last=last)
     
-    metrics, denoised = evaluate(image, reference, model, method)
+    metrics, denoised = evaluate(image, reference, model, method, device=config['training']['device'],
+                                 **tiling_options(config))
 
     metrics['epochs'] = checkpoint['epoch']
     metrics['loss'] = checkpoint['best_val_loss']
@@ -158,7 +189,8 @@ def evaluate_ssm_constraint(image, reference, method, config_path, override_conf
     model, checkpoint = load_model(config, verbose, last=last, best=best)
     #checkpoint = load_checkpoint(config)
 
-    metrics, denoised = evaluate(image, reference, model, method)
+    metrics, denoised = evaluate(image, reference, model, method, device=config['training']['device'],
+                                 **tiling_options(config))
 
     metrics['epochs'] = checkpoint['epoch']
     metrics['loss'] = checkpoint['best_val_loss']
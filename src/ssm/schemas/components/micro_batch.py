@@ -0,0 +1,210 @@
+import math
+import torch
+
+from ssm.utils.precision import get_precision
+from ssm.utils.batch_size_finder import find_max_micro_batch
+from ssm.utils.profiler import NullProfiler
+from ssm.utils.distributed import all_reduce_max, is_ddp, no_sync, unwrap_model
+
+# Rough activation memory of a training forward/backward per input element,
+# relative to the input itself (feature maps of a UNet at full resolution)
+ACTIVATION_FACTOR = 256
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+def available_memory_mb(device='cuda', fraction=0.5):
+    """Memory budget in MB: a fraction of free CUDA memory, or a fixed default on CPU."""
+    device = torch.device(device)
+    if device.type == 'cuda' and torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info(device)
+        return free / 2**20 * fraction
+    return DEFAULT_MEMORY_BUDGET_MB
+
+def budget_micro_batch_size(item_shape, memory_budget_mb=None, device='cuda', precision=None,
+                            activation_factor=ACTIVATION_FACTOR, max_size=256):
+    """
+    Largest power-of-two micro-batch whose estimated activations fit the budget.
+
+    Args:
+        item_shape: Shape of one item, e.g. (C, patch_size, patch_size)
+        memory_budget_mb: Budget in MB, or None for ``available_memory_mb(device)``
+        device: Device the model runs on
+        precision: ``PrecisionContext`` or precision name; halves the estimate for bf16/fp16
+        activation_factor: Activation bytes per input byte
+        max_size: Upper bound on the micro-batch size
+
+    Returns:
+        int: Micro-batch size
+    """
+    if memory_budget_mb is None:
+        memory_budget_mb = available_memory_mb(device)
+    element_size = 2 if get_precision(precision, device).enabled else 4
+    item_bytes = math.prod(item_shape) * element_size * activation_factor
+    size = int(memory_budget_mb * 2**20 // item_bytes)
+    if size < 1:
+        return 1
+    return min(2 ** int(math.log2(size)), max_size)
+
+class MicroBatchRunner:
+    """
+    Shared micro-batch / gradient-accumulation loop of the patch trainers.
+
+    A logical batch of ``n_items`` (e.g. all patches of a loader batch) is split
+    into micro-batches by ``micro_batches``. Each micro-batch loss, a mean over
+    its items, is passed to ``backward`` and weighted by its share of the items
+    in the current accumulation window, so the accumulated gradient equals that
+    of the mean loss over the window. The optimizer steps once every
+    ``accumulation_steps`` micro-batches, by default once per logical batch.
+    Without an optimizer (validation) ``backward`` only records the loss.
+
+    With a ``DistributedDataParallel`` model the trainers run the forward and
+    backward of each micro-batch inside ``accumulate()``, so gradients are only
+    all-reduced by the micro-batch right before an optimizer step. DDP forwards
+    and all-reduces are collectives, so ``micro_batches`` pads every rank to the
+    largest micro-batch count of the logical batch (tissue filtering makes patch
+    counts differ between ranks). Padding micro-batches repeat the first range
+    and are backpropagated with zero weight.
+
+    Args:
+        model: Model being trained
+        optimizer: Optimizer, or None for evaluation
+        precision: ``PrecisionContext`` used for scaled backward and step
+        micro_batch_size: Items per micro-batch, None to estimate it from the memory budget,
+            or 'auto' to probe the largest size that fits with ``find_max_micro_batch``
+        accumulation_steps: Micro-batches per optimizer step, or None for one step per logical batch
+        max_norm: Gradient clipping norm, or None
+        memory_budget_mb: Budget used when ``micro_batch_size`` is None or 'auto'
+        device: Device the model runs on
+        profiler: ``TrainingProfiler`` timing the backward and step phases
+    """
+    def __init__(self, model, optimizer=None, precision=None, micro_batch_size=None, accumulation_steps=None,
+                 max_norm=1.0, memory_budget_mb=None, device='cuda', profiler=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.device = device
+        self.precision = get_precision(precision, device)
+        self.micro_batch_size = micro_batch_size
+        self.accumulation_steps = accumulation_steps
+        self.max_norm = max_norm
+        self.memory_budget_mb = memory_budget_mb
+        self.profiler = profiler or NullProfiler()
+        self.n_steps = 0
+
+    @property
+    def training(self):
+        return self.optimizer is not None
+
+    def resolve_micro_batch_size(self, item_shape):
+        if self.micro_batch_size == 'auto':
+            # Cache key from the underlying model, not a DDP or compile wrapper
+            self.micro_batch_size = find_max_micro_batch(
+                self.model, item_shape, self.device, self.precision, self.memory_budget_mb,
+                model_name=type(unwrap_model(self.model)).__name__)
+        elif self.micro_batch_size is None:
+            self.micro_batch_size = budget_micro_batch_size(
+                item_shape, self.memory_budget_mb, self.device, self.precision)
+            print(f"Micro-batch size from memory budget: {self.micro_batch_size}")
+        return self.micro_batch_size
+
+    def micro_batches(self, n_items, item_shape=None):
+        """
+        Yield ``(start, end)`` item ranges of one logical batch and step at the end.
+
+        Args:
+            n_items: Number of items in the logical batch
+            item_shape: Shape of one item, needed when sizing by memory budget
+        """
+        if self.micro_batch_size in (None, 'auto') and item_shape is None:
+            raise ValueError("item_shape is required when micro_batch_size is chosen by memory budget")
+        size = self.resolve_micro_batch_size(item_shape)
+        n_local = math.ceil(n_items / size)
+        n_micro = max(1, n_local)
+        if is_ddp(self.model):
+            # Same number of forwards and all-reduces on every rank
+            n_micro = all_reduce_max(n_micro)
+        steps = self.accumulation_steps or n_micro
+
+        self._n_items = n_items
+        self._size = size
+        self._n_local = n_local
+        self._n_micro = n_micro
+        self._window = steps
+        self._count = 0
+        self._loss_sum = 0.0
+        if self.training:
+            self.optimizer.zero_grad()
+
+        for start in range(0, n_items, size):
+            yield start, min(start + size, n_items)
+        for _ in range(n_micro - n_local if n_items > 0 else 0):
+            yield 0, min(size, n_items)
+
+        # Step on any leftover accumulated micro-batches
+        if self.training and self._count % self._window != 0:
+            self._step()
+
+    @property
+    def padding(self):
+        """Whether the current micro-batch only pads this rank to the shared micro-batch count."""
+        return self._count >= self._n_local
+
+    def _syncs(self):
+        return (self._count + 1) % self._window == 0 or self._count + 1 == self._n_micro
+
+    def accumulate(self):
+        """
+        Context for the forward and backward of the current micro-batch.
+
+        Skips the DDP gradient all-reduce unless this micro-batch is followed
+        by an optimizer step. DDP prepares the all-reduce during the forward,
+        so the forward has to run inside this context too.
+        """
+        return no_sync(self.model, skip=self.training and not self._syncs())
+
+    def _window_items(self):
+        first = (self._count // self._window) * self._window * self._size
+        last = min(first + self._window * self._size, self._n_items)
+        return last - first
+
+    def _step(self):
+        with self.profiler.phase('step'):
+            self.precision.step(self.optimizer, self.model, max_norm=self.max_norm)
+            self.optimizer.zero_grad()
+        self.n_steps += 1
+
+    def backward(self, loss, n):
+        """
+        Accumulate the mean loss ``loss`` of a micro-batch of ``n`` items.
+
+        Returns:
+            float: The unweighted micro-batch loss
+        """
+        value = loss.item()
+        padding = self.padding
+        if not padding:
+            self._loss_sum += value * n
+        if self.training:
+            weight = 0.0 if padding else n / self._window_items()
+            with self.profiler.phase('backward'), no_sync(self.model, skip=not self._syncs()):
+                self.precision.backward(loss * weight)
+        self._count += 1
+        if self.training and self._count % self._window == 0:
+            self._step()
+        return value
+
+    @property
+    def batch_loss(self):
+        """Item-weighted mean loss of the current logical batch."""
+        return self._loss_sum / max(self._n_items, 1)
+
+def get_micro_batch_runner(model, optimizer, precision, train_config=None, device='cuda', default_size=None,
+                           profiler=None):
+    """Build a ``MicroBatchRunner`` from the 'micro_batch_size', 'accumulation_steps' and 'memory_budget_mb' options."""
+    train_config = train_config or {}
+    return MicroBatchRunner(
+        model, optimizer, precision,
+        micro_batch_size=train_config.get('micro_batch_size', default_size),
+        accumulation_steps=train_config.get('accumulation_steps', None),
+        memory_budget_mb=train_config.get('memory_budget_mb', None),
+        device=device,
+        profiler=profiler
+    )
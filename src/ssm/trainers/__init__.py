@@ -1,3 +1,4 @@
 from .n2_trainer import *
-from .pfn_trainer import *
-from .ssm_trainer import *
\ No newline at end of file
+from .ssm_trainer import *
+from .sweep import *
+from .distil_trainer import *
\ No newline at end of file
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import numpy as np
+import torch
+import torch.optim as optim
+
+from ssm.data import get_paired_loaders
+from ssm.data.paired_dataset import split_batch
+from ssm.data.flow_store import normalize_flow_maps
+from ssm.models.ssm.frozen_ssm import SPECKLE_MODELS, FrozenSpeckleModule, load_speckle_module
+from ssm.utils.config import get_config
+from ssm.utils.precision import get_precision, get_precision_from_config
+from ssm.utils.checkpoint import CheckpointWriter
+from ssm.utils.profiler import NullProfiler, get_profiler
+from ssm.utils.quantization import measure_latency
+from ssm.utils.eval_utils.metrics import calculate_psnr
+
+def student_checkpoint_path(train_config):
+    """Where the student is saved: 'distil_checkpoint_path', or next to the teacher checkpoint."""
+    path = train_config.get('distil_checkpoint_path', None)
+    if path is None:
+        teacher_path = train_config['ssm_checkpoint_path']
+        root = teacher_path[:-4] if teacher_path.endswith('.pth') else teacher_path
+        path = root + f"_{train_config.get('distil_student', 'SSMSimple')}_student.pth"
+    return path
+
+def build_student(train_config):
+    """
+    Student speckle module from the 'distil_*' options.
+
+    Options:
+        distil_student: 'SSMSimple' (default) or 'SSMAttention'
+        distil_student_kwargs: Constructor arguments, default a narrow
+            ``SimplifiedSpeckleSeparationModel`` (feature_dim 16, depth 4)
+
+    Returns:
+        tuple: (model, model_name, model_kwargs)
+    """
+    model_name = train_config.get('distil_student', 'SSMSimple')
+    default_kwargs = {'input_channels': 1, 'feature_dim': 16, 'depth': 4} if model_name == 'SSMSimple' else {}
+    model_kwargs = dict(train_config.get('distil_student_kwargs', None) or default_kwargs)
+    return SPECKLE_MODELS[model_name](**model_kwargs), model_name, model_kwargs
+
+def teacher_flows(teacher, input_imgs, target_imgs, indices):
+    """
+    Teacher flow maps of inputs and targets, cached per dataset index.
+
+    The constraint compares flows of noisy inputs with flows of denoised
+    outputs, so the student is fitted on both noisy and clean images.
+    """
+    images = torch.cat([input_imgs, target_imgs], dim=0)
+    keys = None
+    if indices is not None:
+        indices = [i.item() if isinstance(i, torch.Tensor) else i for i in indices]
+        keys = [('input', i) for i in indices] + [('target', i) for i in indices]
+    flows, = teacher.cached_flows(images, keys)
+    return images, flows
+
+def distil_batch(data_loader, student, teacher, optimizer, epoch, epochs, device, precision=None, profiler=None):
+    """One pass over ``data_loader``; trains ``student`` when it is in train mode. Returns the mean flow MSE."""
+    mode = 'train' if student.training else 'val'
+    precision = get_precision(precision, device)
+    profiler = profiler or NullProfiler()
+
+    epoch_loss = 0
+    for batch in profiler.batches(data_loader, epoch, mode):
+        with profiler.phase('h2d'):
+            input_imgs, target_imgs, indices, _ = split_batch(batch)
+            input_imgs = input_imgs.to(device)
+            target_imgs = target_imgs.to(device)
+
+        with profiler.phase('teacher'):
+            images, flows = teacher_flows(teacher, input_imgs, target_imgs, indices)
+
+        with torch.set_grad_enabled(mode == 'train'):
+            with precision.autocast(), profiler.phase('forward'):
+                outputs = student.forward_flow(precision.prepare_input(images))
+            with profiler.phase('loss'):
+                loss = torch.mean((outputs.float() - flows.float()) ** 2)
+
+        if mode == 'train':
+            optimizer.zero_grad()
+            with profiler.phase('backward'):
+                precision.backward(loss)
+            with profiler.phase('step'):
+                precision.step(optimizer, student, max_norm=1.0)
+
+        epoch_loss += loss.item()
+
+    print(f"{mode.capitalize()} Epoch [{epoch+1}/{epochs}], Flow MSE: {epoch_loss / len(data_loader):.6f}")
+    return epoch_loss / len(data_loader)
+
+def train_student(student, teacher, train_loader, val_loader, optimizer, epochs, device, checkpoint_path,
+                  model_name, model_kwargs, scheduler=None, precision=None, profiler=None):
+    """
+    Fit ``student`` to the teacher's flow maps, keeping the checkpoint with the lowest validation flow MSE.
+
+    Checkpoints record 'model_name' and 'model_kwargs' so ``load_speckle_module``
+    can rebuild the student wherever a speckle module checkpoint is expected.
+    """
+    precision = get_precision(precision, device)
+    profiler = profiler or NullProfiler()
+    checkpoint_writer = CheckpointWriter()
+    best_val_loss = float('inf')
+
+    start_time = time.time()
+    for epoch in range(epochs):
+        student.train()
+        train_loss = distil_batch(train_loader, student, teacher, optimizer, epoch, epochs, device, precision, profiler)
+        student.eval()
+        with torch.no_grad():
+            val_loss = distil_batch(val_loader, student, teacher, optimizer, epoch, epochs, device, precision, profiler)
+        if scheduler is not None:
+            scheduler.step(val_loss)
+
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            print(f"Saving best student with val flow MSE: {val_loss:.6f}")
+            with profiler.phase('checkpoint'):
+                checkpoint_writer.save({
+                    'epoch': epoch,
+                    'model_state_dict': student.state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict(),
+                    'model_name': model_name,
+                    'model_kwargs': model_kwargs,
+                    'train_loss': train_loss,
+                    'val_loss': val_loss,
+                    'best_loss': best_val_loss,
+                }, checkpoint_path)
+        profiler.end_epoch(epoch, train_loss=train_loss, val_loss=val_loss)
+
+    checkpoint_writer.close()
+    profiler.close()
+    print(f"Distillation completed in {(time.time() - start_time) / 60:.2f} minutes")
+    return student
+
+@torch.no_grad()
+def distillation_report(student, teacher, data_loader, device, example_shape=None, n_runs=20, output_path=None):
+    """
+    Fidelity and cost of a distilled student against its teacher.
+
+    Fidelity is the flow-map MSE and PSNR on inputs and targets, plus the
+    constraint gap: the mean absolute difference between the flow loss the
+    n2 trainers would compute (L1 between per-image normalised flows of an
+    input and of its clean target) with the student and with the teacher.
+    Latency is the median flow-only forward time of each module.
+
+    Args:
+        student, teacher: Frozen speckle modules (``FrozenSpeckleModule``)
+        data_loader: Paired loader, e.g. the validation split
+        device: Device both modules run on
+        example_shape: Latency input shape, defaults to one batch of the loader
+        n_runs: Timed forwards per module
+        output_path: Optional JSON file for the report
+
+    Returns:
+        dict: The report
+    """
+    mse, psnr, gaps = [], [], []
+    for batch in data_loader:
+        input_imgs, target_imgs, _, _ = split_batch(batch)
+        input_imgs, target_imgs = input_imgs.to(device), target_imgs.to(device)
+        if example_shape is None:
+            example_shape = tuple(input_imgs.shape)
+
+        teacher_input, teacher_target = (f.float() for f in teacher.flows(input_imgs, target_imgs))
+        student_input, student_target = (f.float() for f in student.flows(input_imgs, target_imgs))
+
+        for s, t in ((student_input, teacher_input), (student_target, teacher_target)):
+            mse.extend(((s - t) ** 2).flatten(1).mean(dim=1).tolist())
+            psnr.extend(calculate_psnr(si[0], ti[0]) for si, ti in zip(s.cpu().numpy(), t.cpu().numpy()))
+
+        teacher_loss = (normalize_flow_maps(teacher_input) - normalize_flow_maps(teacher_target)).abs().flatten(1).mean(dim=1)
+        student_loss = (normalize_flow_maps(student_input) - normalize_flow_maps(student_target)).abs().flatten(1).mean(dim=1)
+        gaps.extend((student_loss - teacher_loss).abs().tolist())
+
+    teacher_ms = measure_latency(teacher.module, example_shape, n_runs=n_runs, device=device)
+    student_ms = measure_latency(student.module, example_shape, n_runs=n_runs, device=device)
+    report = {
+        'flow_mse': float(np.mean(mse)),
+        'flow_psnr': float(np.mean(psnr)),
+        'constraint_gap': float(np.mean(gaps)),
+        'teacher_ms': teacher_ms,
+        'student_ms': student_ms,
+        'speedup': teacher_ms / student_ms,
+        'teacher_params': sum(p.numel() for p in teacher.parameters()),
+        'student_params': sum(p.numel() for p in student.parameters()),
+        'example_shape': list(example_shape),
+    }
+
+    print(f"Flow MSE: {report['flow_mse']:.6f}, flow PSNR: {report['flow_psnr']:.2f} dB, "
+          f"constraint gap: {report['constraint_gap']:.6f}")
+    print(f"Latency {tuple(example_shape)}: teacher {teacher_ms:.2f} ms, student {student_ms:.2f} ms "
+          f"({report['speedup']:.2f}x), parameters {report['teacher_params']} -> {report['student_params']}")
+
+    if output_path is not None:
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Distillation report saved to {output_path}")
+    return report
+
+def distil(config):
+    """
+    Distil the attention speckle module of 'ssm_checkpoint_path' into a small student.
+
+    Uses the n2 training data settings (start_patient, n_patients,
+    n_images_per_patient, batch_size). To train baselines with the student as
+    the constraint, set 'student_checkpoint_path' in the 'speckle_module'
+    section to the saved student; the downstream denoiser metrics then come
+    from the usual n2 training and evaluation.
+
+    Options:
+        distil_student / distil_student_kwargs: See ``build_student``
+        distil_epochs: Epochs (default 50)
+        distil_learning_rate: Adam learning rate (default 1e-3)
+        distil_checkpoint_path: Student checkpoint, see ``student_checkpoint_path``
+
+    Returns:
+        tuple: (student checkpoint path, report dict)
+    """
+    train_config = config['training']
+    device = train_config['device']
+    if torch.device(device).type == 'cuda' and not torch.cuda.is_available():
+        device = 'cpu'
+
+    start = train_config['start_patient'] if train_config['start_patient'] else 1
+    train_loader, val_loader = get_paired_loaders(start, train_config['n_patients'], train_config['n_images_per_patient'],
+                                                  train_config['batch_size'], return_index=True,
+                                                  cache_dir=train_config.get('dataset_cache', None))
+
+    teacher_path = train_config['ssm_checkpoint_path']
+    print(f"Loading teacher from {teacher_path}...")
+    teacher = FrozenSpeckleModule(load_speckle_module(teacher_path)).to(device)
+
+    student, model_name, model_kwargs = build_student(train_config)
+    student = student.to(device)
+    student.flow_only = True
+    print(f"Student: {model_name} {model_kwargs}")
+
+    checkpoint_path = student_checkpoint_path(train_config)
+    optimizer = optim.Adam(student.parameters(), lr=float(train_config.get('distil_learning_rate', 1e-3)))
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', patience=5, factor=0.5)
+    precision = get_precision_from_config(train_config, device)
+    profiler = get_profiler(train_config, checkpoint_path.replace('.pth', '_profile.jsonl'), device)
+
+    train_student(student, teacher, train_loader, val_loader, optimizer, train_config.get('distil_epochs', 50), device,
+                  checkpoint_path, model_name, model_kwargs, scheduler, precision, profiler)
+
+    student = FrozenSpeckleModule(load_speckle_module(checkpoint_path)).to(device)
+    report = distillation_report(student, teacher, val_loader, device,
+                                 output_path=checkpoint_path.replace('.pth', '_report.json'))
+    return checkpoint_path, report
+
+def train_distillation(config_path=None, override_config=None):
+
+    if config_path is None:
+        raise ValueError("Config path must be specified.")
+
+    config = get_config(config_path, override_config)
+
+    return distil(config)
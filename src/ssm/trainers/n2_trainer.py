@@ -1,4 +1,4 @@
-from ssm.data import get_paired_loaders
+from ssm.data import get_paired_loaders, get_patch_loaders, get_flow_loaders
 from ssm.utils.config import get_config
 from ssm.models.unet.unet import UNet
 from ssm.models.unet.unet_2 import UNet2
@@ -6,6 +6,7 @@ from ssm.models.unet.large_unet import LargeUNetAttention, LargeUNet2, LargeUNet
 from ssm.models.unet.large_unet_good import LargeUNet
 from ssm.models.unet.large_unet_attention import LargeUNetAtt
 from ssm.models.ssm.ssm_attention import SpeckleSeparationUNetAttention
+from ssm.models.ssm.frozen_ssm import FrozenSpeckleModule, load_speckle_module, speckle_checkpoint_path
 from ssm.models.unet.small_unet import SmallUNet
 from ssm.models.unet.small_unet_att import SmallUNetAtt
 
@@ -24,6 +25,81 @@ import torch
 
 import random
 from ssm.utils import load_sdoct_dataset, normalize_image_np
+from ssm.utils.precision import get_precision, get_precision_from_config
+from ssm.utils.profiler import set_anomaly_detection
+from ssm.utils.resume import get_training_state
+from ssm.utils.compile import get_compiled_model, FULL_IMAGE_SIZE
+from ssm.utils.distributed import (
+    get_distributed, main_process_first, distributed_loader, wrap_model, cleanup_distributed
+)
+from ssm.utils.batch_size_finder import find_max_micro_batch
+
+N2_MODELS = {
+    'UNet': UNet,
+    'UNet2': UNet2,
+    'LargeUNet': LargeUNet,
+    'LargeUNetAttention': LargeUNetAttention,
+    'LargeUNetNoAttention': LargeUNet2,
+    'LargeUNet2': LargeUNet2,
+    'LargeUNet3': LargeUNet3,
+    'SmallUNet': SmallUNet,
+    'SmallUNetAtt': SmallUNetAtt,
+    'LargeUNetAtt': LargeUNetAtt,
+}
+
+def build_n2_model(name, device='cuda'):
+    """Instantiate a single-channel denoiser from the ``train_n2`` model table."""
+    if name not in N2_MODELS:
+        raise ValueError("Model not found")
+    return N2_MODELS[name](in_channels=1, out_channels=1).to(device)
+
+def find_n2_micro_batch(name, patch_size, precision='fp32', device=None, memory_budget_mb=None, model=None):
+    """
+    Largest training micro-batch of ``patch_size`` patches for a model of the ``train_n2`` table.
+
+    ``model`` is probed if given (e.g. the one about to be trained), otherwise a fresh one is built.
+    """
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if model is None:
+        model = build_n2_model(name, device)
+    return find_max_micro_batch(model, (1, patch_size, patch_size), device, get_precision(precision, device),
+                                memory_budget_mb, model_name=name)
+
+def n2_checkpoint_path(config, method, ssm=False):
+    """
+    Checkpoint prefix of a ``train_n2`` run, e.g. ``<baselines>/<ablation>/n2n_UNet_ssm``.
+
+    The 'checkpoint_suffix' training option is appended, so runs that differ
+    in other settings (e.g. sweep trials over alpha) keep separate checkpoints.
+    """
+    train_config = config['training']
+    ablation = train_config['ablation'].format(n=train_config['n_patients'], n_images=train_config['n_images_per_patient'])
+    checkpoint_path = train_config['baselines_checkpoint_path'] + ablation + rf"/{method}_{train_config['model']}"
+    if config['speckle_module']['use'] is True or ssm:
+        checkpoint_path = checkpoint_path + "_ssm"
+    return checkpoint_path + (train_config.get('checkpoint_suffix', None) or '')
+
+def n2_last_checkpoint_path(checkpoint_path, patch):
+    """Last-epoch checkpoint written by the (patch) trainers for a checkpoint prefix."""
+    return checkpoint_path + ('_patched_last_checkpoint.pth' if patch else '_last_checkpoint.pth')
+
+def n2_input_shape(train_config):
+    """
+    Model input shape of a ``train_n2`` step: a micro-batch of patches, or a batch of full images.
+
+    The micro-batch dimension is only exact once 'micro_batch_size' is an
+    integer ('auto' is resolved by ``train``); otherwise it is 1.
+    """
+    if train_config['patch']:
+        micro_batch_size = train_config.get('micro_batch_size', None)
+        size = micro_batch_size if isinstance(micro_batch_size, int) else 1
+        return (size, 1, train_config['patch_size'], train_config['patch_size'])
+    return (train_config['batch_size'], 1, FULL_IMAGE_SIZE, FULL_IMAGE_SIZE)
+
+def n2_state_path(checkpoint_path, patch):
+    """Resumable training state written by the (patch) trainers for a checkpoint prefix."""
+    return checkpoint_path + ('_patched_state.pth' if patch else '_state.pth')
 
 def train_n2(config_path=None, schema=None, ssm=False, override_config=None):
     
@@ -51,7 +127,35 @@ def train(config, method, ssm):
     start = train_config['start_patient'] if train_config['start_patient'] else 1
     ablation = train_config['ablation'].format(n=n_patients, n_images=n_images_per_patient)
 
-    train_loader, val_loader = get_paired_loaders(start, n_patients, n_images_per_patient, batch_size)
+    # One process per rank under torchrun, a single process otherwise
+    device = get_distributed(train_config)
+
+    # Rank 0 builds shared caches (e.g. the flow-map store) before the other ranks read them
+    with main_process_first():
+        if train_config.get('patch_sampler', False):
+            # Fixed-size batches of random crops instead of exhaustive grid patches
+            train_loader, val_loader = get_patch_loaders(
+                start, n_patients, n_images_per_patient, batch_size,
+                patch_batch_size=train_config.get('patch_batch_size', 32),
+                patch_size=train_config['patch_size'],
+                patches_per_image=train_config.get('patches_per_image', 8),
+                patches_per_epoch=train_config.get('patches_per_epoch', None),
+                num_workers=train_config.get('num_workers', 0),
+                cache_dir=train_config.get('dataset_cache', None))
+        elif train_config.get('precompute_flow', False) and (config['speckle_module']['use'] is True or ssm):
+            # Input flow maps are read from the flow-map store instead of recomputed each step
+            train_loader, val_loader = get_flow_loaders(
+                start, speckle_checkpoint_path(config), n_patients, n_images_per_patient, batch_size,
+                device=device, cache_dir=train_config.get('dataset_cache', None))
+        else:
+            # Dataset indices let the frozen speckle module cache flow maps of the inputs
+            use_ssm = config['speckle_module']['use'] is True or ssm
+            train_loader, val_loader = get_paired_loaders(start, n_patients, n_images_per_patient, batch_size,
+                                                          return_index=use_ssm,
+                                                          cache_dir=train_config.get('dataset_cache', None))
+    # Every rank trains on its own shard of the data
+    train_loader = distributed_loader(train_loader)
+    val_loader = distributed_loader(val_loader)
     print(f"Train loader size: {len(train_loader.dataset)}")
     sample = next(iter(train_loader))[0].shape
     print(f"Sample shape: {sample}")
@@ -62,39 +166,13 @@ def train(config, method, ssm):
 
     model = train_config['model']
 
-    checkpoint_path = baselines_checkpoint_path + rf"/{method}_"
-
     if not os.path.exists(baselines_checkpoint_path):
-        os.makedirs(baselines_checkpoint_path)
+        os.makedirs(baselines_checkpoint_path, exist_ok=True)
 
-    if config['speckle_module']['use'] is True or ssm:
-        checkpoint_path = checkpoint_path + rf"{model}_ssm"
-        print("Checkpoint path: ", checkpoint_path)
-    else:
-        checkpoint_path = checkpoint_path + rf"{model}"
-
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-    if train_config['model'] == 'UNet':
-        model = UNet(in_channels=1, out_channels=1).to(device)
-    elif train_config['model'] == 'UNet2':
-        model = UNet2(in_channels=1, out_channels=1).to(device)
-    elif train_config['model'] == 'LargeUNet':
-        model = LargeUNet(in_channels=1, out_channels=1).to(device)
-    elif train_config['model'] == 'LargeUNetAttention':
-        model = LargeUNetAttention(in_channels=1, out_channels=1).to(device)
-    elif train_config['model'] == 'LargeUNetNoAttention' or train_config['model'] == 'LargeUNet2':
-        model = LargeUNet2(in_channels=1, out_channels=1).to(device)
-    elif train_config['model'] == 'LargeUNet3':
-        model = LargeUNet3(in_channels=1, out_channels=1).to(device)
-    elif train_config['model'] == 'SmallUNet':
-        model = SmallUNet(in_channels=1, out_channels=1).to(device)
-    elif train_config['model'] == 'SmallUNetAtt':
-        model = SmallUNetAtt(in_channels=1, out_channels=1).to(device)
-    elif train_config['model'] == 'LargeUNetAtt':
-        model = LargeUNetAtt(in_channels=1, out_channels=1).to(device)
-    else:
-        raise ValueError("Model not found")
+    checkpoint_path = n2_checkpoint_path(config, method, ssm)
+    print("Checkpoint path: ", checkpoint_path)
+
+    model = build_n2_model(train_config['model'], device)
 
 
     sdoct_path = r"C:\Datasets\OCTData\boe-13-12-6357-d001\Sparsity_SDOCT_DATASET_2012"
@@ -148,13 +226,13 @@ def train(config, method, ssm):
         f.write(f"Number of images per patient: {n_images_per_patient}\n")
 
     if config['speckle_module']['use'] is True or ssm:
-        speckle_module = SpeckleSeparationUNetAttention(input_channels=1, feature_dim=32).to(device)
         try:
-            print("Loading ssm model from checkpoint...")
-            ssm_checkpoint_path = train_config['ssm_checkpoint_path']
-            ssm_checkpoint = torch.load(ssm_checkpoint_path, map_location=device)
-            speckle_module.load_state_dict(ssm_checkpoint['model_state_dict'])
-            speckle_module.to(device)
+            # A distilled student checkpoint, if configured, replaces the attention module
+            ssm_checkpoint_path = speckle_checkpoint_path(config)
+            print(f"Loading ssm model from {ssm_checkpoint_path}...")
+            speckle_module = load_speckle_module(ssm_checkpoint_path, device)
+            # Eval mode, BatchNorm folded, one no-grad forward per step
+            speckle_module = FrozenSpeckleModule(speckle_module).to(device)
             alpha = config['speckle_module']['alpha']
         except Exception as e:
             print(f"Error loading model: {e}")
@@ -180,7 +258,71 @@ def train(config, method, ssm):
             print(f"Error loading model: {e}")
             print("Starting training from scratch.")
 
+    precision = get_precision_from_config(train_config, device)
+    print(f"Precision: {precision.precision}, channels_last: {precision.channels_last}")
+
+    epochs = train_config['epochs']
+    # Full training state (scheduler, RNG, loader position, best scores), saved every
+    # state_every_n_steps steps when resumable; an existing state continues mid-epoch.
+    # 'epochs' counts from the loaded checkpoint, so the state keeps the absolute last epoch
+    training_state = get_training_state(
+        train_config, n2_state_path(checkpoint_path, train_config['patch']), model, optimizer, scheduler, precision,
+        extra={'best_val_loss': best_val_loss, 'best_metrics_score': best_metrics_score,
+               'target_epoch': starting_epoch + epochs})
+    # Otherwise continue an interrupted run from its last checkpoint, for the remaining epochs
+    last_checkpoint_path = n2_last_checkpoint_path(checkpoint_path, train_config['patch'])
+    if training_state.load(device):
+        starting_epoch = training_state.epoch
+        best_val_loss = training_state.extra['best_val_loss']
+        best_metrics_score = training_state.extra['best_metrics_score']
+        epochs = max(training_state.extra['target_epoch'] - starting_epoch, 0)
+    elif train_config.get('resume', False) and os.path.exists(last_checkpoint_path):
+        checkpoint = torch.load(last_checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        # Last checkpoints record the absolute last epoch of their run
+        target_epoch = checkpoint.get('target_epoch', epochs)
+        starting_epoch = checkpoint['epoch'] + 1
+        best_val_loss = checkpoint.get('best_val_loss', best_val_loss)
+        best_metrics_checkpoint_path = checkpoint_path + '_patched_best_metrics_checkpoint.pth'
+        if os.path.exists(best_metrics_checkpoint_path):
+            best_metrics_score = torch.load(best_metrics_checkpoint_path, map_location='cpu').get(
+                'metrics_score', best_metrics_score)
+        epochs = max(target_epoch - starting_epoch, 0)
+        print(f"Resuming from {last_checkpoint_path} at epoch {starting_epoch}, {epochs} epochs left")
+
+    if epochs == 0:
+        # A resumed run that already finished (e.g. a completed sweep trial) has nothing to train
+        print(f"Training already finished at epoch {starting_epoch}, nothing to resume")
+        training_state.close()
+        cleanup_distributed()
+        return model
+
     print("Alpha: ", alpha)
+    # Anomaly detection slows every backward, so it only runs when asked for
+    set_anomaly_detection(train_config)
+
+    if train_config['patch'] and train_config.get('micro_batch_size', None) == 'auto':
+        # Probed once on the bare model so the patch trainers and the compiled shape share one size
+        train_config['micro_batch_size'] = find_n2_micro_batch(
+            train_config['model'], train_config['patch_size'], precision, device,
+            train_config.get('memory_budget_mb', None), model=model)
+        print(f"Micro-batch size: {train_config['micro_batch_size']}")
+
+    model = wrap_model(precision.prepare_model(model), device, train_config.get('sync_batchnorm', False))
+    # Opt-in torch.compile (TorchScript fallback) for the fixed training input shape. A micro-batch
+    # size chosen later by the runner (from the memory budget) is unknown here, so compile for dynamic shapes
+    compile_config = train_config
+    if train_config['patch'] and not isinstance(train_config.get('micro_batch_size', None), int):
+        compile_config = dict(train_config, compile_dynamic=True)
+    model = get_compiled_model(model, compile_config, n2_input_shape(train_config), training=True)
+    if speckle_module is not None:
+        # The frozen module gets inputs and outputs concatenated, or only the uncached inputs, so its
+        # batch size varies: compile for dynamic shapes, warmed up at the input-plus-output batch
+        flow_shape = n2_input_shape(train_config)
+        flow_shape = (2 * flow_shape[0],) + tuple(flow_shape[1:])
+        speckle_module.module = get_compiled_model(
+            speckle_module.module, dict(compile_config, compile_dynamic=True), flow_shape)
     
     if train_config['train']:
         patch = train_config['patch']
@@ -194,7 +336,7 @@ def train(config, method, ssm):
                     optimizer=optimizer,
                     criterion=train_config['criterion'],
                     starting_epoch=starting_epoch,
-                    epochs=train_config['epochs'], 
+                    epochs=epochs, 
                     batch_size=train_config['batch_size'], 
                     lr=train_config['learning_rate'],
                     best_val_loss=best_val_loss,
@@ -209,7 +351,11 @@ def train(config, method, ssm):
                     train_config=train_config,
                     sample=raw_image,
                     patch_size=train_config['patch_size'],
-                    stride=train_config['stride'])
+                    stride=train_config['stride'],
+                    tissue_threshold=train_config.get('tissue_threshold', None),
+                    background_keep=train_config.get('background_keep', 0.0),
+                    precision=precision,
+                    training_state=training_state)
             else:
                 model = train_n2n(
                     model,
@@ -218,7 +364,7 @@ def train(config, method, ssm):
                     optimizer=optimizer,
                     criterion=train_config['criterion'],
                     starting_epoch=starting_epoch,
-                    epochs=train_config['epochs'], 
+                    epochs=epochs, 
                     batch_size=train_config['batch_size'], 
                     lr=train_config['learning_rate'],
                     best_val_loss=best_val_loss,
@@ -230,7 +376,9 @@ def train(config, method, ssm):
                     save=save,
                     scheduler=scheduler,
                     best_metrics_score=best_metrics_score,
-                    train_config=train_config
+                    train_config=train_config,
+                    precision=precision,
+                    training_state=training_state
                     )
             
         elif method == "n2v":
@@ -244,7 +392,7 @@ def train(config, method, ssm):
                     optimizer=optimizer,
                     criterion=train_config['criterion'],
                     starting_epoch=starting_epoch,
-                    epochs=train_config['epochs'], 
+                    epochs=epochs, 
                     batch_size=train_config['batch_size'], 
                     lr=train_config['learning_rate'],
                     best_val_loss=best_val_loss,
@@ -265,6 +413,10 @@ def train(config, method, ssm):
                     patch_size=train_config['patch_size'], 
                     stride=train_config['stride'],
                     patience_count=train_config['patience'],
+                    tissue_threshold=train_config.get('tissue_threshold', None),
+                    background_keep=train_config.get('background_keep', 0.0),
+                    precision=precision,
+                    training_state=training_state
                     )
             else:
                 model = train_n2v(
@@ -274,7 +426,7 @@ def train(config, method, ssm):
                     optimizer=optimizer,
                     criterion=train_config['criterion'],
                     starting_epoch=starting_epoch,
-                    epochs=train_config['epochs'], 
+                    epochs=epochs, 
                     batch_size=train_config['batch_size'], 
                     lr=train_config['learning_rate'],
                     best_val_loss=best_val_loss,
@@ -289,7 +441,9 @@ def train(config, method, ssm):
                     threshold=train_config['threshold'],
                     mask_ratio=train_config['mask_ratio'],
                     best_metrics_score=best_metrics_score,
-                    scheduler=scheduler)
+                    scheduler=scheduler,
+                    precision=precision,
+                    training_state=training_state)
         elif method == "n2s":
             if patch:
                 model = train_n2s_patch(
@@ -299,7 +453,7 @@ def train(config, method, ssm):
                     optimizer=optimizer,
                     criterion=train_config['criterion'],
                     starting_epoch=starting_epoch,
-                    epochs=train_config['epochs'], 
+                    epochs=epochs, 
                     batch_size=train_config['batch_size'], 
                     lr=train_config['learning_rate'],
                     best_val_loss=best_val_loss,
@@ -315,7 +469,11 @@ def train(config, method, ssm):
                     best_metrics_score=best_metrics_score,
                     patch_size=train_config['patch_size'], 
                     stride=train_config['stride'], 
-                    n_partitions=train_config['n_partitions']
+                    n_partitions=train_config['n_partitions'],
+                    tissue_threshold=train_config.get('tissue_threshold', None),
+                    background_keep=train_config.get('background_keep', 0.0),
+                    precision=precision,
+                    training_state=training_state
                     )
                 
             else:
@@ -326,7 +484,7 @@ def train(config, method, ssm):
                     optimizer=optimizer,
                     criterion=train_config['criterion'],
                     starting_epoch=starting_epoch,
-                    epochs=train_config['epochs'], 
+                    epochs=epochs, 
                     batch_size=train_config['batch_size'], 
                     lr=train_config['learning_rate'],
                     best_val_loss=best_val_loss,
@@ -335,6 +493,10 @@ def train(config, method, ssm):
                     visualise=visualise,
                     speckle_module=speckle_module,
                     alpha=alpha,
-                    save=save)
-            
+                    save=save,
+                    precision=precision,
+                    training_state=training_state)
+
+    training_state.close()
+    cleanup_distributed()
     return model
\ No newline at end of file
@@ -1,4 +1,5 @@
 
+import os
 from IPython.display import clear_output
 import random
 import torch
@@ -18,6 +19,15 @@ from torch.utils.data import random_split
 
 from ssm.utils import paired_preprocessing, visualize_attention_maps, subset_blind_spot_masking
 from ssm.utils.config import get_config
+from ssm.utils.precision import get_precision, get_precision_from_config
+from ssm.utils.checkpoint import CheckpointWriter
+from ssm.data.tensor_loader import get_tensor_loaders
+from ssm.utils.profiler import NullProfiler, get_profiler, set_anomaly_detection
+from ssm.utils.resume import NullTrainingState, get_training_state
+from ssm.utils.compile import get_compiled_model
+from ssm.utils.distributed import (
+    get_distributed, distributed_loader, wrap_model, unwrap_model, all_reduce_mean, cleanup_distributed
+)
 
 
 from ssm.utils import paired_octa_preprocessing, paired_octa_preprocessing_binary
@@ -26,14 +36,17 @@ from ssm.models.unet.large_unet_old import LargeUNetAttention
 
 
 
-def process_batch(dataloader, model, history, epoch, num_epochs, optimizer, loss_fn, loss_parameters, debug, n2v_weight, fast, visualise, mode='train'):
+def process_batch(dataloader, model, history, epoch, num_epochs, optimizer, loss_fn, loss_parameters, debug, n2v_weight, fast, visualise, mode='train',
+                  precision=None, profiler=None):
+    precision = get_precision(precision, next(model.parameters()).device)
+    profiler = profiler or NullProfiler()
     running_loss = 0.0
     running_flow_loss = 0.0
     running_noise_loss = 0.0
     
     is_training = mode == 'train'
     
-    progress_bar = tqdm(dataloader, desc=f"{mode.capitalize()} Epoch {epoch+1}/{num_epochs}")
+    progress_bar = tqdm(profiler.batches(dataloader, epoch, mode), desc=f"{mode.capitalize()} Epoch {epoch+1}/{num_epochs}")
     print(f"{mode.capitalize()}...")
     
     for batch_inputs, batch_targets in progress_bar:
@@ -49,31 +62,36 @@ def process_batch(dataloader, model, history, epoch, num_epochs, optimizer, loss
             #outputs = model(masked_inputs)
             print(batch_inputs.shape)
             
-            outputs = model(batch_inputs)
-
-            flow_component = outputs['flow_component']
-            noise_component = outputs['noise_component']
-
-            if loss_fn.__name__ == 'custom_loss':
-                total_loss = loss_fn(
-                    flow_component, 
-                    noise_component, 
-                    batch_inputs, 
-                    batch_targets, 
-                    loss_parameters=loss_parameters, 
-                    debug=debug)
-            else:
-                total_loss = loss_fn(
-                    flow_component, 
-                    batch_targets)
+            with precision.autocast(), profiler.phase('forward'):
+                outputs = model(precision.prepare_input(batch_inputs))
+
+            # Losses in fp32
+            with profiler.phase('loss'):
+                flow_component = outputs['flow_component'].float()
+                noise_component = outputs['noise_component'].float()
+
+                if loss_fn.__name__ == 'custom_loss':
+                    total_loss = loss_fn(
+                        flow_component, 
+                        noise_component, 
+                        batch_inputs, 
+                        batch_targets, 
+                        loss_parameters=loss_parameters, 
+                        debug=debug)
+                else:
+                    total_loss = loss_fn(
+                        flow_component, 
+                        batch_targets)
 
         if is_training and optimizer:
             # Debug parameter changes before step (first epoch only)
             if debug and epoch == 0:
                 params_before = [p.clone().detach() for p in model.parameters()]
             
-            total_loss.backward()
-            optimizer.step()
+            with profiler.phase('backward'):
+                precision.backward(total_loss)
+            with profiler.phase('step'):
+                precision.step(optimizer)
             
             # Debug parameter changes after step (first epoch only)
             if debug and epoch == 0:
@@ -126,7 +144,9 @@ def process_batch(dataloader, model, history, epoch, num_epochs, optimizer, loss
 from ssm.utils.data_utils.patch_processing import extract_patches, reconstruct_from_patches
 from ssm.utils.eval_utils.visualise import visualize_progress_patch, visualize_progress
 
-def process_batch_patch(dataloader, model, history, epoch, num_epochs, optimizer, loss_fn, loss_parameters, debug, n2v_weight, fast, visualise, mode='train'):
+def process_batch_patch(dataloader, model, history, epoch, num_epochs, optimizer, loss_fn, loss_parameters, debug, n2v_weight, fast, visualise, mode='train',
+                        precision=None):
+    precision = get_precision(precision, next(model.parameters()).device)
     running_loss = 0.0
     running_flow_loss = 0.0
     running_noise_loss = 0.0
@@ -159,14 +179,15 @@ def process_batch_patch(dataloader, model, history, epoch, num_epochs, optimizer
             patch_batch_size = 16  # Adjust based on your GPU memory
             for i in range(0, len(input_patches), patch_batch_size):
                 # Get current batch of patches
-                batch_input_patch = input_patches[i:i+patch_batch_size]
+                batch_input_patch = precision.prepare_input(input_patches[i:i+patch_batch_size])
                 
                 # Forward pass
-                outputs = model(batch_input_patch)
+                with precision.autocast():
+                    outputs = model(batch_input_patch)
                 
                 # Store output patches
-                flow_patches.append(outputs['flow_component'])
-                noise_patches.append(outputs['noise_component'])
+                flow_patches.append(outputs['flow_component'].float())
+                noise_patches.append(outputs['noise_component'].float())
             
             # Concatenate patch outputs
             flow_patches = torch.cat(flow_patches, dim=0)
@@ -191,8 +212,8 @@ def process_batch_patch(dataloader, model, history, epoch, num_epochs, optimizer
             if debug and epoch == 0:
                 params_before = [p.clone().detach() for p in model.parameters()]
             
-            total_loss.backward()
-            optimizer.step()
+            precision.backward(total_loss)
+            precision.step(optimizer)
             
             # Debug parameter changes after step (first epoch only)
             if debug and epoch == 0:
@@ -267,7 +288,8 @@ def process_batch_patch(dataloader, model, history, epoch, num_epochs, optimizer
     return avg_loss
 
 def train(train_dataloader, val_dataloader, checkpoint, checkpoint_path, model, history, optimizer, 
-          set_epoch, num_epochs, loss_fn, loss_parameters, debug, n2v_weight, fast, visualise):
+          set_epoch, num_epochs, loss_fn, loss_parameters, debug, n2v_weight, fast, visualise, precision=None,
+          profiler=None, training_state=None):
     
     # Setup checkpoint paths
     last_checkpoint = checkpoint_path.replace('.pth', f'_last.pth')
@@ -277,23 +299,28 @@ def train(train_dataloader, val_dataloader, checkpoint, checkpoint_path, model,
     best_loss = checkpoint['best_loss'] if 'best_loss' in checkpoint else float('inf')
     best_epoch = checkpoint['epoch'] if 'epoch' in checkpoint else 0
     
-    # Enable anomaly detection for debugging if needed
-    torch.autograd.set_detect_anomaly(True)
+    precision = get_precision(precision, next(model.parameters()).device)
+    profiler = profiler or NullProfiler()
+    training_state = training_state or NullTrainingState()
+    model = precision.prepare_model(model)
     
     # Add validation loss to history if not present
     if 'val_loss' not in history:
         history['val_loss'] = []
     
+    checkpoint_writer = CheckpointWriter()
     for epoch in range(set_epoch, num_epochs):
         print(f"Epoch {epoch+1}/{num_epochs}")
         
         
         train_loss = process_batch(
-            train_dataloader, model, history, 
+            training_state.batches(train_dataloader, epoch), model, history, 
             epoch, num_epochs, optimizer, 
             loss_fn, loss_parameters, debug, 
             n2v_weight, fast, visualise,
-            mode='train'
+            mode='train',
+            precision=precision,
+            profiler=profiler
         )
         
         # Validation phase
@@ -302,32 +329,29 @@ def train(train_dataloader, val_dataloader, checkpoint, checkpoint_path, model,
             epoch, num_epochs, None,  # No optimizer for validation 
             loss_fn, loss_parameters, False,  # No debug during validation
             n2v_weight, fast, visualise,
-            mode='val'
+            mode='val',
+            precision=precision,
+            profiler=profiler
         )
         
+        # Losses averaged over ranks so best-model decisions agree
+        train_loss = all_reduce_mean(train_loss)
+        val_loss = all_reduce_mean(val_loss)
         history['val_loss'].append(val_loss)
         
+        # Best and last of one epoch are written once from a shared snapshot
+        checkpoint_paths = []
         if val_loss < best_loss:
             best_loss = val_loss
             best_epoch = epoch + 1
             print(f"New best model found at epoch {best_epoch} with validation loss {best_loss:.6f}")
-            
-            checkpoint = {
-                'epoch': best_epoch,
-                'model_state_dict': model.state_dict(),
-                'best_loss': best_loss,
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'optimizer_state_dict': optimizer.state_dict(),
-                'history': history,
-            }
-            torch.save(checkpoint, best_checkpoint)
+            checkpoint_paths.append(best_checkpoint)
             print(f"Best model checkpoint saved at {best_checkpoint}")
 
         # Save last checkpoint
         checkpoint = {
             'epoch': epoch + 1,  # Save epoch + 1 so we can resume from next epoch
-            'model_state_dict': model.state_dict(),
+            'model_state_dict': unwrap_model(model).state_dict(),
             'best_loss': best_loss,
             'best_epoch': best_epoch,
             'train_loss': train_loss,
@@ -336,12 +360,18 @@ def train(train_dataloader, val_dataloader, checkpoint, checkpoint_path, model,
             'history': history
         }
         
-        torch.save(checkpoint, last_checkpoint)
+        checkpoint_paths.append(last_checkpoint)
+        with profiler.phase('checkpoint'):
+            checkpoint_writer.save(checkpoint, *checkpoint_paths)
         print(f"Latest model checkpoint saved at {last_checkpoint}")
+        training_state.end_epoch(epoch, best_loss=best_loss, best_epoch=best_epoch, history=history)
+        profiler.end_epoch(epoch, train_loss=train_loss, val_loss=val_loss)
     
+    checkpoint_writer.close()
+    profiler.close()
     return model, history
 
-def get_loaders(dataset, batch_size, val_split=0.2, device='cuda', seed=42):
+def get_loaders(dataset, batch_size, val_split=0.2, device='cuda', seed=42, memory_budget_mb=None):
 
     torch.manual_seed(seed)
     np.random.seed(seed)
@@ -368,31 +398,15 @@ def get_loaders(dataset, batch_size, val_split=0.2, device='cuda', seed=42):
     #inputs = torch.stack(input_tensors).to(device)
     #targets = torch.stack(target_tensors).to(device)
 
-    inputs = torch.stack(input_tensors).permute(0, 3, 1, 2).to(device)
-    targets = torch.stack(target_tensors).permute(0, 3, 1, 2).to(device)
-    
-    full_dataset = TensorDataset(inputs, targets)
+    inputs = torch.stack(input_tensors).permute(0, 3, 1, 2).contiguous()
+    targets = torch.stack(target_tensors).permute(0, 3, 1, 2).contiguous()
 
-    dataset_size = len(full_dataset)
-    val_size = int(val_split * dataset_size)
-    train_size = dataset_size - val_size
-    
-    train_dataset, val_dataset = random_split(full_dataset, [train_size, val_size])
-    
-    # Create dataloaders
-    train_loader = DataLoader(
-        train_dataset, 
-        batch_size=batch_size, 
-        shuffle=True
-    )
-    
-    val_loader = DataLoader(
-        val_dataset, 
-        batch_size=batch_size,
-        shuffle=False  # No need to shuffle validation data
-    )
-    
-    print(f"Dataset split: {train_size} training samples, {val_size} validation samples")
+    # Batches are sliced straight from the stacked tensors, on device when they fit
+    train_loader, val_loader = get_tensor_loaders(
+        [inputs, targets], batch_size, val_split=val_split, device=device, seed=seed,
+        memory_budget_mb=memory_budget_mb)
+
+    print(f"Dataset split: {train_loader.num_samples} training samples, {val_loader.num_samples} validation samples")
     
     return train_loader, val_loader
 
@@ -400,6 +414,9 @@ def get_loaders(dataset, batch_size, val_split=0.2, device='cuda', seed=42):
 def train_speckle_separation_module(train_config, loss_fn, loss_name):
 
     device = train_config['device']
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        # One process per rank, each on its own device
+        device = get_distributed(train_config)
 
     n_patients = train_config['n_patients']
 
@@ -416,7 +433,10 @@ def train_speckle_separation_module(train_config, loss_fn, loss_name):
     batch_size = train_config['batch_size']
     
     #dataloader = get_loaders(dataset, batch_size, device)
-    train_loader, val_loader = get_loaders(dataset, batch_size, val_split=0.2, device=device)
+    train_loader, val_loader = get_loaders(dataset, batch_size, val_split=0.2, device=device,
+                                           memory_budget_mb=train_config.get('device_dataset_budget_mb', None))
+    train_loader = distributed_loader(train_loader)
+    val_loader = distributed_loader(val_loader)
     
     history = {
         'loss': [],
@@ -436,6 +456,7 @@ def train_speckle_separation_module(train_config, loss_fn, loss_name):
     if model_name == 'SSMSimple':
         if train_config['load_model']:
             checkpoint_path = train_config['checkpoint'].format(loss_fn=loss_name)
+            checkpoint = torch.load(checkpoint_path, map_location='cpu')
             model = get_ssm_model_simple(checkpoint_path=checkpoint_path)
             model.to(device)
             optimizer = optim.Adam(model.parameters(), lr=learning_rate)
@@ -455,6 +476,7 @@ def train_speckle_separation_module(train_config, loss_fn, loss_name):
     if model_name == 'SSMAttention':
         if train_config['load_model']:
             checkpoint_path = train_config['checkpoint'].format(loss_fn=loss_name)
+            checkpoint = torch.load(checkpoint_path, map_location='cpu')
             model = get_ssm_model_attention(checkpoint_path=checkpoint_path)
             model.to(device)
             optimizer = optim.Adam(model.parameters(), lr=learning_rate)
@@ -509,10 +531,38 @@ def train_speckle_separation_module(train_config, loss_fn, loss_name):
     visualise = train_config['visualise']
     loss_parameters = train_config['loss_parameters']
 
+    precision = get_precision_from_config(train_config, device)
+
+    # Anomaly detection slows every backward, so it only runs when asked for
+    set_anomaly_detection(train_config)
+    profiler = get_profiler(train_config, base_checkpoint_path.replace('.pth', '_profile.jsonl'), device)
+
+    # Resumable state saved every state_every_n_steps steps; an existing one continues mid-epoch.
+    # The state keeps the absolute last epoch, which load_model continuation moved past num_epochs
+    training_state = get_training_state(
+        train_config, base_checkpoint_path.replace('.pth', '_state.pth'), model, optimizer, precision=precision,
+        extra={'best_loss': best_loss, 'best_epoch': checkpoint.get('best_epoch', set_epoch), 'history': history,
+               'target_epoch': num_epochs})
+    if training_state.load(device):
+        set_epoch = training_state.epoch
+        num_epochs = training_state.extra['target_epoch']
+        history = training_state.extra['history']
+        checkpoint['best_loss'] = training_state.extra['best_loss']
+        checkpoint['epoch'] = training_state.extra['best_epoch']
+
+    model = wrap_model(precision.prepare_model(model), device, train_config.get('sync_batchnorm', False),
+                       find_unused_parameters=loss_fn.__name__ != 'custom_loss')
+    # Opt-in torch.compile (TorchScript fallback) for the shape of a training batch
+    model = get_compiled_model(model, train_config, (batch_size,) + tuple(train_loader.tensors[0].shape[1:]),
+                               training=True)
+
     train(train_loader, val_loader, checkpoint, base_checkpoint_path, model, history, 
           optimizer, set_epoch, num_epochs, 
           loss_fn, loss_parameters, debug, 
-          n2v_weight, fast, visualise)
+          n2v_weight, fast, visualise, precision, profiler, training_state)
+
+    training_state.close()
+    cleanup_distributed()
     
 #############
 
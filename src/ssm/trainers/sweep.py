@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import itertools
+import copy
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+from ssm.utils.config import get_config
+from ssm.utils.batch_size_finder import default_memory_budget_mb
+from ssm.data.paired_dataset import cache_paired_dataset
+from ssm.trainers.n2_trainer import train_n2, n2_checkpoint_path, n2_last_checkpoint_path
+
+N2_SCHEMAS = ('n2n', 'n2v', 'n2s')
+
+# Short grid keys and the config entries they override
+SWEEP_KEYS = {
+    'n_patients': ('training', 'n_patients'),
+    'n_images_per_patient': ('training', 'n_images_per_patient'),
+    'model': ('training', 'model'),
+    'patch_size': ('training', 'patch_size'),
+    'alpha': ('speckle_module', 'alpha'),
+}
+
+def _merge(base, override):
+    merged = copy.deepcopy(base or {})
+    for section, values in (override or {}).items():
+        merged.setdefault(section, {}).update(values)
+    return merged
+
+def expand_grid(grid, base_override=None):
+    """
+    Trials of every combination of the values in ``grid``.
+
+    ``grid`` maps 'schema' (required), 'ssm', the short keys of ``SWEEP_KEYS``
+    or 'section.key' config entries to lists of values.
+
+    Every trial's 'checkpoint_suffix' encodes its swept values other than
+    'schema' and 'ssm', so trials keep separate checkpoints.
+
+    Returns:
+        list: Trial dicts with 'schema', 'ssm', 'params' and the 'override' config
+    """
+    if 'schema' not in grid:
+        raise ValueError("The sweep grid needs a 'schema' entry")
+    keys = list(grid)
+    trials = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        params = dict(zip(keys, values))
+        override = copy.deepcopy(base_override or {})
+        for key, value in params.items():
+            if key in ('schema', 'ssm'):
+                continue
+            section, name = SWEEP_KEYS[key] if key in SWEEP_KEYS else key.split('.', 1)
+            override.setdefault(section, {})[name] = value
+        training = override.setdefault('training', {})
+        training['checkpoint_suffix'] = (training.get('checkpoint_suffix', None) or '') + trial_suffix(params)
+        trials.append({
+            'schema': params['schema'],
+            'ssm': params.get('ssm', False),
+            'params': params,
+            'override': override,
+        })
+    return trials
+
+def trial_name(trial):
+    return ', '.join(f"{key}={value}" for key, value in trial['params'].items())
+
+def trial_suffix(params):
+    """Checkpoint suffix of a trial, e.g. ``_alpha-0.5_patch_size-64``; empty when only schema and ssm vary."""
+    parts = []
+    for key, value in params.items():
+        if key in ('schema', 'ssm'):
+            continue
+        value = str(value).replace('/', '-').replace('\\', '-').replace(' ', '')
+        parts.append(f"_{key.replace('.', '_')}-{value}")
+    return ''.join(parts)
+
+def trial_done_path(checkpoint_path, patch):
+    """Marker written when a sweep trial has finished, per checkpoint prefix and patch mode."""
+    return checkpoint_path + ('_patched_done.json' if patch else '_done.json')
+
+def sweep_workers(n_trials, memory_per_trial_mb=8192, threads_per_trial=4, trials_per_gpu=1, max_workers=None):
+    """
+    Concurrent trials that fit the machine: bounded by CPU cores, available memory and GPUs.
+    """
+    by_cpu = (os.cpu_count() or 1) // max(threads_per_trial, 1)
+    by_memory = int(default_memory_budget_mb('cpu') // memory_per_trial_mb)
+    workers = min(by_cpu, by_memory, n_trials)
+    if torch.cuda.is_available():
+        workers = min(workers, torch.cuda.device_count() * trials_per_gpu)
+    if max_workers is not None:
+        workers = min(workers, max_workers)
+    return max(workers, 1)
+
+def _init_worker(gpu_queue, threads_per_trial):
+    # Pin each worker to one GPU before CUDA is initialised in it
+    if gpu_queue is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_queue.get())
+    torch.set_num_threads(threads_per_trial)
+
+def _run_trial(config_path, trial, checkpoint_path, patch):
+    start_time = time.time()
+    result = {
+        'name': trial_name(trial),
+        'params': trial['params'],
+        'checkpoint_path': checkpoint_path,
+        'resumed': trial['override'].get('training', {}).get('resume', False),
+    }
+    try:
+        train_n2(config_path=config_path, schema=trial['schema'], ssm=trial['ssm'], override_config=trial['override'])
+    except Exception as e:
+        result.update(status='failed', error=repr(e), elapsed=time.time() - start_time)
+        return result
+
+    result.update(status='done', elapsed=time.time() - start_time)
+    with open(trial_done_path(checkpoint_path, patch), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+def run_sweep(config_path, grid, base_override=None, max_workers=None, memory_per_trial_mb=8192,
+              threads_per_trial=4, trials_per_gpu=1, cache_dir=None, log_path=None):
+    """
+    Train every trial of a grid of ``train_n2`` overrides, several at a time.
+
+    Before any trial starts, the preprocessed paired dataset of every distinct
+    (start patient, patient count, images per patient) is written once to a
+    ``.npy`` cache (``cache_paired_dataset``). Trials memory-map it through the
+    'dataset_cache' option instead of each rebuilding it.
+
+    Trials run in a process pool sized by ``sweep_workers``, one GPU per
+    worker when CUDA is available. A trial whose done marker exists is
+    skipped. A trial with a last checkpoint but no marker was interrupted and
+    is resumed from that checkpoint.
+
+    Args:
+        config_path: ``train_n2`` config file
+        grid: Values to sweep, see ``expand_grid``
+        base_override: Override dict applied to every trial
+        max_workers: Upper bound on concurrent trials
+        memory_per_trial_mb: Host memory one trial needs
+        threads_per_trial: Torch CPU threads per trial
+        trials_per_gpu: Concurrent trials sharing one GPU
+        cache_dir: Root of the dataset cache, defaults to ``$DATASET_DIR_PATH/paired_cache``
+        log_path: JSONL file the trial results are appended to
+
+    Returns:
+        list: Result dict of every trial
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.environ["DATASET_DIR_PATH"], "paired_cache")
+
+    pending = []
+    results = []
+    data_keys = set()
+    trial_paths = {}
+    for trial in expand_grid(grid, base_override):
+        config = get_config(config_path, trial['override'])
+        train_config = config['training']
+        checkpoint_path = n2_checkpoint_path(config, trial['schema'], trial['ssm'])
+        patch = train_config['patch']
+
+        # Trials sharing a checkpoint prefix would overwrite each other's checkpoints and markers
+        key = (checkpoint_path, patch)
+        if key in trial_paths:
+            raise ValueError(f"Trials '{trial_paths[key]}' and '{trial_name(trial)}' share the checkpoint "
+                             f"path {checkpoint_path}")
+        trial_paths[key] = trial_name(trial)
+
+        if os.path.exists(trial_done_path(checkpoint_path, patch)):
+            print(f"Skipping finished trial: {trial_name(trial)}")
+            results.append({'name': trial_name(trial), 'params': trial['params'],
+                            'checkpoint_path': checkpoint_path, 'status': 'skipped'})
+            continue
+
+        resume = os.path.exists(n2_last_checkpoint_path(checkpoint_path, patch))
+        trial['override'] = _merge(trial['override'], {'training': {'dataset_cache': cache_dir, 'resume': resume}})
+        data_keys.add((train_config['start_patient'] or 1, train_config['n_patients'],
+                       train_config['n_images_per_patient']))
+        pending.append((trial, checkpoint_path, patch))
+
+    for start, n_patients, n_images_per_patient in sorted(data_keys):
+        cache_paired_dataset(start, n_patients, n_images_per_patient, cache_dir=cache_dir)
+
+    if pending:
+        workers = sweep_workers(len(pending), memory_per_trial_mb, threads_per_trial, trials_per_gpu, max_workers)
+        print(f"Running {len(pending)} trials on {workers} workers")
+
+        ctx = mp.get_context('spawn')
+        gpu_queue = None
+        if torch.cuda.is_available():
+            gpu_queue = ctx.Queue()
+            for i in range(workers):
+                gpu_queue.put(i % torch.cuda.device_count())
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(gpu_queue, threads_per_trial)) as pool:
+            futures = {pool.submit(_run_trial, config_path, trial, checkpoint_path, patch): trial
+                       for trial, checkpoint_path, patch in pending}
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(f"Trial {result['status']}: {result['name']} ({result['elapsed'] / 60:.1f} min)")
+                if result['status'] == 'failed':
+                    print(f"  {result['error']}")
+                if log_path is not None:
+                    with open(log_path, 'a') as f:
+                        f.write(json.dumps(result) + '\n')
+
+    for result in results:
+        print(f"{result['status']:>8}  {result['name']}")
+    return results
+
+def train_all_n2(config_path=None, ssm=False, override_config=None, schemas=N2_SCHEMAS, max_workers=1):
+    """Train every n2 schema for one config override, skipping finished and resuming interrupted runs."""
+    return run_sweep(config_path, {'schema': list(schemas), 'ssm': [ssm]}, base_override=override_config,
+                     max_workers=max_workers)
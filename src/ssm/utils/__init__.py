@@ -9,5 +9,6 @@ from .data_utils.pfn import *
 from .eval_utils.evaluate import *
 from .eval_utils.visualise import *
 from .eval_utils.metrics import *
+from .eval_utils.tiled_inference import *
 from .data_utils.patch_processing import *
 from .noise import *
\ No newline at end of file
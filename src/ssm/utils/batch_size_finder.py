@@ -0,0 +1,214 @@
+import os
+import json
+import resource
+import torch
+
+from ssm.utils.precision import get_precision
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ssm', 'micro_batch_sizes.json')
+
+def _is_oom(error):
+    return isinstance(error, MemoryError) or 'out of memory' in str(error).lower()
+
+def _read_proc_kb(path, field):
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, from /proc or getrusage."""
+    kb = _read_proc_kb('/proc/self/status', 'VmHWM')
+    if kb is None:
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb / 1024
+
+def current_rss_mb():
+    kb = _read_proc_kb('/proc/self/status', 'VmRSS')
+    return kb / 1024 if kb is not None else peak_rss_mb()
+
+def default_memory_budget_mb(device='cuda', fraction=0.9):
+    """Budget for a probe: a fraction of total CUDA memory, or of available system memory on CPU."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory / 2**20 * fraction
+    available_kb = _read_proc_kb('/proc/meminfo', 'MemAvailable')
+    if available_kb is None:
+        return 4096
+    return available_kb / 1024 * fraction
+
+def _device_name(device):
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return f"cuda:{torch.cuda.get_device_name(device)}"
+    return device.type
+
+def _cache_key(model_name, item_shape, device, precision, memory_budget_mb=None):
+    shape = 'x'.join(str(s) for s in item_shape)
+    # Sizes probed under one budget do not hold for another
+    budget = 'default' if memory_budget_mb is None else f"{round(memory_budget_mb)}MB"
+    return f"{model_name}|{shape}|{_device_name(device)}|{precision.precision}|{budget}"
+
+def _load_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache(cache_path, cache):
+    if cache_path is None:
+        return
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+def _output_tensor(outputs):
+    if isinstance(outputs, dict):
+        return outputs.get('flow_component', next(iter(outputs.values())))
+    if isinstance(outputs, (list, tuple)):
+        return outputs[-1]
+    return outputs
+
+def probe_micro_batch(model, size, item_shape, device='cuda', precision=None):
+    """
+    One training forward/backward pass with a random batch of ``size`` items.
+
+    Returns:
+        float or None: Peak memory of the pass in MB, or None if it ran out of memory
+    """
+    device = torch.device(device)
+    precision = get_precision(precision, device)
+    try:
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline = 0
+        else:
+            baseline = current_rss_mb() if reset_peak_rss() else peak_rss_mb()
+
+        # Probes may run from validation code under no_grad
+        with torch.enable_grad():
+            x = precision.prepare_input(torch.rand((size,) + tuple(item_shape), device=device))
+            with precision.autocast():
+                outputs = model(x)
+            loss = _output_tensor(outputs).float().mean()
+            loss.backward()
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            peak = torch.cuda.max_memory_allocated(device) / 2**20
+        else:
+            peak = peak_rss_mb() - baseline
+        return peak
+    except (RuntimeError, MemoryError) as e:
+        if not _is_oom(e):
+            raise
+        return None
+    finally:
+        x = outputs = loss = None
+        model.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+def find_max_micro_batch(model, item_shape, device='cuda', precision=None, memory_budget_mb=None,
+                         model_name=None, max_size=1024, cache_path=DEFAULT_CACHE_PATH, overwrite=False):
+    """
+    Largest micro-batch whose training step fits into a memory budget.
+
+    The batch size is doubled until a trial forward/backward pass runs out of
+    memory, exceeds the budget (CUDA peak allocation, or peak RSS growth on
+    CPU) or reaches ``max_size``, then binary-searched between the last size
+    that fitted and the first that did not. BatchNorm running statistics are
+    restored and gradients cleared afterwards.
+
+    Results are cached in a JSON file per (model, item shape, device, precision,
+    memory budget).
+
+    Args:
+        model: Model to probe, already on ``device``
+        item_shape: Shape of one item, e.g. (1, patch_size, patch_size)
+        device: Device the model runs on
+        precision: ``PrecisionContext`` or precision name
+        memory_budget_mb: Budget in MB, or None for ``default_memory_budget_mb(device)``
+        model_name: Name used in the cache key, defaults to the model class name
+        max_size: Upper bound on the result
+        cache_path: JSON cache file, or None to disable caching
+        overwrite: Probe again even if a cached result exists
+
+    Returns:
+        int: Micro-batch size (at least 1)
+    """
+    precision = get_precision(precision, device)
+    model_name = model_name or type(model).__name__
+    key = _cache_key(model_name, item_shape, device, precision, memory_budget_mb)
+
+    cache = _load_cache(cache_path)
+    if key in cache and not overwrite:
+        print(f"Using cached micro-batch size {cache[key]} for {key}")
+        return cache[key]
+
+    if memory_budget_mb is None:
+        memory_budget_mb = default_memory_budget_mb(device)
+
+    was_training = model.training
+    buffers = {name: b.detach().clone() for name, b in model.named_buffers()}
+    model.train()
+
+    def fits(size):
+        peak = probe_micro_batch(model, size, item_shape, device, precision)
+        ok = peak is not None and peak <= memory_budget_mb
+        print(f"Micro-batch {size}: {'fits' if ok else 'too large'}"
+              + (f" ({peak:.0f} MB of {memory_budget_mb:.0f} MB)" if peak is not None else " (out of memory)"))
+        return ok
+
+    try:
+        good, bad = 0, None
+        size = 1
+        while size <= max_size:
+            if not fits(size):
+                bad = size
+                break
+            good = size
+            size *= 2
+
+        if bad is not None:
+            # Back off between the last size that fitted and the first that did not
+            while bad - good > 1:
+                mid = (good + bad) // 2
+                if fits(mid):
+                    good = mid
+                else:
+                    bad = mid
+    finally:
+        with torch.no_grad():
+            for name, b in model.named_buffers():
+                if name in buffers:
+                    b.copy_(buffers[name])
+        model.train(was_training)
+
+    result = max(good, 1)
+    print(f"Largest micro-batch for {key}: {result}")
+
+    cache = _load_cache(cache_path)
+    cache[key] = result
+    _save_cache(cache_path, cache)
+
+    return result
@@ -0,0 +1,125 @@
+import os
+import queue
+import shutil
+import threading
+import torch
+
+from ssm.utils.distributed import is_main_process
+
+def snapshot_state(obj):
+    """
+    Copy of a checkpoint dict with every tensor cloned to CPU.
+
+    Nested dicts, lists and tuples (optimizer state, history) are copied
+    recursively so training can keep mutating the originals while the
+    snapshot is written.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_state(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [snapshot_state(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(snapshot_state(v) for v in obj)
+    return obj
+
+def _link_or_copy(src, dst):
+    tmp_path = dst + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+def atomic_save(state, *paths):
+    """
+    Save ``state`` once to ``paths[0]`` and hard-link it to the other paths.
+
+    Each file is written under a temporary name and renamed into place, so a
+    crash never leaves a truncated checkpoint behind.
+    """
+    first = paths[0]
+    directory = os.path.dirname(first)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = first + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, first)
+    for path in paths[1:]:
+        _link_or_copy(first, path)
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread.
+
+    ``save`` snapshots the state to CPU on the calling thread and returns; the
+    snapshot is serialised by a worker thread with ``atomic_save``. Checkpoints
+    that share a snapshot (e.g. best and last of the same epoch) are passed
+    together and written once. At most ``max_pending`` snapshots are queued;
+    further ``save`` calls block until the worker catches up. Errors from the
+    worker are raised by the next ``save``, ``wait`` or ``close``. In
+    distributed training only rank 0 writes.
+
+    Args:
+        max_pending: Maximum number of queued snapshots
+        background: Write on the calling thread instead when False
+    """
+    def __init__(self, max_pending=2, background=True):
+        self.background = background
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                state, paths = item
+                atomic_save(state, *paths)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"Checkpoint write failed: {error}") from error
+
+    def save(self, state, *paths):
+        """Snapshot ``state`` and write it to every path in ``paths``."""
+        self._raise_error()
+        paths = [p for p in paths if p is not None]
+        if not paths or not is_main_process():
+            return
+        snapshot = snapshot_state(state)
+        if self.background:
+            self.queue.put((snapshot, paths))
+        else:
+            atomic_save(snapshot, *paths)
+
+    def wait(self):
+        """Block until all queued checkpoints are written."""
+        if self.background:
+            self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
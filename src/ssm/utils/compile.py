@@ -0,0 +1,215 @@
+import os
+import torch
+import torch.nn as nn
+
+# Inputs the models are trained and evaluated on: full B-scans and square patches
+FULL_IMAGE_SIZE = 256
+
+def enable_compile_cache(cache_dir=None):
+    """
+    Persist compiled graphs between runs.
+
+    Turns on the inductor FX graph and autotuning caches and, if ``cache_dir``
+    is given, stores them there instead of the default temporary directory,
+    so a second run with the same models and shapes skips recompilation.
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+        os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+def _outputs(result):
+    # Models return a tensor, or a dict of tensors (speckle module)
+    if isinstance(result, dict):
+        return [result[k] for k in sorted(result) if isinstance(result[k], torch.Tensor)]
+    if isinstance(result, (list, tuple)):
+        return [r for r in result if isinstance(r, torch.Tensor)]
+    return [result]
+
+class TracedModel(nn.Module):
+    """
+    TorchScript fallback for models ``torch.compile`` cannot handle.
+
+    Tracing bakes the train/eval behaviour of dropout and batch norm into the
+    graph, so one trace is kept per mode and picked by ``self.training``. Both
+    traces share the parameters of the original module, which stays reachable
+    as ``_orig_mod`` (like a ``torch.compile`` module) for state dicts.
+    """
+    def __init__(self, model, example):
+        super().__init__()
+        self._orig_mod = model
+        self.example_shape = tuple(example.shape)
+        self._traces = {}
+        self.train(model.training)
+
+    def _trace(self, training, example):
+        was_training = self._orig_mod.training
+        self._orig_mod.train(training)
+        buffers = {name: b.clone() for name, b in self._orig_mod.named_buffers()}
+        # check_trace would rerun the model; outputs differ in train mode because of dropout
+        traced = torch.jit.trace(self._orig_mod, example, strict=False, check_trace=False)
+        with torch.no_grad():
+            for name, b in self._orig_mod.named_buffers():
+                b.copy_(buffers[name])
+        self._orig_mod.train(was_training)
+        return traced
+
+    def forward(self, x):
+        if self.training not in self._traces:
+            self._traces[self.training] = self._trace(self.training, x)
+        return self._traces[self.training](x)
+
+def compile_model(model, example_shape, mode='default', backend='inductor', dynamic=False, fallback='trace',
+                  warmup=True, training=False, cache_dir=None):
+    """
+    Compiled version of ``model`` for a fixed input shape.
+
+    ``torch.compile`` is tried first, with static shapes unless ``dynamic``.
+    If it is unavailable or the warm-up fails, the model is traced with
+    TorchScript instead (``fallback='trace'``) or returned unchanged
+    (``fallback=None``). The compiled model shares its parameters with
+    ``model``; ``unwrap_model`` returns the original for state dicts.
+
+    The warm-up runs the example shape once (forward and backward when
+    ``training``) so compilation happens here rather than in the first step.
+    Batch-norm statistics and gradients touched by the warm-up are restored.
+
+    Args:
+        model: Model on its device
+        example_shape: Input shape, e.g. (batch_size, 1, 256, 256)
+        mode: ``torch.compile`` mode, e.g. 'default', 'reduce-overhead', 'max-autotune'
+        backend: ``torch.compile`` backend
+        dynamic: Allow dynamic shapes instead of recompiling per input shape
+        fallback: 'trace' for TorchScript, or None for eager
+        warmup: Compile with an example input now
+        training: Warm up the training graph (forward and backward)
+        cache_dir: Persistent compile cache directory
+
+    Returns:
+        nn.Module: Compiled (or traced, or original) model
+    """
+    enable_compile_cache(cache_dir)
+    device = next(model.parameters()).device
+    example = torch.randn(*example_shape, device=device)
+
+    compiled = None
+    if hasattr(torch, 'compile'):
+        try:
+            compiled = torch.compile(model, mode=mode, backend=backend, dynamic=dynamic)
+            if warmup:
+                _warmup(compiled, model, example, training)
+            print(f"Compiled {type(model).__name__} with torch.compile ({backend}, mode={mode}) for {tuple(example_shape)}")
+        except Exception as e:
+            print(f"torch.compile failed for {type(model).__name__}: {e}")
+            compiled = None
+
+    if compiled is None and fallback == 'trace':
+        try:
+            compiled = TracedModel(model, example)
+            if warmup:
+                _warmup(compiled, model, example, training)
+            print(f"Traced {type(model).__name__} with TorchScript for {tuple(example_shape)}")
+        except Exception as e:
+            print(f"TorchScript tracing failed for {type(model).__name__}: {e}")
+            compiled = None
+
+    if compiled is None:
+        print(f"Running {type(model).__name__} eagerly")
+        return model
+    return compiled
+
+def _warmup(compiled, model, example, training):
+    was_training = model.training
+    buffers = {name: b.clone() for name, b in model.named_buffers()}
+    compiled.train(training)
+    if training:
+        _outputs(compiled(example))[0].float().mean().backward()
+        model.zero_grad(set_to_none=True)
+    compiled.eval()
+    with torch.no_grad():
+        compiled(example)
+    with torch.no_grad():
+        for name, b in model.named_buffers():
+            b.copy_(buffers[name])
+    compiled.train(was_training)
+
+@torch.no_grad()
+def verify_compiled(model, compiled, example_shape, atol=1e-4, rtol=1e-3, seed=0, training=False):
+    """
+    Compare outputs of ``compiled`` against eager ``model`` on a random input.
+
+    Eval mode by default; ``training=True`` compares train-mode outputs (batch
+    statistics in BatchNorm), which only agree for models without dropout.
+    Buffers updated by the comparison are restored.
+
+    Returns:
+        tuple: (ok, max_abs_diff)
+    """
+    device = next(model.parameters()).device
+    generator = torch.Generator(device='cpu').manual_seed(seed)
+    example = torch.rand(*example_shape, generator=generator).to(device)
+    was_training = model.training
+    buffers = {name: b.clone() for name, b in model.named_buffers()}
+    model.train(training)
+    compiled.train(training)
+    expected = _outputs(model(example))
+    actual = _outputs(compiled(example))
+    for name, b in model.named_buffers():
+        b.copy_(buffers[name])
+    model.train(was_training)
+    compiled.train(was_training)
+
+    ok = len(expected) == len(actual)
+    max_diff = 0.0
+    for e, a in zip(expected, actual):
+        e, a = e.float(), a.float()
+        max_diff = max(max_diff, (e - a).abs().max().item())
+        ok = ok and torch.allclose(e, a, atol=atol, rtol=rtol)
+    return ok, max_diff
+
+def get_compiled_model(model, config=None, example_shape=None, training=False):
+    """
+    ``compile_model`` with the 'compile*' options, or ``model`` itself when 'compile' is off.
+
+    The compiled model is checked against eager execution with
+    ``verify_compiled``; if outputs differ beyond the tolerance the eager
+    model is used.
+
+    Options:
+        compile: Enable compiled execution
+        compile_mode: ``torch.compile`` mode (default 'default')
+        compile_backend: ``torch.compile`` backend (default 'inductor')
+        compile_dynamic: Dynamic shapes (default False, recompile per shape)
+        compile_fallback: 'trace' (default) or None
+        compile_cache_dir: Persistent compile cache directory
+        compile_atol / compile_rtol: Tolerance of the eager comparison (default 1e-4 / 1e-3)
+    """
+    if config is None or not config.get('compile', False):
+        return model
+    if example_shape is None:
+        example_shape = (1, 1, FULL_IMAGE_SIZE, FULL_IMAGE_SIZE)
+    compiled = compile_model(
+        model, example_shape,
+        mode=config.get('compile_mode', 'default'),
+        backend=config.get('compile_backend', 'inductor'),
+        dynamic=config.get('compile_dynamic', False),
+        fallback=config.get('compile_fallback', 'trace'),
+        training=training,
+        cache_dir=config.get('compile_cache_dir', None)
+    )
+    if compiled is model:
+        return model
+    ok, max_diff = verify_compiled(model, compiled, example_shape,
+                                   atol=config.get('compile_atol', 1e-4), rtol=config.get('compile_rtol', 1e-3))
+    if not ok:
+        print(f"Compiled outputs differ from eager by up to {max_diff:.2e}, running eagerly")
+        return model
+    print(f"Compiled outputs match eager (max abs diff {max_diff:.2e})")
+    return compiled
@@ -1,4 +1,6 @@
 import torch
+import torch.nn.functional as F
+from collections import OrderedDict
 
 def extract_patches(image, patch_size=64, stride=32):
     """Extract patches from an image with given patch size and stride."""
@@ -174,63 +176,280 @@ def _reconstruct_from_patches(patches, locations, image_shape, patch_size):
 ############
 
 
-def extract_patches(image, patch_size, stride):
+def _as_batched_image(image):
+    """Return ``image`` as a (B, C, H, W) tensor."""
+    if len(image.shape) == 4:  # (B, C, H, W)
+        return image
+    elif len(image.shape) == 3:  # (C, H, W)
+        return image.unsqueeze(0)
+    elif len(image.shape) == 2:  # (H, W)
+        return image.unsqueeze(0).unsqueeze(0)
+    raise ValueError(f"Unexpected image shape: {image.shape}")
+
+def patch_positions(length, patch_size, stride):
+    """
+    Top-left offsets of the patches along one image axis.
+
+    Regular grid positions every ``stride`` pixels, plus the last valid
+    position when the grid does not reach the image edge.
+    """
+    if length < patch_size:
+        raise ValueError(f"Patch size {patch_size} is larger than image dimension {length}")
+    positions = list(range(0, length - patch_size + 1, stride))
+    if length - patch_size > 0 and (length - patch_size) % stride != 0:
+        positions.append(length - patch_size)
+    return positions
+
+def patch_locations(image_shape, patch_size, stride, device=None):
     """
-    Extract patches from images with consistent sampling and optimal performance.
+    Build the (N, 3) integer tensor of patch locations for a batch of images.
+
+    Args:
+        image_shape: (B, C, H, W) shape of the batch
+        patch_size: Size of square patches
+        stride: Stride between patches
+        device: Device of the returned tensor
+
+    Returns:
+        torch.LongTensor: rows of (batch_idx, y, x), ordered by batch, then y, then x
+    """
+    b, _, h, w = image_shape
+    ys = torch.tensor(patch_positions(h, patch_size, stride), dtype=torch.long, device=device)
+    xs = torch.tensor(patch_positions(w, patch_size, stride), dtype=torch.long, device=device)
+    bs = torch.arange(b, dtype=torch.long, device=device)
+    grid = torch.meshgrid(bs, ys, xs, indexing='ij')
+    return torch.stack(grid, dim=-1).reshape(-1, 3)
+
+def gather_patches(windows, locations):
+    """
+    Materialise patches from a sliding-window view.
+
+    Args:
+        windows: View of shape (B, C, H - p + 1, W - p + 1, p, p) from ``extract_patches(..., contiguous=False)``
+        locations: (N, 3) tensor of (batch_idx, y, x), or a slice of it
+
+    Returns:
+        torch.Tensor: Contiguous patches of shape (N, C, p, p)
+    """
+    b, y, x = locations.to(windows.device).unbind(1)
+    return windows[b, :, y, x]
+
+def patch_cache_keys(indices, locations):
+    """
+    Hashable (dataset index, y, x) key per patch, for caching per-patch results.
+    
+    Args:
+        indices: Dataset index of each image in the batch, or None
+        locations: (N, 3) tensor of (batch_idx, y, x)
+        
+    Returns:
+        list or None: One key per patch, None when ``indices`` is None
+    """
+    if indices is None:
+        return None
+    indices = torch.as_tensor(indices).tolist()
+    return [(indices[b], y, x) for b, y, x in torch.as_tensor(locations).tolist()]
+
+def extract_patches(image, patch_size=64, stride=32, contiguous=True):
+    """
+    Extract patches from images with a single strided view and one gather.
     
     Args:
         image: Input tensor of shape (B, C, H, W), (C, H, W), or (H, W)
         patch_size: Size of square patches to extract
         stride: Stride between patch centers
+        contiguous: If False, return the zero-copy sliding-window view instead
+            of the stacked patches; use ``gather_patches`` on slices of the
+            locations to materialise only the patches a model step needs.
         
     Returns:
-        tuple: (patches tensor of shape [N, C, patch_size, patch_size], 
-                list of patch locations [(batch_idx, y, x), ...])
+        tuple: (patches tensor of shape [N, C, patch_size, patch_size] or the
+                window view, LongTensor of patch locations of shape [N, 3]
+                holding (batch_idx, y, x))
     """
-    # Standardize input format
-    if len(image.shape) == 4:  # (B, C, H, W)
-        b, c, h, w = image.shape
-    elif len(image.shape) == 3:  # (C, H, W)
-        image = image.unsqueeze(0)  # Add batch dimension
-        b, c, h, w = image.shape
-    elif len(image.shape) == 2:  # (H, W)
-        image = image.unsqueeze(0).unsqueeze(0)  # Add batch and channel dimensions
-        b, c, h, w = image.shape
-    else:
-        raise ValueError(f"Unexpected image shape: {image.shape}")
+    image = _as_batched_image(image)
     
-    # Calculate valid patch extraction points
-    y_positions = list(range(0, h - patch_size + 1, stride))
-    x_positions = list(range(0, w - patch_size + 1, stride))
+    locations = patch_locations(image.shape, patch_size, stride, device=image.device)
     
-    # Handle edge cases by adding the last valid position if it's not already included
-    if h - patch_size > 0 and (h - patch_size) % stride != 0:
-        y_positions.append(h - patch_size)
-    if w - patch_size > 0 and (w - patch_size) % stride != 0:
-        x_positions.append(w - patch_size)
+    # (B, C, H - p + 1, W - p + 1, p, p) view over every window position, no copy
+    windows = image.unfold(2, patch_size, 1).unfold(3, patch_size, 1)
     
-    # Pre-allocate for better memory efficiency
-    total_patches = b * len(y_positions) * len(x_positions)
-    all_patches = []
-    all_locations = []
+    if not contiguous:
+        return windows, locations
     
-    # Extract patches using efficient indexing
-    for batch_idx in range(b):
-        for y in y_positions:
-            for x in x_positions:
-                # Extract patch directly with proper indexing
-                patch = image[batch_idx:batch_idx+1, :, y:y+patch_size, x:x+patch_size].squeeze(0)
-                all_patches.append(patch)
-                all_locations.append((batch_idx, y, x))
+    return gather_patches(windows, locations), locations
+
+def patch_tissue_fraction(image, locations, patch_size, downsample=4, threshold=0.05, measure='intensity'):
+    """
+    Fraction of each patch covered by tissue, from a downsampled occupancy map.
     
-    # Stack tensors efficiently
-    patches_tensor = torch.stack(all_patches)
+    The image is average-pooled by ``downsample``; a low-resolution pixel counts
+    as tissue when its mean intensity (or local variance) exceeds ``threshold``.
+    The per-patch fraction is a box filter over that map, so the cost is a few
+    pooling calls regardless of the number of patches.
+    
+    Args:
+        image: (B, C, H, W) tensor the patches are taken from. Pass a
+            (N, C, p, p) patch batch with locations (i, 0, 0) to score patches directly.
+        locations: (N, 3) tensor of (batch_idx, y, x)
+        patch_size: Size of square patches
+        downsample: Pooling factor of the occupancy map
+        threshold: Intensity (or variance) above which a pixel is tissue
+        measure: 'intensity' or 'variance'
+        
+    Returns:
+        torch.Tensor: (N,) tissue fraction in [0, 1]
+    """
+    image = _as_batched_image(image)
+    if patch_size % downsample != 0:
+        downsample = 1
     
-    return patches_tensor, all_locations
+    with torch.no_grad():
+        intensity = image.float().mean(dim=1, keepdim=True)
+        low_res = F.avg_pool2d(intensity, downsample)
+        if measure == 'variance':
+            low_res = (F.avg_pool2d(intensity ** 2, downsample) - low_res ** 2).clamp_(min=0)
+        elif measure != 'intensity':
+            raise ValueError(f"Unknown tissue measure: {measure}")
+        
+        tissue = (low_res > threshold).float()
+        fraction_map = F.avg_pool2d(tissue, patch_size // downsample, stride=1)
+        
+        locations = torch.as_tensor(locations, dtype=torch.long, device=image.device)
+        b, y, x = locations.unbind(1)
+        y = (y // downsample).clamp_(max=fraction_map.shape[2] - 1)
+        x = (x // downsample).clamp_(max=fraction_map.shape[3] - 1)
+        return fraction_map[b, 0, y, x]
 
-def reconstruct_from_patches(patches, locations, image_shape, patch_size):
-    """Basic reconstruction from patches without special features."""
-    # Handle different shape formats
+def select_tissue_patches(fraction, tissue_threshold=0.1, background_keep=0.0, generator=None):
+    """
+    Boolean mask of the patches to train on.
+    
+    Patches with a tissue fraction of at least ``tissue_threshold`` are kept;
+    background patches are kept with probability ``background_keep`` so the
+    model still sees some empty regions. At least one patch is always kept.
+    """
+    keep = fraction >= tissue_threshold
+    if background_keep > 0:
+        draw = torch.rand(fraction.shape, generator=generator, device=fraction.device)
+        keep |= draw < background_keep
+    if not keep.any():
+        keep[fraction.argmax()] = True
+    return keep
+
+def filter_tissue_patches(image, locations, patch_size, tissue_threshold=0.1, background_keep=0.0,
+                          stats=None, **kwargs):
+    """
+    Drop background-only patch locations before the model sees them.
+    
+    Args:
+        image: (B, C, H, W) tensor the locations refer to
+        locations: (N, 3) tensor of (batch_idx, y, x)
+        patch_size: Size of square patches
+        tissue_threshold: Minimum tissue fraction for a patch to be kept
+        background_keep: Probability of keeping a background patch anyway
+        stats: Optional dict updated in place with 'patches' and 'skipped' counts
+        **kwargs: Passed to ``patch_tissue_fraction``
+        
+    Returns:
+        tuple: (kept locations, boolean keep mask)
+    """
+    fraction = patch_tissue_fraction(image, locations, patch_size, **kwargs)
+    keep = select_tissue_patches(fraction, tissue_threshold, background_keep)
+    if stats is not None:
+        stats['patches'] = stats.get('patches', 0) + len(keep)
+        stats['skipped'] = stats.get('skipped', 0) + int((~keep).sum())
+    return locations[keep.to(locations.device)], keep
+
+def print_skip_stats(stats, label="Tissue filter"):
+    """Print how many background patches were skipped."""
+    total = stats.get('patches', 0)
+    if total == 0:
+        return
+    skipped = stats.get('skipped', 0)
+    print(f"{label}: skipped {skipped}/{total} background patches ({100.0 * skipped / total:.1f}%)")
+
+_WEIGHT_CACHE_SIZE = 16
+_weight_cache = OrderedDict()
+
+def _position_groups(positions):
+    """
+    Split sorted patch offsets along one axis into runs with a constant step.
+
+    Grid positions form one regular run; the edge position appended by
+    ``patch_positions`` ends up in a run of its own.
+
+    Returns:
+        list: (first_index, count, first_offset, step) per run
+    """
+    groups = []
+    i = 0
+    n = len(positions)
+    while i < n:
+        if i + 1 < n:
+            step = positions[i + 1] - positions[i]
+            j = i + 1
+            while j + 1 < n and positions[j + 1] - positions[j] == step:
+                j += 1
+            groups.append((i, j - i + 1, positions[i], step))
+            i = j + 1
+        else:
+            groups.append((i, 1, positions[i], 1))
+            i += 1
+    return groups
+
+def _fold_grid(grid, ys, xs, out_h, out_w, patch_size):
+    """
+    Overlap-add a (B, ny, nx, C, p, p) patch grid into a (B, C, out_h, out_w) canvas.
+
+    Each pair of regular runs along y and x is a single ``F.fold`` call, so a
+    grid with one extra edge row and column takes at most four folds.
+    """
+    b, _, _, c, p, _ = grid.shape
+    canvas = grid.new_zeros((b, c, out_h, out_w))
+    for iy, ny, y0, sy in _position_groups(ys):
+        for ix, nx, x0, sx in _position_groups(xs):
+            block = grid[:, iy:iy + ny, ix:ix + nx]
+            # (B, ny, nx, C, p, p) -> (B, C * p * p, ny * nx) as expected by fold
+            block = block.permute(0, 3, 4, 5, 1, 2).reshape(b, c * p * p, ny * nx)
+            block_h = (ny - 1) * sy + p
+            block_w = (nx - 1) * sx + p
+            canvas[:, :, y0:y0 + block_h, x0:x0 + block_w] += F.fold(
+                block, output_size=(block_h, block_w), kernel_size=p, stride=(sy, sx)
+            )
+    return canvas
+
+def _overlap_weights(ys, xs, out_h, out_w, patch_size, device, dtype):
+    """Number of patches covering each pixel of a complete grid, cached per geometry."""
+    key = (out_h, out_w, patch_size, tuple(ys), tuple(xs), str(device), dtype)
+    weights = _weight_cache.get(key)
+    if weights is not None:
+        _weight_cache.move_to_end(key)
+        return weights
+    
+    ones = torch.ones((1, len(ys), len(xs), 1, patch_size, patch_size), device=device, dtype=dtype)
+    weights = _fold_grid(ones, ys, xs, out_h, out_w, patch_size).clamp_(min=1)
+    
+    _weight_cache[key] = weights
+    if len(_weight_cache) > _WEIGHT_CACHE_SIZE:
+        _weight_cache.popitem(last=False)
+    return weights
+
+def reconstruct_from_patches(patches, locations, image_shape, patch_size=64):
+    """
+    Reconstruct a batch of images from overlapping patches, averaging overlaps.
+    
+    Args:
+        patches: Tensor of shape (N, C, patch_size, patch_size)
+        locations: (N, 3) tensor or list of (batch_idx, y, x) as returned by
+            ``extract_patches``, or (N, 2) / list of (y, x) for a single image
+        image_shape: (B, C, H, W) or (C, H, W) shape of the output
+        patch_size: Size of square patches
+        
+    Returns:
+        torch.Tensor: (B, C, H, W) reconstruction, or (C, H, W) when
+        locations are (y, x) pairs
+    """
     if len(image_shape) == 4:  # (B, C, H, W)
         b, c, h, w = image_shape
     elif len(image_shape) == 3:  # (C, H, W)
@@ -239,61 +458,44 @@ def reconstruct_from_patches(patches, locations, image_shape, patch_size):
     else:
         raise ValueError(f"Unexpected image shape: {image_shape}")
     
-    # Check location format
-    sample_location = locations[0]
-    if len(sample_location) == 3:  # (batch_idx, y, x)
-        # Need to group by batch
-        batch_reconstructed = []
-        
-        # Group patches by batch index
-        batch_patches = [[] for _ in range(b)]
-        batch_locations = [[] for _ in range(b)]
-        
-        for i, (patch, location) in enumerate(zip(patches, locations)):
-            batch_idx, y, x = location
-            batch_patches[batch_idx].append(patch)
-            batch_locations[batch_idx].append((y, x))
-        
-        # Reconstruct each batch item
-        for i in range(b):
-            if len(batch_patches[i]) > 0:
-                # Call recursively with simpler locations
-                reconstructed = reconstruct_from_patches(
-                    torch.stack(batch_patches[i]), 
-                    batch_locations[i],
-                    (c, h, w),  # Single image shape
-                    patch_size
-                )
-                batch_reconstructed.append(reconstructed)
-            else:
-                # Empty tensor if no patches for this batch
-                batch_reconstructed.append(torch.zeros((c, h, w), device=patches[0].device))
-        
-        return torch.stack(batch_reconstructed)
+    device = patches.device
+    locations = torch.as_tensor(locations, dtype=torch.long, device=device)
     
-    elif len(sample_location) == 2:  # (y, x)
-        # Simple reconstruction for a single image
-        reconstructed = torch.zeros((c, h, w), device=patches[0].device)
-        weights = torch.zeros((h, w), device=patches[0].device)
-        
-        # Direct accumulation of patches
-        for patch, (y, x) in zip(patches, locations):
-            # Handle patches that might go beyond image boundaries
-            y_end = min(y + patch_size, h)
-            x_end = min(x + patch_size, w)
-            patch_h = y_end - y
-            patch_w = x_end - x
-            
-            # Add patch contribution
-            reconstructed[:, y:y_end, x:x_end] += patch[:, :patch_h, :patch_w]
-            weights[y:y_end, x:x_end] += 1
-        
-        # Normalize by weights
-        weights = weights.unsqueeze(0).repeat(c, 1, 1)
-        weights[weights == 0] = 1  # Avoid division by zero
-        reconstructed = reconstructed / weights
-        
-        return reconstructed
+    if locations.dim() != 2 or locations.shape[1] not in (2, 3):
+        raise ValueError(f"Unexpected location format: {tuple(locations.shape)}")
     
+    single_image = locations.shape[1] == 2
+    if single_image:  # (y, x)
+        b = 1
+        locations = torch.cat([locations.new_zeros((len(locations), 1)), locations], dim=1)
+    
+    batch_idx, y, x = locations.unbind(1)
+    ys = torch.unique(y)
+    xs = torch.unique(x)
+    iy = torch.searchsorted(ys, y)
+    ix = torch.searchsorted(xs, x)
+    ys = ys.tolist()
+    xs = xs.tolist()
+    
+    # Patches running past the image edge are folded into a padded canvas and cropped
+    out_h = max(h, ys[-1] + patch_size)
+    out_w = max(w, xs[-1] + patch_size)
+    
+    grid = patches.new_zeros((b, len(ys), len(xs), c, patch_size, patch_size))
+    grid[batch_idx, iy, ix] = patches
+    reconstructed = _fold_grid(grid, ys, xs, out_h, out_w, patch_size)
+    
+    if len(locations) == b * len(ys) * len(xs):
+        weights = _overlap_weights(ys, xs, out_h, out_w, patch_size, device, patches.dtype)
     else:
-        raise ValueError(f"Unexpected location format: {sample_location}")
+        # Sparse grid (e.g. skipped patches): weights depend on which patches are present
+        present = patches.new_zeros((b, len(ys), len(xs), 1, 1, 1))
+        present[batch_idx, iy, ix] = 1
+        ones = present.expand(-1, -1, -1, 1, patch_size, patch_size)
+        weights = _fold_grid(ones, ys, xs, out_h, out_w, patch_size).clamp_(min=1)
+    
+    reconstructed = (reconstructed / weights)[:, :, :h, :w]
+    
+    if single_image:
+        return reconstructed[0]
+    return reconstructed
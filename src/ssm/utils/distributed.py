@@ -0,0 +1,226 @@
+import os
+import builtins
+from contextlib import contextmanager, nullcontext
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data.distributed import DistributedSampler
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def _rank_zero_print():
+    """Silence ``print`` on all ranks but 0; ``print(..., force=True)`` still prints."""
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if force or is_main_process():
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+def setup_distributed(backend=None):
+    """
+    Join the process group described by the torchrun environment variables.
+
+    Does nothing when ``WORLD_SIZE`` is unset or 1. The backend defaults to
+    'nccl' with CUDA and 'gloo' otherwise, so several CPU processes on one
+    machine can train together. Each rank uses the GPU of its ``LOCAL_RANK``.
+
+    Returns:
+        torch.device: Device this rank trains on
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    use_cuda = torch.cuda.is_available() and backend != 'gloo'
+
+    if world_size > 1 and not is_distributed():
+        backend = backend or ('nccl' if use_cuda else 'gloo')
+        if use_cuda:
+            torch.cuda.set_device(local_rank)
+        dist.init_process_group(backend=backend)
+        # Install the rank-aware print first: the builtin one rejects force=True
+        _rank_zero_print()
+        print(f"Rank {get_rank()}/{world_size} joined the process group ({backend})", force=True)
+
+    if use_cuda:
+        return torch.device('cuda', local_rank if world_size > 1 else torch.cuda.current_device())
+    return torch.device('cpu')
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.barrier()
+        dist.destroy_process_group()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+@contextmanager
+def main_process_first():
+    """Run the enclosed block on rank 0 before the other ranks, e.g. to build shared caches."""
+    if not is_main_process():
+        barrier()
+    try:
+        yield
+    finally:
+        if is_main_process():
+            barrier()
+
+def _reduce_device():
+    backend = dist.get_backend()
+    return torch.device('cuda', torch.cuda.current_device()) if backend == 'nccl' else torch.device('cpu')
+
+def all_reduce_mean(value):
+    """Mean of a float over all ranks; ``value`` itself without a process group."""
+    if not is_distributed():
+        return value
+    tensor = torch.tensor(float(value), dtype=torch.float64, device=_reduce_device())
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / get_world_size()
+
+def all_reduce_max(value):
+    """Maximum of an int over all ranks; ``value`` itself without a process group."""
+    if not is_distributed():
+        return value
+    tensor = torch.tensor(int(value), dtype=torch.int64, device=_reduce_device())
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return int(tensor.item())
+
+def broadcast_object(obj, src=0):
+    """``obj`` of rank ``src`` on every rank."""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+def wrap_model(model, device, sync_batchnorm=False, find_unused_parameters=False):
+    """
+    ``DistributedDataParallel`` around ``model``, or ``model`` itself without a process group.
+
+    Args:
+        model: Model already on ``device``
+        device: Device of this rank
+        sync_batchnorm: Convert BatchNorm layers to ``SyncBatchNorm``
+        find_unused_parameters: Needed when part of the model does not contribute to the loss,
+            e.g. the noise branch of the speckle module trained with a flow-only loss
+    """
+    if not is_distributed():
+        return model
+    if sync_batchnorm:
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return DistributedDataParallel(model, device_ids=[device.index], output_device=device.index,
+                                       find_unused_parameters=find_unused_parameters)
+    return DistributedDataParallel(model, find_unused_parameters=find_unused_parameters)
+
+def unwrap_model(model):
+    """Underlying module of a ``DistributedDataParallel`` and/or compiled model, for state dicts."""
+    while True:
+        if isinstance(model, DistributedDataParallel):
+            model = model.module
+        elif hasattr(model, '_orig_mod'):
+            # torch.compile and TracedModel keep the original module as _orig_mod
+            model = model._orig_mod
+        else:
+            return model
+
+def is_ddp(model):
+    """Whether ``model``, possibly compiled, is wrapped in ``DistributedDataParallel``."""
+    return isinstance(getattr(model, '_orig_mod', model), DistributedDataParallel)
+
+def no_sync(model, skip=True):
+    """``model.no_sync()`` when ``skip`` and the model is wrapped in DDP, else a null context."""
+    model = getattr(model, '_orig_mod', model)
+    if skip and isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return nullcontext()
+
+class EpochDistributedSampler(DistributedSampler):
+    """
+    ``DistributedSampler`` that reshuffles on every pass.
+
+    The trainers do not call ``set_epoch`` on samplers, so the epoch is
+    advanced each time the loader is iterated.
+    """
+    def __iter__(self):
+        indices = super().__iter__()
+        self.set_epoch(self.epoch + 1)
+        return indices
+
+def distributed_loader(loader, seed=42):
+    """
+    Copy of ``loader`` that gives every rank a disjoint shard of its dataset.
+
+    Shuffling follows the original loader (``RandomSampler`` or not). Batch
+    size, workers, collate function and ``drop_last`` are kept, so every rank
+    sees the same number of batches. Returns ``loader`` unchanged without a
+    process group. Loaders with a ``shard(rank, world_size)`` method, such as
+    ``TensorBatchLoader``, shard themselves.
+    """
+    if not is_distributed():
+        return loader
+    if hasattr(loader, 'shard'):
+        return loader.shard(get_rank(), get_world_size())
+    shuffle = isinstance(loader.sampler, RandomSampler)
+    sampler = EpochDistributedSampler(
+        loader.dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed,
+        drop_last=loader.drop_last)
+    return DataLoader(
+        loader.dataset,
+        batch_size=loader.batch_size,
+        sampler=sampler,
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last
+    )
+
+def get_distributed(train_config=None):
+    """
+    Set up distributed training from the training options.
+
+    Options:
+        distributed_backend: 'nccl' or 'gloo', defaults by device
+
+    Returns:
+        torch.device: Device this rank trains on
+    """
+    backend = train_config.get('distributed_backend', None) if train_config else None
+    return setup_distributed(backend)
+
+def _launch_worker(local_rank, fn, args, nproc, master_addr, master_port):
+    os.environ.update({
+        'MASTER_ADDR': master_addr,
+        'MASTER_PORT': str(master_port),
+        'RANK': str(local_rank),
+        'LOCAL_RANK': str(local_rank),
+        'WORLD_SIZE': str(nproc),
+    })
+    fn(*args)
+
+def launch(fn, nproc, *args, master_addr='127.0.0.1', master_port=29500):
+    """
+    Run ``fn(*args)`` in ``nproc`` local processes that form one process group.
+
+    Each process gets the torchrun environment variables, so ``fn`` sets up
+    the group with ``setup_distributed``. Under torchrun (``WORLD_SIZE`` already
+    set) or with ``nproc`` 1, ``fn`` runs in the current process instead.
+    """
+    if nproc <= 1 or 'WORLD_SIZE' in os.environ:
+        return fn(*args)
+    import torch.multiprocessing as mp
+    mp.spawn(_launch_worker, args=(fn, args, nproc, master_addr, master_port), nprocs=nproc, join=True)
@@ -0,0 +1,209 @@
+import os
+import json
+import queue
+import numpy as np
+import multiprocessing as mp
+
+from ssm.utils.checkpoint import snapshot_state
+from ssm.utils.distributed import is_main_process
+
+def metrics_score(metrics):
+    """Weighted validation score used to pick the best-metrics checkpoint."""
+    return (
+        metrics.get('snr', 0) * 0.3 +
+        metrics.get('cnr', 0) * 0.3 +
+        metrics.get('enl', 0) * 0.2 +
+        metrics.get('epi', 0) * 0.2
+    )
+
+def _to_json(metrics):
+    return {k: (None if v is None or not np.isfinite(v) else float(v)) for k, v in metrics.items()}
+
+def _run_job(job, run_dir):
+    from ssm.utils.eval_utils.metrics import evaluate_oct_denoising
+    from ssm.utils.eval_utils.visualise import save_images
+
+    kind = job[0]
+    if kind == 'figure':
+        _, name, images, titles, losses, cols = job
+        path = os.path.join(run_dir, 'figures', f"{name}.png")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_images(images, titles, losses, path, cols=cols)
+        return None
+    if kind == 'metrics':
+        _, key, name, original, denoised = job
+        metrics = evaluate_oct_denoising(original, denoised)
+        path = os.path.join(run_dir, 'metrics', f"{name}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(_to_json(metrics), f, indent=2)
+        return key, metrics
+    raise ValueError(f"Unknown job: {kind}")
+
+def _worker_main(jobs, results, run_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        try:
+            result = _run_job(job, run_dir)
+        except Exception as e:
+            print(f"Metrics worker failed on {job[0]} job: {e}")
+            result = (job[1], None) if job[0] == 'metrics' else None
+        if result is not None:
+            results.put(result)
+
+class MetricsWorker:
+    """
+    Validation metrics and figures computed in a background process.
+
+    Jobs go through a bounded queue, so the training loop only blocks when
+    ``max_pending`` jobs are already waiting. Figures are written to
+    ``<run_dir>/figures/<name>.png`` and metrics to
+    ``<run_dir>/metrics/<name>.json``; metric results are also returned by
+    ``poll`` as ``(key, metrics)`` pairs (metrics is None if evaluation failed).
+
+    With ``background=False`` jobs run synchronously in the calling process,
+    which is useful for debugging.
+
+    Args:
+        run_dir: Directory for figures and metric JSON
+        max_pending: Maximum number of queued jobs
+        background: Run jobs in a worker process
+    """
+    def __init__(self, run_dir, max_pending=4, background=True):
+        self.run_dir = run_dir
+        self.background = background
+        self.pending = 0
+        self.done = []
+        os.makedirs(run_dir, exist_ok=True)
+        if background:
+            ctx = mp.get_context('spawn')
+            self.jobs = ctx.Queue(maxsize=max_pending)
+            self.results = ctx.Queue()
+            self.process = ctx.Process(target=_worker_main, args=(self.jobs, self.results, run_dir), daemon=True)
+            self.process.start()
+
+    def _submit(self, job):
+        if self.background:
+            self.jobs.put(job)
+        else:
+            result = _run_job(job, self.run_dir)
+            if result is not None:
+                self.done.append(result)
+
+    def submit_figure(self, images, titles, losses, name, cols=None):
+        images = [np.asarray(img) if img is not None else None for img in images]
+        self._submit(('figure', name, images, list(titles), dict(losses or {}), cols))
+
+    def submit_metrics(self, original, denoised, key, name=None):
+        """Queue ``evaluate_oct_denoising(original, denoised)``; the result is returned by ``poll`` under ``key``."""
+        name = name or f"metrics_{key}"
+        self._submit(('metrics', key, name, np.asarray(original), np.asarray(denoised)))
+        self.pending += 1
+
+    def poll(self, block=False):
+        """Collect finished metric results; with ``block`` wait for all pending ones."""
+        if self.background:
+            while self.pending > 0:
+                try:
+                    result = self.results.get(block=block)
+                except queue.Empty:
+                    break
+                self.done.append(result)
+                self.pending -= 1
+        else:
+            self.pending = 0
+        done, self.done = self.done, []
+        return done
+
+    def close(self):
+        """Wait for all queued jobs, stop the worker and return the remaining results."""
+        results = self.poll(block=True)
+        if self.background and self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join()
+        return results
+
+class BestMetricsCheckpointer:
+    """
+    Writes the best-metrics checkpoint once asynchronous metrics arrive.
+
+    ``add`` keeps a CPU snapshot of the checkpoint whose metrics were just
+    queued; ``update`` collects finished metrics and, if a score beats the best
+    so far, writes the matching snapshot (with its metrics filled in) through
+    the checkpoint writer. Snapshots are dropped once their metrics arrive.
+    """
+    def __init__(self, worker, checkpoint_writer, path, best_score=float('-inf'), save=True):
+        self.worker = worker
+        self.checkpoint_writer = checkpoint_writer
+        self.path = path
+        self.best_score = best_score if best_score is not None else float('-inf')
+        self.save = save
+        self.snapshots = {}
+
+    def add(self, key, state):
+        if self.save:
+            self.snapshots[key] = snapshot_state(state)
+
+    def update(self, block=False):
+        """
+        Returns:
+            list: ``(key, metrics, score)`` of every result collected
+        """
+        collected = []
+        for key, metrics in self.worker.poll(block=block):
+            snapshot = self.snapshots.pop(key, None)
+            if metrics is None:
+                continue
+            score = metrics_score(metrics)
+            collected.append((key, metrics, score))
+            print(f"Validation metrics for {key}: {metrics} (score {score:.4f})")
+            if score > self.best_score:
+                self.best_score = score
+                if snapshot is not None:
+                    print(f"Saving best metrics model with score: {score:.4f}")
+                    snapshot['metrics'] = metrics
+                    snapshot['metrics_score'] = score
+                    self.checkpoint_writer.save(snapshot, self.path)
+        return collected
+
+    def close(self):
+        collected = self.update(block=True)
+        self.worker.close()
+        return collected
+
+def report_validation(images, titles, losses, original, denoised, metrics_worker=None, key=None,
+                      name='validation', submit_metrics=True):
+    """
+    Show the validation figure and evaluate ``denoised`` against ``original``.
+
+    Without a worker this is ``plot_images`` followed by ``evaluate_oct_denoising``.
+    With one, both are queued (metrics only if ``submit_metrics``) under ``key``
+    and an empty dict is returned; the metrics arrive later through ``poll``.
+    Ranks other than 0 skip both in distributed training.
+    """
+    if not is_main_process():
+        return {}
+    if metrics_worker is None:
+        from ssm.utils.eval_utils.visualise import plot_images
+        from ssm.utils.eval_utils.metrics import evaluate_oct_denoising
+        plot_images(images, titles, losses)
+        return evaluate_oct_denoising(original, denoised)
+
+    metrics_worker.submit_figure(images, titles, losses, name)
+    if submit_metrics:
+        metrics_worker.submit_metrics(original, denoised, key, name=name)
+    return {}
+
+def get_metrics_worker(train_config, run_dir):
+    """
+    ``MetricsWorker`` for a run if 'async_metrics' is enabled in the training options, else None.
+
+    Only rank 0 gets a worker in distributed training.
+    """
+    if not train_config or not train_config.get('async_metrics', False) or not is_main_process():
+        return None
+    return MetricsWorker(run_dir, max_pending=train_config.get('metrics_queue_size', 4))
@@ -6,9 +6,11 @@ from tqdm import tqdm
 import numpy as np
 from skimage import io
 from skimage.transform import resize
+from skimage.util import img_as_float
 
 from ssm.utils import normalize_image
 from ssm.utils.eval_utils.metrics import evaluate_oct_denoising
+from ssm.utils.eval_utils.tiled_inference import tiled_denoise
 
 def get_sample_image(dataloader, device):
     sample = next(iter(dataloader))
@@ -39,7 +41,10 @@ def plot_sample(image, denoised, model, method):
     plt.show()
     
 
-def denoise_image(model, image, device):
+def denoise_image(model, image, device, tile_size=None, overlap=64):
+    if tile_size is not None:
+        # Full-resolution inference with blended overlapping tiles
+        return tiled_denoise(model, image, tile_size=tile_size, overlap=overlap, device=device)
     model.eval()
     with torch.no_grad():
         if isinstance(image, np.ndarray):
@@ -55,7 +60,17 @@ load_dotenv()
 device = os.getenv("DEVICE")
 device
 
-def evaluate(image, reference, model, method):
+def evaluate(image, reference, model, method, tile_size=None, overlap=64, device=None):
+    """
+    Denoise ``image`` with ``model`` and score it against ``reference``.
+
+    With ``tile_size`` set, the image is denoised at its native resolution
+    with overlapping tiles (``tiled_denoise``) instead of in one forward pass,
+    so it does not need to be resized to the training size first.
+
+    ``device`` is the device the model runs on, 'cuda' by default.
+    """
+    device = device or 'cuda'
     # Convert image to tensor if it's a numpy array
     if isinstance(image, np.ndarray):
         image_tensor = torch.from_numpy(image).float()
@@ -69,9 +84,13 @@ def evaluate(image, reference, model, method):
         except:
             original_image = image.cpu().numpy()
 
-    denoised = denoise_image(model, image_tensor, device='cuda')
+    if tile_size is not None:
+        # tiled_denoise already picks the final output and keeps the input layout
+        denoised = denoise_image(model, image_tensor, device=device, tile_size=tile_size, overlap=overlap)
+    else:
+        denoised = denoise_image(model, image_tensor, device=device)
 
-    denoised = denoised[-1]
+        denoised = denoised[-1]
 
     print(f"Image shape: {image_tensor.shape}")
     print(f"Denoised shape: {denoised.shape}")
@@ -120,6 +139,7 @@ from ssm.utils.data_utils.standard_preprocessing import normalize_image
 
 
 def load_sdoct_dataset(dataset_path, target_size=(256, 256)):
+    """SDOCT raw/averaged pairs per patient, resized to ``target_size`` unless it is None."""
 
     sdoct_data = {}
     patients = os.listdir(dataset_path)
@@ -138,9 +158,14 @@ def load_sdoct_dataset(dataset_path, target_size=(256, 256)):
             raw_img = io.imread(raw_path)
             avg_img = io.imread(avg_path)
                 
-            # Resize images
-            raw_img = resize(raw_img, target_size, anti_aliasing=True)
-            avg_img = resize(avg_img, target_size, anti_aliasing=True)
+            # Resize images, or keep the native resolution for tiled evaluation
+            if target_size is not None:
+                raw_img = resize(raw_img, target_size, anti_aliasing=True)
+                avg_img = resize(avg_img, target_size, anti_aliasing=True)
+            else:
+                # Same [0, 1] float scaling that resize applies
+                raw_img = img_as_float(raw_img)
+                avg_img = img_as_float(avg_img)
             
             raw_tensor = torch.from_numpy(raw_img).float().unsqueeze(0).unsqueeze(0)
             avg_tensor = torch.from_numpy(avg_img).float().unsqueeze(0).unsqueeze(0)
@@ -282,42 +282,73 @@ def calculate_cnr_whole(image):
     
     return cnr_db
 
-def auto_select_roi_using_flow(img, device='cuda'):
-
-    from ssm.models import SpeckleSeparationUNetAttention
-
-    speckle_module = SpeckleSeparationUNetAttention(input_channels=1, feature_dim=32).to(device)
-    try:
-        print("Loading ssm model from checkpoint...")
-        ssm_checkpoint_path = r"C:\Users\CL-11\OneDrive\Repos\OCTDenoisingFinal\checkpoints\SSM_mse_best.pth"
-        ssm_checkpoint = torch.load(ssm_checkpoint_path, map_location=device)
-        speckle_module.load_state_dict(ssm_checkpoint['model_state_dict'])
-        speckle_module.to(device)
-        speckle_module.eval()
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        print("Starting training from scratch.")
-        raise e 
-
-    # Convert numpy array to tensor
-    if len(img.shape) == 2:
-        img_tensor = torch.from_numpy(img).unsqueeze(0).unsqueeze(0).float().to(device)
-    else:
-        img_tensor = torch.from_numpy(img).unsqueeze(0).float().to(device)
-    
-    with torch.no_grad():
-        output = speckle_module(img_tensor)
-        flow = output['flow_component'].cpu().numpy()[0, 0]
-    
-    foreground_mask = flow > 0.1 * flow.max()
-    background_mask = flow < 0.1 * flow.max()
-    #foreground_mask = flow  # Use raw flow values as "weights" rather than binary mask
-    #background_mask = 1.0 - flow
+ROI_CHECKPOINT_PATH = r"C:\Users\CL-11\OneDrive\Repos\OCTDenoisingFinal\checkpoints\SSM_mse_best.pth"
 
-    
-    return [foreground_mask, background_mask]
+# Loaded ROI flow models keyed by (checkpoint path, mtime, device)
+_roi_models = {}
+
+def get_roi_flow_model(checkpoint_path=None, device='cuda'):
+    """
+    Frozen speckle separation module used for flow-based ROI selection.
+
+    The checkpoint path defaults to the ``SSM_ROI_CHECKPOINT`` environment
+    variable, then ``ROI_CHECKPOINT_PATH``. Models are loaded once per
+    process for each (path, modification time, device) and kept in eval mode;
+    a changed checkpoint file is reloaded.
+    """
+    from ssm.models.ssm.frozen_ssm import FrozenSpeckleModule, load_speckle_module
+
+    checkpoint_path = checkpoint_path or os.environ.get('SSM_ROI_CHECKPOINT', ROI_CHECKPOINT_PATH)
+    if torch.device(device).type == 'cuda' and not torch.cuda.is_available():
+        device = 'cpu'
+    checkpoint_path = os.path.abspath(checkpoint_path)
+    key = (checkpoint_path, os.path.getmtime(checkpoint_path), str(device))
+
+    if key not in _roi_models:
+        # Drop models loaded from an older version of the same checkpoint
+        for stale in [k for k in _roi_models if k[0] == key[0] and k[2] == key[2]]:
+            del _roi_models[stale]
+        print(f"Loading ROI flow model from {checkpoint_path}...")
+        _roi_models[key] = FrozenSpeckleModule(load_speckle_module(checkpoint_path)).to(device)
+
+    return _roi_models[key], device
+
+def auto_select_roi_using_flow_batch(images, device='cuda', checkpoint_path=None, batch_size=16):
+    """
+    Flow-based foreground/background ROI masks for many images.
 
-def evaluate_oct_denoising(original, denoised, reference=None):
+    Args:
+        images: Sequence of (H, W) or (C, H, W) arrays of the same shape
+        device: Device of the ROI model
+        checkpoint_path: ROI model checkpoint, see ``get_roi_flow_model``
+        batch_size: Images per forward pass
+
+    Returns:
+        list: ``[foreground_mask, background_mask]`` per image
+    """
+    speckle_module, device = get_roi_flow_model(checkpoint_path, device)
+
+    roi_masks = []
+    for start in range(0, len(images), batch_size):
+        batch = np.stack([np.asarray(img, dtype=np.float32) for img in images[start:start + batch_size]])
+        if batch.ndim == 3:
+            batch = batch[:, np.newaxis]
+        flows, = speckle_module.flows(torch.from_numpy(batch).to(device))
+        flows = flows[:, 0].float().cpu().numpy()
+
+        for flow in flows:
+            foreground_mask = flow > 0.1 * flow.max()
+            background_mask = flow < 0.1 * flow.max()
+            #foreground_mask = flow  # Use raw flow values as "weights" rather than binary mask
+            #background_mask = 1.0 - flow
+            roi_masks.append([foreground_mask, background_mask])
+
+    return roi_masks
+
+def auto_select_roi_using_flow(img, device='cuda', checkpoint_path=None):
+    return auto_select_roi_using_flow_batch([img], device, checkpoint_path)[0]
+
+def evaluate_oct_denoising(original, denoised, reference=None, roi_masks=None):
 
     metrics = {}
 
@@ -330,13 +361,14 @@ def evaluate_oct_denoising(original, denoised, reference=None):
     
     metrics['snr'] = calculate_snr(denoised) - calculate_snr(original)
     
-    try:
-        roi_masks = auto_select_roi_using_flow(denoised)
-        print("Using auto-selected ROIs Using Flow for CNR calculation.")
-    except Exception as e:
-        raise e
-        roi_masks = auto_select_roi(denoised)
-        print(f"Using AutoSelect ROI{e}")
+    if roi_masks is None:
+        try:
+            roi_masks = auto_select_roi_using_flow(denoised)
+            print("Using auto-selected ROIs Using Flow for CNR calculation.")
+        except Exception as e:
+            raise e
+            roi_masks = auto_select_roi(denoised)
+            print(f"Using AutoSelect ROI{e}")
 
     if len(roi_masks) >= 2:
         print("Using auto-selected ROIs for CNR calculation.")
@@ -351,6 +383,21 @@ def evaluate_oct_denoising(original, denoised, reference=None):
     
     return metrics
 
+def evaluate_oct_denoising_batch(originals, denoised_images, references=None, device='cuda'):
+    """
+    ``evaluate_oct_denoising`` for many image pairs, with all ROI masks from batched flow forwards.
+
+    Returns:
+        list: Metrics dict per image pair
+    """
+    roi_masks = auto_select_roi_using_flow_batch(denoised_images, device=device)
+    if references is None:
+        references = [None] * len(denoised_images)
+    return [
+        evaluate_oct_denoising(original, denoised, reference, roi_masks=masks)
+        for original, denoised, reference, masks in zip(originals, denoised_images, references, roi_masks)
+    ]
+
 def denoise_image(model, image, device=None):
     """Apply model to denoise a single image"""
     if device is None:
@@ -0,0 +1,218 @@
+import time
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from ssm.utils.data_utils.patch_processing import patch_positions, patch_tissue_fraction
+
+
+@lru_cache(maxsize=8)
+def _blend_window(tile_size, window, min_weight):
+    if window == 'hann':
+        w = torch.hann_window(tile_size, periodic=False, dtype=torch.float64)
+    elif window == 'gaussian':
+        sigma = tile_size / 8
+        coords = torch.arange(tile_size, dtype=torch.float64) - (tile_size - 1) / 2
+        w = torch.exp(-0.5 * (coords / sigma) ** 2)
+    elif window == 'none':
+        w = torch.ones(tile_size, dtype=torch.float64)
+    else:
+        raise ValueError(f"Unknown blend window: {window}")
+    w = torch.outer(w, w)
+    w = w / w.max()
+    return w.clamp(min=min_weight).float()
+
+def make_blend_window(tile_size, window='hann', min_weight=1e-3):
+    """
+    2D blending window used to weight overlapping tiles.
+
+    The window is clamped to ``min_weight`` so pixels on the image border,
+    which are only covered by the edge of a single tile, keep a valid weight.
+
+    Args:
+        tile_size: Side length of the square tile
+        window: 'hann', 'gaussian' or 'none'
+        min_weight: Lower bound of the window
+
+    Returns:
+        torch.Tensor: (tile_size, tile_size) float32 window on the CPU
+    """
+    return _blend_window(tile_size, window, min_weight)
+
+def _select_output(outputs, output_key):
+    """Pick the denoised image from whatever the model returns."""
+    if isinstance(outputs, dict):
+        return outputs[output_key]
+    if isinstance(outputs, (list, tuple)):
+        # Progressive models return one output per stage, the last is the final one
+        return outputs[-1]
+    return outputs
+
+def _as_image_stack(images):
+    """Return ``images`` as an (N, C, H, W) float tensor and the original layout."""
+    is_numpy = isinstance(images, np.ndarray)
+    tensor = torch.from_numpy(images) if is_numpy else images
+    shape = tuple(tensor.shape)
+    if tensor.dim() == 2:  # (H, W) single B-scan
+        tensor = tensor[None, None]
+    elif tensor.dim() == 3:  # (N, H, W) volume of B-scans
+        tensor = tensor[:, None]
+    elif tensor.dim() != 4:  # (N, C, H, W)
+        raise ValueError(f"Unexpected image shape: {shape}")
+    return tensor.float(), shape, is_numpy
+
+def tiled_denoise(model, images, tile_size=256, overlap=64, batch_tiles=16, window='hann',
+                  device=None, output_key='flow_component', tissue_threshold=None,
+                  background_fill='input', return_stats=False):
+    """
+    Denoise full-resolution B-scans or volumes with overlapping tiles.
+
+    Tiles from all images are queued together and run through the model in
+    fixed-size batches of ``batch_tiles`` (the last batch is zero-padded), so
+    peak device memory depends only on the tile budget and not on the image
+    size. Tile outputs are weighted with a blending window and accumulated on
+    the CPU. Images smaller than a tile are reflect-padded.
+
+    With ``tissue_threshold`` set, tiles whose tissue fraction (see
+    ``patch_tissue_fraction``) is below the threshold skip the model and are
+    filled with the input tile or zeros instead.
+
+    Args:
+        model: Any denoising model returning a tensor, a list of stage outputs,
+            or a dict (e.g. ``SpeckleSeparationUNetAttention``)
+        images: (H, W) B-scan, (N, H, W) volume, or (N, C, H, W) batch, as a
+            numpy array or tensor
+        tile_size: Side length of the square tiles fed to the model
+        overlap: Overlap between neighbouring tiles in pixels
+        batch_tiles: Number of tiles per forward pass
+        window: Blending window, 'hann', 'gaussian' or 'none'
+        device: Device to run the model on, defaults to the model's device (CPU without parameters)
+        output_key: Key of the output to use when the model returns a dict
+        tissue_threshold: Minimum tissue fraction for a tile to go through the model
+        background_fill: 'input' or 'zeros', the output used for skipped tiles
+        return_stats: Also return a dict with tile counts
+
+    Returns:
+        Denoised images with the same layout and type as ``images`` (float32),
+        and the stats dict if ``return_stats`` is set
+    """
+    if overlap >= tile_size:
+        raise ValueError(f"Overlap {overlap} must be smaller than the tile size {tile_size}")
+    if device is None:
+        # Frozen TorchScript artifacts and quantised models may have no parameters
+        param = next(model.parameters(), None)
+        device = param.device if param is not None else torch.device('cpu')
+
+    stack, original_shape, is_numpy = _as_image_stack(images)
+    n, c, h, w = stack.shape
+
+    # Pad small images up to one tile
+    pad_h = max(tile_size - h, 0)
+    pad_w = max(tile_size - w, 0)
+    if pad_h or pad_w:
+        mode = 'reflect' if pad_h < h and pad_w < w else 'replicate'
+        stack = F.pad(stack, (0, pad_w, 0, pad_h), mode=mode)
+    padded_h, padded_w = stack.shape[-2:]
+
+    stride = tile_size - overlap
+    ys = patch_positions(padded_h, tile_size, stride)
+    xs = patch_positions(padded_w, tile_size, stride)
+    tiles = [(i, y, x) for i in range(n) for y in ys for x in xs]
+
+    background = []
+    if tissue_threshold is not None:
+        fraction = patch_tissue_fraction(stack, tiles, tile_size).cpu()
+        is_tissue = (fraction >= tissue_threshold).tolist()
+        background = [t for t, keep in zip(tiles, is_tissue) if not keep]
+        tiles = [t for t, keep in zip(tiles, is_tissue) if keep]
+
+    blend = make_blend_window(tile_size, window)
+    weights = torch.zeros((padded_h, padded_w))
+    for y in ys:
+        for x in xs:
+            weights[y:y + tile_size, x:x + tile_size] += blend
+
+    output = None
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        for start in range(0, len(tiles), batch_tiles):
+            chunk = tiles[start:start + batch_tiles]
+            batch = stack.new_zeros((batch_tiles, c, tile_size, tile_size))
+            for k, (i, y, x) in enumerate(chunk):
+                batch[k] = stack[i, :, y:y + tile_size, x:x + tile_size]
+
+            result = _select_output(model(batch.to(device)), output_key)
+            result = result[:len(chunk)].float().cpu() * blend
+
+            if output is None:
+                output = torch.zeros((n, result.shape[1], padded_h, padded_w))
+            for k, (i, y, x) in enumerate(chunk):
+                output[i, :, y:y + tile_size, x:x + tile_size] += result[k]
+    model.train(was_training)
+
+    if output is None:
+        output = torch.zeros((n, c, padded_h, padded_w))
+    if background_fill not in ('input', 'zeros'):
+        raise ValueError(f"Unknown background fill: {background_fill}")
+    if background_fill == 'input':
+        for i, y, x in background:
+            tile = stack[i, :, y:y + tile_size, x:x + tile_size].float().cpu()
+            output[i, :, y:y + tile_size, x:x + tile_size] += tile[:output.shape[1]] * blend
+
+    output = (output / weights)[:, :, :h, :w]
+
+    if len(original_shape) == 2:
+        output = output[0, 0]
+    elif len(original_shape) == 3:
+        output = output[:, 0]
+
+    output = output.numpy() if is_numpy else output
+    if return_stats:
+        stats = {'tiles': len(tiles) + len(background), 'skipped': len(background)}
+        return output, stats
+    return output
+
+def tissue_skip_fidelity(model, images, tissue_threshold=0.1, **kwargs):
+    """
+    Compare tissue-skipping inference against full tiled inference.
+
+    Args:
+        model: Denoising model
+        images: Images accepted by ``tiled_denoise``
+        tissue_threshold: Threshold used for the skipping run
+        **kwargs: Passed to both ``tiled_denoise`` calls
+
+    Returns:
+        dict: fraction of tiles skipped, max/mean absolute difference, PSNR of
+        the skipped result against the full one, and both run times in seconds
+    """
+    start = time.time()
+    full = tiled_denoise(model, images, **kwargs)
+    full_time = time.time() - start
+
+    start = time.time()
+    skipped, stats = tiled_denoise(model, images, tissue_threshold=tissue_threshold,
+                                   return_stats=True, **kwargs)
+    skip_time = time.time() - start
+
+    full = torch.as_tensor(full).float()
+    skipped = torch.as_tensor(skipped).float()
+    diff = (full - skipped).abs()
+    mse = (diff ** 2).mean().item()
+    data_range = (full.max() - full.min()).item() or 1.0
+    psnr = float('inf') if mse == 0 else 10 * np.log10(data_range ** 2 / mse)
+
+    report = {
+        'skipped_fraction': stats['skipped'] / max(stats['tiles'], 1),
+        'max_abs_diff': diff.max().item(),
+        'mean_abs_diff': diff.mean().item(),
+        'psnr': psnr,
+        'full_time': full_time,
+        'skip_time': skip_time,
+    }
+    print(f"Skipped {stats['skipped']}/{stats['tiles']} tiles, PSNR vs full: {psnr:.2f} dB, "
+          f"max abs diff: {report['max_abs_diff']:.4f}, time {full_time:.2f}s -> {skip_time:.2f}s")
+    return report
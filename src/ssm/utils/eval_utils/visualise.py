@@ -5,6 +5,7 @@ import torch
 import numpy as np
 import matplotlib.pyplot as plt
 from ssm.utils.data_utils.standard_preprocessing import normalize_image
+from ssm.utils.distributed import is_main_process
 from ssm.models.ssm.ssm_attention import SpatialAttention
 
 def visualize_progress(model, input_tensor, target_tensor, masked_tensor, epoch):
@@ -350,6 +351,9 @@ def visualize_attention_maps(model, input_tensor):
     return fig, None, attention_maps
 
 def plot_images(images, titles, losses):
+    # Figures are only shown by rank 0 in distributed training
+    if not is_main_process():
+        return
     # clear output
     clear_output(wait=True)
     cols = len(images)
@@ -368,6 +372,23 @@ def plot_images(images, titles, losses):
     plt.tight_layout()
     plt.show()
 
+def save_images(images, titles, losses, path, cols=None):
+    """Render ``images`` like ``plot_images`` into ``path`` instead of showing them."""
+    cols = cols or len(images)
+    rows = (len(images) + cols - 1) // cols
+    fig, axes = plt.subplots(rows, cols, figsize=(3 * cols, 3 * rows + 1), squeeze=False)
+    if losses:
+        fig.suptitle(" | ".join(f"{name}: {value:.4f}" for name, value in losses.items()), fontsize=16)
+    for ax in axes.flat:
+        ax.axis('off')
+    for ax, img, title in zip(axes.flat, images, titles):
+        if img is not None:
+            ax.imshow(img, cmap='gray')
+        ax.set_title(title)
+    plt.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
 def plot_computation_graph(model, loss, speckle_module):
 
     # Create visualization
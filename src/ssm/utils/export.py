@@ -0,0 +1,135 @@
+import os
+import copy
+import json
+import torch
+import torch.nn as nn
+
+from ssm.models.components.fusion import fuse_conv_bn, strip_dropout
+from ssm.utils.compile import FULL_IMAGE_SIZE, verify_compiled
+
+METADATA_FILE = 'metadata.json'
+
+def prepare_for_inference(model):
+    """
+    Copy of ``model`` reduced to what inference needs.
+
+    BatchNorm layers are folded into the preceding convolutions, dropout layers
+    are removed and all parameters are frozen. The result is in eval mode.
+    """
+    model = fuse_conv_bn(model)
+    strip_dropout(model, inplace=True)
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model.eval()
+
+def checkpoint_metadata(checkpoint):
+    """JSON-serialisable scalar entries of a training checkpoint (epoch, losses, scores)."""
+    metadata = {}
+    for key, value in (checkpoint or {}).items():
+        if isinstance(value, torch.Tensor) and value.numel() == 1:
+            value = value.item()
+        if isinstance(value, (int, float, str, bool)) or value is None:
+            metadata[key] = value
+    return metadata
+
+def export_path(checkpoint_path, method='torchscript'):
+    """Artifact path next to a ``.pth`` checkpoint."""
+    root = checkpoint_path[:-4] if checkpoint_path.endswith('.pth') else checkpoint_path
+    return root + ('_inference.pt2' if method == 'export' else '_inference.pt')
+
+def export_model(model, path, example_shape=(1, 1, FULL_IMAGE_SIZE, FULL_IMAGE_SIZE), method='torchscript',
+                 metadata=None, atol=1e-4, rtol=1e-3):
+    """
+    Write a self-contained inference artifact of ``model``.
+
+    The model is reduced with ``prepare_for_inference``, then either traced
+    and frozen with TorchScript (``method='torchscript'``, a ``.pt`` file) or
+    captured with ``torch.export`` (``method='export'``, a ``.pt2`` file).
+    Freezing turns parameters into constants, so scalar weights such as
+    learnable residual mixes are folded into the graph. Neither format needs
+    the model classes to load. The artifact's outputs are checked against the
+    original model in eval mode before saving.
+
+    Shape-dependent branches (e.g. the resize before a skip connection) are
+    recorded as taken for ``example_shape``; inputs whose sides are divisible
+    by the same powers of two behave identically.
+
+    Args:
+        model: Trained model
+        path: Output file
+        example_shape: Input shape used for tracing
+        method: 'torchscript' or 'export'
+        metadata: Dict stored with the artifact, e.g. ``checkpoint_metadata(checkpoint)``
+        atol, rtol: Tolerance of the output check
+
+    Returns:
+        str: ``path``
+    """
+    device = next(model.parameters()).device
+    reference = copy.deepcopy(model).eval()
+    model = prepare_for_inference(model)
+    example = torch.rand(*example_shape, device=device)
+    metadata = dict(metadata or {})
+    metadata.update({'method': method, 'example_shape': list(example_shape)})
+
+    with torch.no_grad():
+        if method == 'torchscript':
+            artifact = torch.jit.freeze(torch.jit.trace(model, example, strict=False))
+        elif method == 'export':
+            artifact = torch.export.export(model, (example,))
+        else:
+            raise ValueError(f"Unknown export method: {method}")
+
+    module = artifact.module() if method == 'export' else artifact
+    ok, max_diff = verify_compiled(reference, InferenceModel(module), example_shape, atol=atol, rtol=rtol)
+    if not ok:
+        raise RuntimeError(f"Exported model differs from the original by up to {max_diff:.2e}")
+    print(f"Exported model matches the original (max abs diff {max_diff:.2e})")
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if method == 'torchscript':
+        torch.jit.save(artifact, path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+    else:
+        torch.export.save(artifact, path, extra_files={METADATA_FILE: json.dumps(metadata)})
+    print(f"Inference artifact saved to {path}")
+    return path
+
+class InferenceModel(nn.Module):
+    """
+    Loaded inference artifact, usable where a model is expected.
+
+    Always stays in eval mode: ``train()`` and ``eval()`` are no-ops on the
+    frozen graph, which exported programs do not support themselves.
+    """
+    def __init__(self, module, metadata=None):
+        super().__init__()
+        self.module = module
+        self.metadata = metadata or {}
+
+    def train(self, mode=True):
+        self.training = False
+        return self
+
+    def forward(self, x):
+        return self.module(x)
+
+def is_exported_model(path):
+    """Whether ``path`` names an artifact written by ``export_model`` (see ``export_path``)."""
+    return path.endswith('_inference.pt') or path.endswith('_inference.pt2')
+
+def load_exported_model(path, device='cpu'):
+    """
+    Load an artifact written by ``export_model``.
+
+    Returns:
+        tuple: (``InferenceModel``, metadata dict)
+    """
+    extra_files = {METADATA_FILE: ''}
+    if path.endswith('.pt2'):
+        module = torch.export.load(path, extra_files=extra_files).module().to(device)
+    else:
+        module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    metadata = json.loads(extra_files[METADATA_FILE] or '{}')
+    return InferenceModel(module, metadata), metadata
@@ -0,0 +1,87 @@
+import torch
+from contextlib import nullcontext
+
+_DTYPES = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+class PrecisionContext:
+    """
+    Mixed-precision and memory-format settings shared by the training loops.
+
+    Forwards run under ``autocast()``; losses should be computed on ``.float()``
+    outputs outside of it. ``backward``/``step`` handle gradient scaling for fp16
+    and are plain ``loss.backward()``/``optimizer.step()`` otherwise, so the
+    default 'fp32' context leaves training unchanged.
+
+    Args:
+        precision: 'fp32', 'bf16' or 'fp16'
+        device: Device the models run on
+        channels_last: Convert models and 4D inputs to ``torch.channels_last``
+    """
+    def __init__(self, precision='fp32', device='cuda', channels_last=False):
+        if precision not in _DTYPES:
+            raise ValueError(f"Unknown precision: {precision}, expected one of {list(_DTYPES)}")
+        self.device_type = torch.device(device).type
+        if precision == 'fp16' and self.device_type != 'cuda':
+            print("fp16 autocast needs CUDA, using bf16 instead")
+            precision = 'bf16'
+        self.precision = precision
+        self.dtype = _DTYPES[precision]
+        self.channels_last = channels_last
+        self.scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+    @property
+    def enabled(self):
+        return self.dtype is not None
+
+    def autocast(self):
+        if not self.enabled:
+            return nullcontext()
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype)
+
+    def prepare_model(self, model):
+        if model is not None and self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def prepare_input(self, tensor):
+        if self.channels_last and tensor.dim() == 4:
+            return tensor.contiguous(memory_format=torch.channels_last)
+        return tensor
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer, model=None, max_norm=None):
+        """Unscale, optionally clip ``model`` gradients, and step the optimizer."""
+        if max_norm is not None and model is not None:
+            self.scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=max_norm)
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return {'precision': self.precision, 'scaler': self.scaler.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        if state_dict.get('precision') == self.precision and self.scaler.is_enabled():
+            self.scaler.load_state_dict(state_dict['scaler'])
+
+def get_precision(precision=None, device='cuda', channels_last=False):
+    """
+    Return a ``PrecisionContext`` from a context, a precision name, or None (fp32).
+    """
+    if isinstance(precision, PrecisionContext):
+        return precision
+    return PrecisionContext(precision or 'fp32', device=device, channels_last=channels_last)
+
+def get_precision_from_config(train_config, device='cuda'):
+    """Build the context from the 'precision' and 'channels_last' training options."""
+    return PrecisionContext(
+        train_config.get('precision', 'fp32'),
+        device=device,
+        channels_last=train_config.get('channels_last', False)
+    )
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+from contextlib import contextmanager, nullcontext
+import torch
+
+from ssm.utils.batch_size_finder import peak_rss_mb, reset_peak_rss
+from ssm.utils.distributed import is_main_process
+
+PHASES = ('data', 'h2d', 'prep', 'forward', 'loss', 'backward', 'step', 'checkpoint', 'metrics')
+
+def _batch_size(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.size(0)
+    if isinstance(batch, (list, tuple)) and batch:
+        return _batch_size(batch[0])
+    if isinstance(batch, dict) and batch:
+        return _batch_size(next(iter(batch.values())))
+    return 0
+
+class TrainingProfiler:
+    """
+    Per-step phase timings and throughput of a training run, written as JSONL.
+
+    ``batches`` wraps a dataloader: the time spent waiting for each batch is
+    recorded as the 'data' phase and every batch starts a new step. Code inside
+    the loop is timed with ``phase(name)`` (see ``PHASES``); when CUDA is in use
+    the device is synchronised at phase boundaries so kernel time lands in the
+    phase that launched it. Each step is written as one line::
+
+        {"type": "step", "mode": "train", "epoch": 0, "step": 12, "samples": 8,
+         "time": 0.41, "samples_per_sec": 19.5, "peak_memory_mb": 2210.0,
+         "phases": {"data": 0.01, "forward": 0.12, ...}, "other": 0.02}
+
+    Phases timed outside a step (checkpointing, metrics) are collected into the
+    record written by ``end_epoch``.
+
+    ``torch.profiler`` traces of the training steps listed in ``trace_steps``
+    are exported as Chrome traces to ``trace_dir``.
+
+    Args:
+        log_path: JSONL output file
+        device: Device the model runs on, for synchronisation and peak memory
+        trace_steps: Global training step indices to trace with ``torch.profiler``
+        trace_dir: Directory for traces, defaults to ``<log_path>_traces``
+        sync_cuda: Synchronise CUDA at phase boundaries
+    """
+    enabled = True
+
+    def __init__(self, log_path, device='cuda', trace_steps=None, trace_dir=None, sync_cuda=True):
+        self.log_path = log_path
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.sync_cuda = sync_cuda and self.cuda
+        self.trace_steps = set(trace_steps or [])
+        self.trace_dir = trace_dir or os.path.splitext(log_path)[0] + '_traces'
+
+        directory = os.path.dirname(log_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(log_path, 'a')
+
+        self.global_step = 0
+        self.epoch_phases = {}
+        self.epoch_samples = {}
+        self.epoch_time = {}
+        self._step = None
+        self._trace = None
+
+    def _sync(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize(self.device)
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def _reset_peak_memory(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            reset_peak_rss()
+
+    def _peak_memory_mb(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        return peak_rss_mb()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as phase ``name`` of the current step (or epoch)."""
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            elapsed = time.perf_counter() - start
+            phases = self._step['phases'] if self._step is not None else self.epoch_phases
+            phases[name] = phases.get(name, 0.0) + elapsed
+
+    def _start_step(self, mode, epoch, data_time):
+        self._reset_peak_memory()
+        self._step = {
+            'mode': mode,
+            'epoch': epoch,
+            'start': time.perf_counter() - data_time,
+            'phases': {'data': data_time},
+            'samples': 0,
+        }
+        if mode == 'train' and self.global_step in self.trace_steps:
+            self._start_trace()
+
+    def _end_step(self):
+        step, self._step = self._step, None
+        if step is None:
+            return
+        self._sync()
+        total = time.perf_counter() - step['start']
+        mode = step['mode']
+        record = {
+            'type': 'step',
+            'mode': mode,
+            'epoch': step['epoch'],
+            'step': self.global_step if mode == 'train' else None,
+            'samples': step['samples'],
+            'time': total,
+            'samples_per_sec': step['samples'] / total if total > 0 else None,
+            'peak_memory_mb': self._peak_memory_mb(),
+            'phases': step['phases'],
+            'other': max(total - sum(step['phases'].values()), 0.0),
+        }
+        self._write(record)
+
+        if self._trace is not None:
+            self._stop_trace()
+        self.epoch_samples[mode] = self.epoch_samples.get(mode, 0) + step['samples']
+        self.epoch_time[mode] = self.epoch_time.get(mode, 0.0) + total
+        if mode == 'train':
+            self.global_step += 1
+
+    def _start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._trace.__enter__()
+
+    def _stop_trace(self):
+        trace, self._trace = self._trace, None
+        trace.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f"step_{self.global_step}.json")
+        trace.export_chrome_trace(path)
+        print(f"Profiler trace for step {self.global_step} saved to {path}")
+
+    def batches(self, dataloader, epoch=None, mode='train'):
+        """
+        Iterate over ``dataloader``, timing the wait for each batch and starting a new step per batch.
+
+        The number of samples of a step is taken from the first tensor of the
+        batch; use ``add_samples`` when a step processes a different count.
+        The result keeps the length of ``dataloader`` for progress bars.
+        """
+        return _ProfiledBatches(self, dataloader, epoch, mode)
+
+    def _iterate(self, dataloader, epoch, mode):
+        iterator = iter(dataloader)
+        while True:
+            self._end_step()
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            data_time = time.perf_counter() - start
+            self._start_step(mode, epoch, data_time)
+            self._step['samples'] = _batch_size(batch)
+            yield batch
+
+    def add_samples(self, n):
+        """Override the sample count of the current step."""
+        if self._step is not None:
+            self._step['samples'] = n
+
+    def end_epoch(self, epoch, **extra):
+        """Write the epoch summary with its throughput and the phases timed outside steps."""
+        self._end_step()
+        record = {'type': 'epoch', 'epoch': epoch, 'phases': self.epoch_phases}
+        for mode, samples in self.epoch_samples.items():
+            elapsed = self.epoch_time.get(mode, 0.0)
+            record[f'{mode}_samples'] = samples
+            record[f'{mode}_samples_per_sec'] = samples / elapsed if elapsed > 0 else None
+        record['peak_memory_mb'] = self._peak_memory_mb()
+        record.update(extra)
+        self._write(record)
+        self.epoch_phases = {}
+        self.epoch_samples = {}
+        self.epoch_time = {}
+
+    def close(self):
+        self._end_step()
+        if self._trace is not None:
+            self._stop_trace()
+        if not self.file.closed:
+            self.file.close()
+
+class _ProfiledBatches:
+    def __init__(self, profiler, dataloader, epoch, mode):
+        self.profiler = profiler
+        self.dataloader = dataloader
+        self.epoch = epoch
+        self.mode = mode
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        return self.profiler._iterate(self.dataloader, self.epoch, self.mode)
+
+class NullProfiler:
+    """Profiler with the ``TrainingProfiler`` interface that records nothing."""
+    enabled = False
+
+    def phase(self, name):
+        return nullcontext()
+
+    def batches(self, dataloader, epoch=None, mode='train'):
+        return dataloader
+
+    def add_samples(self, n):
+        pass
+
+    def end_epoch(self, epoch, **extra):
+        pass
+
+    def close(self):
+        pass
+
+def get_profiler(train_config=None, log_path=None, device='cuda'):
+    """
+    ``TrainingProfiler`` if 'profile' is enabled in the training options, else a ``NullProfiler``.
+
+    In distributed training only rank 0 profiles.
+
+    Options:
+        profile: Enable profiling
+        profile_path: JSONL output file, defaults to ``log_path``
+        profile_trace_steps: Training steps to capture with ``torch.profiler``
+        profile_sync_cuda: Synchronise CUDA at phase boundaries (default True)
+    """
+    if train_config is None or not train_config.get('profile', False) or not is_main_process():
+        return NullProfiler()
+    log_path = train_config.get('profile_path', None) or log_path
+    if log_path is None:
+        raise ValueError("A profile_path is required when profiling is enabled")
+    print(f"Profiling training to {log_path}")
+    return TrainingProfiler(
+        log_path,
+        device=device,
+        trace_steps=train_config.get('profile_trace_steps', None),
+        sync_cuda=train_config.get('profile_sync_cuda', True)
+    )
+
+def set_anomaly_detection(train_config=None):
+    """
+    Enable autograd anomaly detection only when 'detect_anomaly' is set in the training options.
+
+    Anomaly detection records a traceback for every autograd node and slows
+    every backward pass, so it is meant for debugging NaNs only.
+
+    Returns:
+        bool: Whether anomaly detection is enabled
+    """
+    enabled = bool(train_config.get('detect_anomaly', False)) if train_config else False
+    torch.autograd.set_detect_anomaly(enabled)
+    if enabled:
+        print("Autograd anomaly detection enabled")
+    return enabled
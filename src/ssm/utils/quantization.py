@@ -0,0 +1,261 @@
+import os
+import io
+import copy
+import json
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+from ssm.models.components.fusion import fuse_conv_bn, strip_dropout
+from ssm.utils.compile import FULL_IMAGE_SIZE
+from ssm.utils.export import METADATA_FILE
+from ssm.utils.eval_utils.metrics import calculate_psnr, calculate_ssim, calculate_cnr_whole
+from ssm.data.paired_dataset import load_paired_dataset
+
+def calibration_samples(start, n_patients=1, n_images_per_patient=20, cache_dir=None):
+    """
+    (inputs, targets) tensors of shape (N, 1, H, W) from a ``PairedOCTDataset`` sample.
+
+    Used both to calibrate activation ranges of static quantisation and, from a
+    different ``start`` patient, to evaluate the quantised models.
+    """
+    dataset = load_paired_dataset(start, n_patients, n_images_per_patient, cache_dir=cache_dir)
+    inputs, targets = zip(*(dataset[i][:2] for i in range(len(dataset))))
+    return torch.stack(inputs), torch.stack(targets)
+
+def _float_copy(model):
+    # Quantised kernels run on CPU; BatchNorm folding and dropout removal happen before observers are inserted
+    model = fuse_conv_bn(copy.deepcopy(model).cpu().float())
+    return strip_dropout(model, inplace=True).eval()
+
+def quantize_static(model, calibration_inputs, backend='x86', batch_size=4):
+    """
+    Post-training static int8 quantisation with FX graph mode.
+
+    The model is symbolically traced, observers are inserted with the default
+    qconfig mapping of ``backend``, calibration inputs are run through it to
+    record activation ranges, and the observed model is converted to int8
+    kernels. Weights and activations of convolutions, linear layers and
+    supported element-wise ops are quantised; outputs are dequantised.
+
+    Data-dependent control flow in ``forward`` cannot be traced; the UNets and
+    speckle modules keep their skip-connection resize in
+    ``match_spatial_size``, which is traced as a leaf and runs in fp32 between
+    dequantise/quantise nodes. Other untraceable models raise here.
+
+    Args:
+        model: Trained fp32 model
+        calibration_inputs: Tensor (N, 1, H, W) of representative inputs
+        backend: Quantised engine, 'x86', 'fbgemm' or 'qnnpack' (ARM)
+        batch_size: Calibration batch size
+
+    Returns:
+        nn.Module: Quantised model on CPU
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    model = _float_copy(model)
+    example = calibration_inputs[:1].cpu()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (example,))
+    with torch.no_grad():
+        for i in range(0, len(calibration_inputs), batch_size):
+            prepared(calibration_inputs[i:i + batch_size].cpu())
+    quantized = convert_fx(prepared).eval()
+    if count_quantized_modules(quantized) == 0:
+        raise ValueError(f"No layer of {type(model).__name__} was quantised")
+    return quantized
+
+def quantize_dynamic(model, dtype=torch.qint8):
+    """
+    Dynamic int8 quantisation: weights stored in int8, activations quantised on the fly.
+
+    Needs no calibration and no tracing, but only ``nn.Linear`` and recurrent
+    layers have dynamic kernels. Convolutional models (all UNets and speckle
+    modules) have nothing to quantise this way, so a ``ValueError`` is raised
+    instead of returning what would be an fp32 model.
+    """
+    model = _float_copy(model)
+    quantized = torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM, nn.GRU}, dtype=dtype).eval()
+    if count_quantized_modules(quantized) == 0:
+        raise ValueError(f"{type(model).__name__} has no Linear or recurrent layers to quantise dynamically")
+    return quantized
+
+def count_quantized_modules(model):
+    """Number of submodules replaced by quantised kernels."""
+    return sum('quantized' in type(module).__module__ for module in model.modules())
+
+def quantize_model(model, calibration_inputs=None, mode='auto', backend='x86'):
+    """
+    Quantised copy of ``model`` for CPU inference.
+
+    Args:
+        model: Trained fp32 model
+        calibration_inputs: Representative inputs, required for static quantisation
+        mode: 'static', 'dynamic', or 'auto' (static, falling back to dynamic when
+            the model cannot be traced or no calibration data is given); raises
+            if the model ends up with no quantised layers
+        backend: Quantised engine for static quantisation
+
+    Returns:
+        tuple: (quantised model, mode actually used)
+    """
+    name = type(model).__name__
+    if mode in ('static', 'auto') and calibration_inputs is not None:
+        try:
+            quantized = quantize_static(model, calibration_inputs, backend=backend)
+            print(f"Statically quantised {name} to int8 ({backend}, {len(calibration_inputs)} calibration images)")
+            return quantized, 'static'
+        except Exception as e:
+            if mode == 'static':
+                raise
+            print(f"Static quantisation failed for {name}: {e}")
+    elif mode == 'static':
+        raise ValueError("Static quantisation needs calibration inputs")
+    elif mode != 'dynamic' and mode != 'auto':
+        raise ValueError(f"Unknown quantisation mode: {mode}")
+
+    print(f"Dynamically quantised {name} to int8")
+    return quantize_dynamic(model), 'dynamic'
+
+def save_quantized(model, path, example_shape=(1, 1, FULL_IMAGE_SIZE, FULL_IMAGE_SIZE), metadata=None):
+    """
+    Write a quantised model as a frozen TorchScript inference artifact.
+
+    The file is read back by ``load_exported_model`` like the artifacts of
+    ``export_model``, so ``path`` should end in '_inference.pt' (``export_path``).
+    """
+    metadata = dict(metadata or {})
+    metadata.update({'method': 'torchscript', 'example_shape': list(example_shape)})
+    with torch.no_grad():
+        artifact = torch.jit.freeze(torch.jit.trace(model.eval(), torch.rand(*example_shape), strict=False))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    torch.jit.save(artifact, path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+    print(f"Quantised inference artifact saved to {path}")
+    return path
+
+def _denoised(output):
+    # The speckle separation module returns a dict; its flow component is the cleaned image
+    if isinstance(output, dict):
+        output = output['flow_component']
+    return output.float()
+
+@torch.no_grad()
+def measure_latency(model, example_shape=(1, 1, FULL_IMAGE_SIZE, FULL_IMAGE_SIZE), n_warmup=3, n_runs=20, device='cpu'):
+    """Median latency of one forward pass on ``device`` in milliseconds."""
+    example = torch.rand(*example_shape, device=device)
+    sync = torch.cuda.synchronize if torch.device(device).type == 'cuda' else (lambda: None)
+    model.eval()
+    for _ in range(n_warmup):
+        model(example)
+    sync()
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        model(example)
+        sync()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+def model_size_mb(model):
+    """Serialised state dict size, which reflects int8 weight storage."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+@torch.no_grad()
+def quantization_report(models, inputs, targets, reference='fp32', batch_size=4, example_shape=None,
+                        n_runs=20, num_threads=None, output_path=None):
+    """
+    Compare quantised models against the fp32 model on CPU.
+
+    For every model the denoised outputs are scored with PSNR and SSIM against
+    the paired targets and with whole-image CNR, averaged over ``inputs``.
+    Fidelity to the fp32 model is the PSNR between its outputs and those of
+    the ``reference`` model. Latency is the median of ``n_runs`` single-image
+    forwards.
+
+    Args:
+        models: Dict of name -> model, including ``reference``
+        inputs, targets: Evaluation tensors (N, 1, H, W), e.g. from ``calibration_samples``
+        reference: Name of the fp32 model
+        batch_size: Evaluation batch size
+        example_shape: Latency input shape, defaults to one full image
+        n_runs: Timed forwards per model
+        num_threads: CPU threads for inference, as on the deployment machines
+        output_path: Optional JSON file for the report
+
+    Returns:
+        list: One dict of metrics per model
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if example_shape is None:
+        example_shape = (1,) + tuple(inputs.shape[1:])
+
+    outputs = {}
+    for name, model in models.items():
+        model.eval()
+        outputs[name] = torch.cat([
+            _denoised(model(inputs[i:i + batch_size].cpu())) for i in range(0, len(inputs), batch_size)
+        ]).numpy()
+    targets = targets.cpu().numpy()
+
+    rows = []
+    for name, model in models.items():
+        denoised = outputs[name]
+        row = {
+            'model': name,
+            'psnr': float(np.mean([calculate_psnr(d[0], t[0]) for d, t in zip(denoised, targets)])),
+            'ssim': float(np.mean([calculate_ssim(d[0], t[0]) for d, t in zip(denoised, targets)])),
+            'cnr': float(np.mean([calculate_cnr_whole(d[0]) for d in denoised])),
+            'psnr_vs_fp32': float(np.mean([calculate_psnr(d[0], r[0]) for d, r in zip(denoised, outputs[reference])]))
+                            if name != reference else float('inf'),
+            'latency_ms': measure_latency(model, example_shape, n_runs=n_runs),
+            'size_mb': model_size_mb(model),
+        }
+        rows.append(row)
+
+    base_latency = next(row['latency_ms'] for row in rows if row['model'] == reference)
+    for row in rows:
+        row['speedup'] = base_latency / row['latency_ms']
+
+    print(f"{'Model':<24}{'PSNR':>8}{'SSIM':>8}{'CNR':>8}{'vs fp32':>10}{'ms':>10}{'speedup':>9}{'MB':>8}")
+    for row in rows:
+        print(f"{row['model']:<24}{row['psnr']:>8.2f}{row['ssim']:>8.4f}{row['cnr']:>8.2f}"
+              f"{row['psnr_vs_fp32']:>10.2f}{row['latency_ms']:>10.1f}{row['speedup']:>9.2f}{row['size_mb']:>8.1f}")
+
+    if output_path is not None:
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump(rows, f, indent=2)
+        print(f"Quantisation report saved to {output_path}")
+    return rows
+
+def quantize_and_report(model, calibration_inputs, inputs, targets, modes=('static', 'dynamic'), backend='x86',
+                        num_threads=None, output_path=None):
+    """
+    Quantise ``model`` with each of ``modes`` and report them next to fp32.
+
+    Modes that fail (e.g. static quantisation of an untraceable model) are
+    skipped with a message.
+
+    Returns:
+        tuple: (dict of name -> model, report rows)
+    """
+    fp32 = _float_copy(model)
+    models = {'fp32': fp32}
+    for mode in modes:
+        try:
+            quantized, used = quantize_model(fp32, calibration_inputs, mode=mode, backend=backend)
+            models[f'int8_{used}'] = quantized
+        except Exception as e:
+            print(f"Skipping {mode} quantisation: {e}")
+    rows = quantization_report(models, inputs, targets, num_threads=num_threads, output_path=output_path)
+    return models, rows
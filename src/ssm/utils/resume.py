@@ -0,0 +1,254 @@
+import os
+import random
+import itertools
+import numpy as np
+import torch
+
+from ssm.utils.checkpoint import CheckpointWriter, atomic_save, snapshot_state
+from ssm.utils.distributed import get_rank, is_main_process, unwrap_model
+
+def capture_rng_state():
+    """RNG states of python, numpy, torch and every CUDA device."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+def loader_state(loader):
+    """Shuffling state of a loader: its own generator and the epoch of a distributed sampler."""
+    state = {}
+    generator = getattr(loader, 'generator', None)
+    if generator is not None:
+        state['generator'] = generator.get_state()
+    sampler = getattr(loader, 'sampler', None)
+    if hasattr(sampler, 'epoch'):
+        state['sampler_epoch'] = sampler.epoch
+    return state
+
+def load_loader_state(loader, state):
+    if 'generator' in state and getattr(loader, 'generator', None) is not None:
+        loader.generator.set_state(state['generator'])
+    sampler = getattr(loader, 'sampler', None)
+    if 'sampler_epoch' in state and hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(state['sampler_epoch'])
+
+def _skip_batches(loader, n):
+    # Loaders that can start at a batch skip without gathering the skipped ones
+    if n and hasattr(loader, 'iter_from'):
+        return loader.iter_from(n)
+    return itertools.islice(iter(loader), n, None)
+
+class TrainingState:
+    """
+    Everything needed to continue a training run exactly where it stopped.
+
+    The state holds the model, optimizer, scheduler and gradient scaler, the
+    epoch and the number of training batches finished in it, the python,
+    numpy, torch and CUDA RNG states and the shuffling state of the training
+    loader, plus free-form bookkeeping in ``extra`` (best losses, metrics
+    scores, history).
+
+    The training loader is iterated through ``batches``, which saves the state
+    every ``save_every`` steps; ``end_epoch`` saves it after every epoch. After
+    ``load``, the first ``batches`` call of the interrupted epoch restores the
+    RNG and loader state of the start of that epoch, so the loader produces the
+    same order, skips the batches already trained on, and then restores the
+    RNG state of the moment the state was saved. With a single-process loader
+    the remaining steps then see the same batches and random masks as the
+    uninterrupted run. The epoch-average training loss of a resumed epoch only
+    covers the batches trained after resuming.
+
+    States are written atomically by a ``CheckpointWriter``. In distributed
+    training rank 0 writes the full state and every other rank writes its own
+    RNG and loader state next to it.
+
+    Args:
+        path: State file
+        model: Model being trained (unwrapped or DDP)
+        optimizer: Optimizer
+        scheduler: Learning rate scheduler, or None
+        precision: ``PrecisionContext`` whose gradient scaler is saved, or None
+        save_every: Training steps between mid-epoch saves, 0 or None to save at epoch ends only
+        extra: Initial bookkeeping values
+    """
+    enabled = True
+
+    def __init__(self, path, model, optimizer, scheduler=None, precision=None, save_every=None, extra=None):
+        self.path = path
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.precision = precision
+        self.save_every = save_every or 0
+        self.extra = dict(extra or {})
+        self.epoch = 0
+        self.batch = 0
+        self.global_step = 0
+        self.writer = CheckpointWriter()
+        self._epoch_start = None
+        self._resume = None
+
+    def _rank_path(self, rank):
+        root, ext = os.path.splitext(self.path)
+        return f"{root}_rank{rank}{ext}"
+
+    def _rank_state(self):
+        return {
+            'rng': capture_rng_state(),
+            'epoch_start': self._epoch_start,
+        }
+
+    def state_dict(self):
+        state = {
+            'epoch': self.epoch,
+            'batch': self.batch,
+            'global_step': self.global_step,
+            'model_state_dict': unwrap_model(self.model).state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'extra': self.extra,
+        }
+        if self.scheduler is not None:
+            state['scheduler_state_dict'] = self.scheduler.state_dict()
+        if self.precision is not None:
+            state['precision_state_dict'] = self.precision.state_dict()
+        state.update(self._rank_state())
+        return state
+
+    def save(self):
+        if is_main_process():
+            self.writer.save(self.state_dict(), self.path)
+        else:
+            atomic_save(snapshot_state(self._rank_state()), self._rank_path(get_rank()))
+
+    def load(self, map_location='cpu'):
+        """
+        Restore the state from ``path`` if it exists.
+
+        Returns:
+            bool: Whether a state was loaded
+        """
+        if not os.path.exists(self.path):
+            return False
+        state = torch.load(self.path, map_location=map_location, weights_only=False)
+        unwrap_model(self.model).load_state_dict(state['model_state_dict'])
+        self.optimizer.load_state_dict(state['optimizer_state_dict'])
+        if self.scheduler is not None and 'scheduler_state_dict' in state:
+            self.scheduler.load_state_dict(state['scheduler_state_dict'])
+        if self.precision is not None and 'precision_state_dict' in state:
+            self.precision.load_state_dict(state['precision_state_dict'])
+        self.epoch = state['epoch']
+        self.batch = state['batch']
+        self.global_step = state['global_step']
+        self.extra.update(state['extra'])
+
+        if not is_main_process() and os.path.exists(self._rank_path(get_rank())):
+            state.update(torch.load(self._rank_path(get_rank()), map_location='cpu', weights_only=False))
+        self._resume = {'epoch': self.epoch, 'batch': self.batch, 'rng': state['rng'],
+                        'epoch_start': state['epoch_start']}
+        print(f"Resuming from {self.path} at epoch {self.epoch + 1}, batch {self.batch}")
+        return True
+
+    def batches(self, loader, epoch):
+        """
+        Training batches of ``loader`` for ``epoch``, continuing mid-epoch after ``load``.
+
+        The result keeps the length of the remaining batches, for progress bars
+        and loss averages.
+        """
+        resume = self._resume if self._resume is not None and self._resume['epoch'] == epoch else None
+        self._resume = None
+        skip = 0
+        if resume is not None and resume['batch'] > 0:
+            restore_rng_state(resume['epoch_start']['rng'])
+            load_loader_state(loader, resume['epoch_start']['loader'])
+            skip = resume['batch']
+        elif resume is not None:
+            # Saved at an epoch boundary: continue from the RNG state at that point
+            restore_rng_state(resume['rng'])
+        return _ResumableBatches(self, loader, epoch, skip, resume)
+
+    def _iterate(self, loader, epoch, skip, resume):
+        self.epoch = epoch
+        self.batch = skip
+        self._epoch_start = {'rng': capture_rng_state(), 'loader': loader_state(loader)}
+        iterator = _skip_batches(loader, skip)
+        if skip:
+            restore_rng_state(resume['rng'])
+        for batch in iterator:
+            yield batch
+            self.batch += 1
+            self.global_step += 1
+            if self.save_every and self.global_step % self.save_every == 0:
+                self.save()
+
+    def end_epoch(self, epoch, **extra):
+        """Record the bookkeeping of a finished epoch and save the state to continue with the next one."""
+        self.extra.update(extra)
+        self.epoch = epoch + 1
+        self.batch = 0
+        self._epoch_start = None
+        self.save()
+
+    def close(self):
+        self.writer.close()
+
+class _ResumableBatches:
+    def __init__(self, state, loader, epoch, skip, resume):
+        self.state = state
+        self.loader = loader
+        self.epoch = epoch
+        self.skip = skip
+        self.resume = resume
+
+    def __len__(self):
+        return len(self.loader) - self.skip
+
+    def __iter__(self):
+        return self.state._iterate(self.loader, self.epoch, self.skip, self.resume)
+
+class NullTrainingState:
+    """Training state with the ``TrainingState`` interface that saves nothing."""
+    enabled = False
+
+    def __init__(self, extra=None):
+        self.extra = dict(extra or {})
+        self.epoch = 0
+
+    def load(self, map_location='cpu'):
+        return False
+
+    def batches(self, loader, epoch):
+        return loader
+
+    def save(self):
+        pass
+
+    def end_epoch(self, epoch, **extra):
+        pass
+
+    def close(self):
+        pass
+
+def get_training_state(train_config, path, model, optimizer, scheduler=None, precision=None, extra=None):
+    """
+    ``TrainingState`` if 'resumable' is enabled in the training options, else a ``NullTrainingState``.
+
+    Options:
+        resumable: Save a resumable training state and continue from it when it exists
+        state_every_n_steps: Training steps between mid-epoch saves (default: epoch ends only)
+    """
+    if train_config is None or not train_config.get('resumable', False):
+        return NullTrainingState(extra)
+    return TrainingState(path, model, optimizer, scheduler, precision,
+                         save_every=train_config.get('state_every_n_steps', None), extra=extra)
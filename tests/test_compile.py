@@ -0,0 +1,42 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from ssm.models.unet.unet import UNet
+from ssm.models.ssm.ssm_attention import SpeckleSeparationUNetAttention
+from ssm.models.components.fusion import strip_dropout
+from ssm.utils.compile import compile_model, verify_compiled
+
+# Small inputs keep compilation fast; both models downsample 16x
+EXAMPLE_SHAPE = (2, 1, 32, 32)
+
+MODELS = {
+    'UNet': lambda: UNet(in_channels=1, out_channels=1),
+    # Dropout makes train-mode outputs random, so it is removed for the comparison
+    'SpeckleSeparationUNetAttention': lambda: strip_dropout(SpeckleSeparationUNetAttention(input_channels=1, feature_dim=8)),
+}
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+
+@pytest.mark.parametrize("name", sorted(MODELS))
+@pytest.mark.parametrize("training", [False, True])
+def test_compiled_matches_eager(name, training):
+    model = MODELS[name]()
+    # torch.compile when the inductor backend works here, the TorchScript trace otherwise
+    compiled = compile_model(model, EXAMPLE_SHAPE, training=training, fallback='trace')
+    assert compiled is not model
+
+    ok, max_diff = verify_compiled(model, compiled, EXAMPLE_SHAPE, training=training)
+    assert ok, f"{name} differs from eager by {max_diff:.2e} ({'train' if training else 'eval'} mode)"
+
+@pytest.mark.parametrize("name", sorted(MODELS))
+def test_traced_fallback_matches_eager(name):
+    model = MODELS[name]()
+    compiled = compile_model(model, EXAMPLE_SHAPE, backend='no-such-backend', training=True, fallback='trace')
+    assert compiled is not model
+
+    for training in (False, True):
+        ok, max_diff = verify_compiled(model, compiled, EXAMPLE_SHAPE, training=training)
+        assert ok, f"Traced {name} differs from eager by {max_diff:.2e}"
@@ -0,0 +1,54 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from ssm.data.flow_store import precompute_flow_maps, FlowMapDataset
+from ssm.data.paired_dataset import split_batch
+from ssm.models.ssm.ssm_attention import SpeckleSeparationUNetAttention
+from ssm.models.ssm.frozen_ssm import FrozenSpeckleModule, load_speckle_module
+from ssm.schemas.baselines.n2n import normalize_image_torch
+
+IMAGE_SIZE = 32
+N_IMAGES = 4
+
+class ImageDataset(torch.utils.data.Dataset):
+    """Minimal stand-in for ``PairedOCTDataset`` with random images."""
+    def __init__(self, n_images):
+        self.input_images = [np.random.rand(IMAGE_SIZE, IMAGE_SIZE, 1).astype(np.float32) for _ in range(n_images)]
+
+    def __len__(self):
+        return len(self.input_images)
+
+    def __getitem__(self, idx):
+        tensor = torch.from_numpy(self.input_images[idx].transpose(2, 0, 1))
+        return tensor, tensor
+
+def flow_loss(flow_inputs, flow_outputs):
+    # The flow term of the n2n trainer
+    flow_inputs = normalize_image_torch(flow_inputs.float())
+    flow_outputs = normalize_image_torch(flow_outputs.float())
+    return torch.mean(torch.abs(flow_outputs - flow_inputs))
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+def test_stored_flows_reproduce_flow_loss(tmp_path):
+    checkpoint_path = str(tmp_path / 'ssm.pth')
+    module = SpeckleSeparationUNetAttention(input_channels=1, feature_dim=8)
+    torch.save({'model_state_dict': module.state_dict()}, checkpoint_path)
+
+    dataset = ImageDataset(N_IMAGES)
+    flow_maps = precompute_flow_maps(dataset, checkpoint_path, device='cpu', store_dir=str(tmp_path / 'flow_maps'))
+    batch = next(iter(torch.utils.data.DataLoader(FlowMapDataset(dataset, flow_maps), batch_size=N_IMAGES)))
+    inputs, _, _, stored_flows = split_batch(batch)
+    outputs = torch.rand_like(inputs)
+
+    speckle_module = FrozenSpeckleModule(load_speckle_module(checkpoint_path))
+    fresh = flow_loss(*speckle_module.cached_flows(inputs, None, outputs))
+    stored = flow_loss(*speckle_module.cached_flows(inputs, None, outputs, input_flows=stored_flows))
+
+    assert torch.allclose(stored, fresh, atol=1e-5), \
+        f"Flow loss from the store {stored.item():.6f} differs from the fresh one {fresh.item():.6f}"
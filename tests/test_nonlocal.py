@@ -0,0 +1,29 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from ssm.models.gan.gan import NonLocalBlock
+
+# 16x16 = 256 positions, so a chunk of 48 queries splits them unevenly
+EXAMPLE_SHAPE = (2, 8, 16, 16)
+CHUNK_SIZE = 48
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+
+@pytest.mark.skipif(not hasattr(torch.nn.functional, 'scaled_dot_product_attention'),
+                    reason="Both paths are the exact implementation without scaled_dot_product_attention")
+@pytest.mark.parametrize("sub_sample", [False, True])
+def test_chunked_matches_exact(sub_sample):
+    block = NonLocalBlock(EXAMPLE_SHAPE[1], sub_sample=sub_sample, query_chunk_size=CHUNK_SIZE).eval()
+    x = torch.randn(*EXAMPLE_SHAPE)
+
+    with torch.no_grad():
+        chunked = block(x)
+        block.exact = True
+        exact = block(x)
+
+    assert chunked.shape == x.shape
+    assert torch.allclose(chunked, exact, atol=1e-5, rtol=1e-4), \
+        f"Chunked attention differs from exact by {(chunked - exact).abs().max().item():.2e}"